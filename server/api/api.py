@@ -1,9 +1,9 @@
 import argparse
+import asyncio
 import os
 import sys
 import uuid
-import base64
-from binascii import Error as binasciiError
+from concurrent.futures import ThreadPoolExecutor
 
 from lib import logging
 from lib.config import Config
@@ -14,14 +14,22 @@ logging.init(fmt=logging.DEFAULT_LOG_FMT)
 
 LOGGER = logging.getLogger(__name__)
 
-from db import session_scope
-from db.devices import Devices as DevicesDB
+from db import dispose_async_engine, session_scope, stop_replica_monitor
+from db.filters import stop_filter_bank
+from db.ingest import stop_ingest_buffer
 from db.users import Users as UsersDB
-from db.service_accounts import ServiceAccount as ServiceAccountsDB
+from lib import exceptions as local_exc
+from lib.aio import stop_background_loop
+from lib.devices import particle
+from lib.http import close_http_sessions
+from lib.passwords import get_password_hasher, stop_password_hasher
 from resources import API_PREFIX
-from resources.auth import AuthUser, api as AuthNS, session_urls as AuthSessionUrlsNS
+from resources.admin import api as AdminNS
+from resources.auth import load_user_from_bearer_token, load_user_from_session, api as AuthNS, session_urls as AuthSessionUrlsNS
 from resources.devices import api as DevicesNS
 from resources.device_measurements import api as DeviceMeasurementsNS
+from resources.device_pours import api as DevicePoursNS
+from resources.exports import routes as ExportRoutes
 from resources.device_status import api as DeviceStatusNS
 from resources.users import api as UsersNS
 from resources.ui import api as UINS
@@ -33,7 +41,7 @@ from flask_login import LoginManager
 from flask_restx import Api, Resource
 from flask_restx.errors import abort
 from aiohttp import web
-from aiohttp_wsgi import WSGIHandler, serve
+from aiohttp_wsgi import WSGIHandler
 
 
 app = Flask(__name__, static_folder='static', static_url_path='')
@@ -43,10 +51,7 @@ login_manager.init_app(app)
 
 @login_manager.user_loader
 async def load_user(user_id):
-    with session_scope(CONFIG) as db_session:
-        print("refreshing user %s" % user_id)
-
-        return AuthUser.from_user(UsersDB.get_by_pkey(db_session, user_id))
+    return load_user_from_session(CONFIG, user_id)
     
 @login_manager.unauthorized_handler
 async def redirect_not_logged_in():
@@ -69,37 +74,11 @@ async def load_user_from_request(request):
     if bearer_token:
         LOGGER.debug(f"Bearer token found, attempting to decode and authorize.  Bearer token: {bearer_token}")
         try:
-            bearer_token = base64.b64decode(bearer_token).decode('ascii')
-            LOGGER.debug(f"Bearer token decoded successfully.  Decoded bearer token: {bearer_token}")
-        except TypeError as e:
-            abort(401, "Invalid Bearer token format")
-        except binasciiError as e:
-            abort(401, "Invalid Bearer token format")
-        parts = bearer_token.split('|')
-        if len(parts) != 2:
-            abort(401, "Invalid Bearer token format")
-        
-        type = parts[0].lower()
-        key = parts[1]
-        LOGGER.info(f"Bearer token type: {type}")
-        LOGGER.info(f"API Key: {key}")
-        if type == "user":
-            with session_scope(CONFIG) as db_session:
-                user = UsersDB.get_by_api_key(db_session, key)
-                if user:
-                    return AuthUser.from_user(user) 
-        elif type == "svc":
-            with session_scope(CONFIG) as db_session:
-                svc_acc = ServiceAccountsDB.get_by_api_key(db_session, key)
-                if svc_acc:
-                    return AuthUser.from_service_account(svc_acc)
-        elif type == "device":
-            with session_scope(CONFIG) as db_session:
-                dev = DevicesDB.get_by_api_key(db_session, key)
-                if dev:
-                    return AuthUser.from_device(dev)
-        else:
-            abort(401, "Invalid Bearer token format")
+            user = load_user_from_bearer_token(CONFIG, bearer_token)
+        except local_exc.InvalidBearerToken as ex:
+            abort(401, str(ex))
+        if user:
+            return user
 
     # finally, return None if both methods did not login the user
     return None
@@ -135,14 +114,30 @@ api.add_namespace(AuthSessionUrlsNS, path=f"/auth")
 api.add_namespace(AuthNS, path=f"{API_PREFIX}/auth")
 api.add_namespace(DevicesNS, path=f"{API_PREFIX}/devices")
 api.add_namespace(DeviceMeasurementsNS, path=f"{API_PREFIX}/devices/<device_id>/measurements")
+api.add_namespace(DevicePoursNS, path=f"{API_PREFIX}/devices/<device_id>/pours")
 api.add_namespace(DeviceStatusNS, path=f"{API_PREFIX}/devices/<id>/status")
 api.add_namespace(UsersNS, path=f"{API_PREFIX}/users")
+api.add_namespace(AdminNS, path=f"{API_PREFIX}/admin")
 
 @api.route(f"{API_PREFIX}/ping")
 class Ping(Resource):
     def get(self):
         return "pong"
 
+async def close_background_loop_clients():
+    await close_http_sessions()
+    await dispose_async_engine()
+
+async def stop_background_workers(_app):
+    # writes out the measurements still queued in the ingest buffer and the measurement filter states, then closes the
+    # async engine's connections and the shared http client sessions
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, stop_ingest_buffer)
+    await loop.run_in_executor(None, stop_filter_bank)
+    await loop.run_in_executor(None, stop_password_hasher)
+    await loop.run_in_executor(None, lambda: stop_background_loop(cleanup=close_background_loop_clients()))
+    await loop.run_in_executor(None, stop_replica_monitor)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
 
@@ -184,17 +179,27 @@ if __name__ == '__main__':
             init_admin_pass = CONFIG.get("auth.initial_admin.password")
             api_key = CONFIG.get("auth.initial_admin.api_key")
             logger.info(f"Creating initial admin user {init_admin_username}")
-            UsersDB.create(db_session, password=init_admin_pass, email=init_admin_username, api_key=api_key, admin=True)
+            password_hash = get_password_hasher(CONFIG).hash_sync(init_admin_pass)
+            UsersDB.create(db_session, password_hash=password_hash, email=init_admin_username, api_key=api_key, admin=True)
+
+    particle.start_client()
 
     port = CONFIG.get("api.port")
     logger.debug("app.config: %s", app.config)
     logger.debug("config: %s", CONFIG.data_flat)
     logger.info("Serving on port %s", port)
 
+    # the flask app is served through aiohttp, next to native aiohttp routes for the responses that need to be
+    # streamed (aiohttp_wsgi buffers the whole WSGI response body in memory)
+    aio_app = web.Application()
+    aio_app.add_routes(ExportRoutes)
+    wsgi_handler = WSGIHandler(app, executor=ThreadPoolExecutor(CONFIG.get("api.threads", 12)))
+    aio_app.router.add_route("*", "/{path_info:.*}", wsgi_handler.handle_request)
+    aio_app.on_cleanup.append(stop_background_workers)
+
     try:
         # app.run(host="0.0.0.0", port=port, debug=False)
-        wsgi_handler = WSGIHandler(app)
-        serve(app, port=port)
+        web.run_app(aio_app, port=port)
     except KeyboardInterrupt:
         logger.info("User interrupted - Goodbye")
         sys.exit()
\ No newline at end of file
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+# Compares the per call cost of the hot lookups through the ORM query methods with the cached statements of db.lookups.
+#
+#   cd api && poetry run python -m benchmarks.lookups              # against the configured database
+#   cd api && poetry run python -m benchmarks.lookups --offline    # statement construction only, no database needed
+#
+# Against a database, the api key, device and chip id of the first device (and first user, when there is one) are looked
+# up, so run it after seeding the database.  --offline builds the statements and their cache keys, which is what every
+# call pays before sqlalchemy finds the already compiled SQL in its cache.
+
+import argparse
+import time
+
+from lib import logging
+from lib.config import Config
+
+CONFIG = Config()
+CONFIG.setup(config_files=["default.json"])
+logging.init(fmt=logging.DEFAULT_LOG_FMT)
+
+LOGGER = logging.getLogger(__name__)
+
+from sqlalchemy import and_, select
+
+from db import lookups, session_scope
+from db.devices import Devices
+from db.users import Users
+
+
+def measure(fn, iterations):
+    # returns the (wall, cpu) microseconds per call
+    fn()  # warm up the statement caches
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - wall_start) / iterations * 1e6, (time.process_time() - cpu_start) / iterations * 1e6
+
+
+def report(name, orm, cached):
+    LOGGER.info(
+        "%-24s orm: %8.1fus wall %8.1fus cpu | cached: %8.1fus wall %8.1fus cpu | cpu -%.0f%%",
+        name, orm[0], orm[1], cached[0], cached[1], (1 - cached[1] / orm[1]) * 100,
+    )
+
+
+def run_offline(iterations):
+    # the select() equivalents of the ORM query methods, built the way they are on every call
+    cases = {
+        "get_by_api_key": (
+            lambda: select(Devices).filter_by(api_key="key")._generate_cache_key(),
+            lambda: lookups._device_by_api_key("key")._generate_cache_key(),  # pylint: disable=protected-access
+        ),
+        "get_by_pkey": (
+            lambda: select(Users).where(Users.id == "pkey")._generate_cache_key(),
+            lambda: lookups._user_by_pkey("pkey")._generate_cache_key(),  # pylint: disable=protected-access
+        ),
+        "get_by_chip_id": (
+            lambda: select(Devices).where(and_(Devices.chip_type.ilike("particle"), Devices.chip_id.ilike("chip")))._generate_cache_key(),
+            lambda: lookups._devices_by_chip_id("particle", "chip")._generate_cache_key(),  # pylint: disable=protected-access
+        ),
+    }
+
+    for name, (orm, cached) in cases.items():
+        report(name, measure(orm, iterations), measure(cached, iterations))
+
+
+def run(iterations):
+    with session_scope(CONFIG) as db_session:
+        dev = db_session.scalars(select(Devices).limit(1)).first()
+        user = db_session.scalars(select(Users).limit(1)).first()
+        if dev is None:
+            raise SystemExit("No devices found, seed the database first")
+
+        dev_id, api_key, chip_type, chip_id = dev.id, dev.api_key, dev.chip_type, dev.chip_id
+        user_id = user.id if user else None
+
+    cases = {
+        "get_by_api_key": (
+            lambda s: Devices.get_by_api_key(s, api_key),
+            lambda s: lookups.device_by_api_key(s, api_key),
+        ),
+        "get_by_chip_id": (
+            lambda s: Devices.get_by_chip_id(s, chip_type, chip_id),
+            lambda s: lookups.devices_by_chip_id(s, chip_type, chip_id),
+        ),
+    }
+    if user_id:
+        cases["get_by_pkey (user)"] = (
+            lambda s: Users.get_by_pkey(s, user_id),
+            lambda s: lookups.user_by_pkey(s, user_id),
+        )
+
+    for name, (orm, cached) in cases.items():
+        # a fresh session per call, as every request gets one, so the ORM versions can not answer from the identity map
+        def per_request(fn):
+            def call():
+                with session_scope(CONFIG) as db_session:
+                    fn(db_session)
+            return call
+
+        report(name, measure(per_request(orm), iterations), measure(per_request(cached), iterations))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the hot lookup queries, ORM query methods vs. cached statements")
+    parser.add_argument("-n", "--iterations", type=int, default=2000, help="The number of calls to time per lookup.  Default: 2000")
+    parser.add_argument("--offline", action="store_true", help="Only time the statement construction, without a database")
+    args = parser.parse_args()
+
+    if args.offline:
+        run_offline(args.iterations)
+    else:
+        run(args.iterations)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+# Measures the latency of simulated device ingest requests during a burst of password logins, with the password checked
+# inline in the request thread (as the login used to) and on the bounded password hasher pool of lib.passwords.
+#
+#   cd api && poetry run python -m benchmarks.passwords
+#   cd api && poetry run python -m benchmarks.passwords --logins 32 --threads 8
+#
+# No database is needed: the requests run on a thread pool sized like the WSGI one (api.threads), an ingest request
+# parses and validates a batch of measurements with the measurement handler and sleeps for what a database round trip
+# would take, and a login verifies a password hashed with the configured auth.passwords.argon2.* parameters, on a short
+# lived event loop like Flask's async views.
+# A login turned away by the pool is retried after --retry-ms, like a client retrying a 503, so every phase completes
+# the same logins, and the ingest requests keep coming until they have all succeeded.
+
+import argparse
+import asyncio
+import json
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+from lib import logging
+from lib.config import Config
+
+CONFIG = Config()
+CONFIG.setup(config_files=["default.json"])
+logging.init(fmt=logging.DEFAULT_LOG_FMT)
+
+LOGGER = logging.getLogger(__name__)
+
+from lib.exceptions import PasswordHasherBusy
+from lib.passwords import PasswordHasherPool, password_hasher
+from resources.device_measurements import DeviceMeasurementResource
+
+PASSWORD = "supersecretpassword"
+# a batch as a device posts it to /devices/<device id>/measurements/batch
+BATCH = json.dumps([{"m": 20000.0 - i, "u": "g", "ts": 1760000000 + i} for i in range(50)])
+DEVICE = SimpleNamespace(id="00000000-0000-0000-0000-000000000000", device_type="weight")
+
+
+def ingest_request(db_ms):
+    # parsed and validated by the measurement handler, as the API does before writing the batch
+    for data in json.loads(BATCH):
+        DeviceMeasurementResource.build_measurement(None, DEVICE, data)
+    time.sleep(db_ms / 1000)
+
+
+def login_request(verify, password_hash):
+    async def login():
+        try:
+            return await verify(password_hash, PASSWORD)
+        except PasswordHasherBusy:
+            return None
+    return asyncio.run(login())
+
+
+def login_client(executor, verify, password_hash, retry_ms):
+    # the client side of a login: each attempt takes a request thread, the wait before a retry does not
+    submitted = time.perf_counter()
+    retries = 0
+    while not executor.submit(login_request, verify, password_hash).result():
+        retries += 1
+        time.sleep(retry_ms / 1000)
+    return (time.perf_counter() - submitted) * 1000, retries
+
+
+def _quantiles(latencies):
+    latencies = sorted(latencies)
+    quantiles = statistics.quantiles(latencies, n=100, method="inclusive") if len(latencies) > 1 else latencies * 99
+    return quantiles[49], quantiles[94], quantiles[98], latencies[-1]
+
+
+def run_phase(name, threads, duration, ingest_interval_ms, db_ms, logins=0, verify=None, password_hash=None, retry_ms=50):
+    latencies = []
+    lock = threading.Lock()
+    results = []
+
+    with ThreadPoolExecutor(threads) as executor, ThreadPoolExecutor(max(logins, 1)) as clients:
+        def timed_ingest(submitted):
+            ingest_request(db_ms)
+            with lock:
+                latencies.append((time.perf_counter() - submitted) * 1000)
+
+        login_futures = []
+        start = time.perf_counter()
+        next_ingest = start
+        burst_at = start + duration / 4
+        # past the duration, ingest goes on until the burst of logins is over
+        while (now := time.perf_counter()) < start + duration or not all(f.done() for f in login_futures):
+            if logins and now >= burst_at and not login_futures:
+                login_futures = [clients.submit(login_client, executor, verify, password_hash, retry_ms) for _ in range(logins)]
+            if now >= next_ingest:
+                executor.submit(timed_ingest, now)
+                next_ingest += ingest_interval_ms / 1000
+            time.sleep(0.0005)
+        results = [f.result() for f in login_futures]
+
+    LOGGER.info(
+        "%-8s ingest requests: %5d  p50: %7.1fms  p95: %7.1fms  p99: %7.1fms  max: %7.1fms",
+        name, len(latencies), *_quantiles(latencies),
+    )
+    if results:
+        LOGGER.info(
+            "%-8s logins:          %5d  p50: %7.1fms  p95: %7.1fms  p99: %7.1fms  max: %7.1fms | busy retries: %d",
+            name, len(results), *_quantiles([latency for latency, _ in results]), sum(retries for _, retries in results),
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ingest latency during a burst of logins, inline vs. pooled password checks")
+    parser.add_argument("--threads", type=int, default=CONFIG.get("api.threads", 12), help="The number of request threads.  Default: api.threads")
+    parser.add_argument("--logins", type=int, default=16, help="The number of concurrent logins in the burst.  Default: 16")
+    parser.add_argument("--duration", type=float, default=5, help="The duration of each phase, in seconds.  Default: 5")
+    parser.add_argument("--ingest-interval-ms", type=float, default=5, help="The time between two ingest requests.  Default: 5")
+    parser.add_argument("--db-ms", type=float, default=2, help="The simulated database time of an ingest request.  Default: 2")
+    parser.add_argument("--retry-ms", type=float, default=50, help="The time before a login turned away as busy is retried.  Default: 50")
+    args = parser.parse_args()
+
+    hasher = password_hasher(CONFIG)
+    password_hash = hasher.hash(PASSWORD)
+
+    async def verify_inline(_hash, password):
+        return hasher.verify(_hash, password)
+
+    pool = PasswordHasherPool(
+        hasher,
+        max_workers=CONFIG.get("auth.passwords.max_workers", 2),
+        max_pending=CONFIG.get("auth.passwords.max_pending", 4),
+    )
+
+    phase = dict(threads=args.threads, duration=args.duration, ingest_interval_ms=args.ingest_interval_ms, db_ms=args.db_ms)
+    try:
+        run_phase("baseline", **phase)
+        run_phase("inline", logins=args.logins, verify=verify_inline, password_hash=password_hash, retry_ms=args.retry_ms, **phase)
+        run_phase("pool", logins=args.logins, verify=pool.verify, password_hash=password_hash, retry_ms=args.retry_ms, **phase)
+    finally:
+        pool.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,16 @@
 import logging
 import re
-from contextlib import contextmanager
+import threading
+from contextlib import asynccontextmanager, contextmanager
 from urllib.parse import quote
 
+from psycopg2 import errors as pg_errors
 from psycopg2.errors import InvalidTextRepresentation, NotNullViolation, UniqueViolation  # pylint: disable=no-name-in-module
 from psycopg2.extensions import QuotedString, register_adapter
-from sqlalchemy import DDL, Column, DateTime, String, create_engine, event, func, text
+from sqlalchemy import DDL, Column, DateTime, String, create_engine, delete, event, func, select, text
 from sqlalchemy.dialects.postgresql import ENUM
 from sqlalchemy.exc import DataError, IntegrityError
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.inspection import inspect
@@ -17,10 +20,13 @@ from sqlalchemy.orm.session import Session
 
 from lib import exceptions as local_exc
 from lib import json
+from lib.aio import run_on_background_loop
+from db.pool import InstrumentedAsyncAdaptedQueuePool, InstrumentedQueuePool, pool_kwargs
+from db.replicas import Replica, ReplicaSet
 
 Base = declarative_base()
 
-__all__ = ["devices", "device_measurements", "users", "service_accounts"]
+__all__ = ["devices", "device_measurements", "device_pours", "users", "service_accounts"]
 
 
 LOGGER = logging.getLogger(__name__)
@@ -29,36 +35,201 @@ LOGGER = logging.getLogger(__name__)
 def create_extensions(_target, connection, **_):
     connection.execute(text('CREATE EXTENSION IF NOT EXISTS "uuid-ossp";'))
 
+def _get_db_password(config, connect_args, host=None):
+    password = config.get("db.password")
+
+    if not password:
+        connect_args["sslmode"] = "require"
+        rds = aws.client("rds")
+        password = rds.generate_db_auth_token(host or config.get("db.host"), config.get("db.port"), config.get("db.username"))
+
+    return password
+
+
+def _get_db_url(config, password, driver="postgresql", host=None, port=None):
+    return (
+        f"{driver}://"
+        f"{quote(config.get('db.username'))}:{quote(password)}@{quote(host or config.get('db.host'))}:"
+        f"{port or config.get('db.port')}/{quote(config.get('db.name'))}"
+    )
+
+
+def _create_engine(config, host=None, port=None, connect_args=None):
+    engine_kwargs = {
+        "connect_args": {"application_name": config.get("app_id", f"UNKNOWN=>({__name__})")} | (connect_args or {}),
+        "json_serializer": json.dumps,
+    }
+
+    password = _get_db_password(config, engine_kwargs["connect_args"], host)
+
+    return create_engine(_get_db_url(config, password, host=host, port=port), poolclass=InstrumentedQueuePool, **pool_kwargs(config), **engine_kwargs)
+
+
+def _create_async_engine(config, host=None, port=None, connect_args=None):
+    connect_args = dict(connect_args or {})
+    password = _get_db_password(config, connect_args, host)
+    if connect_args.pop("sslmode", None):
+        connect_args["ssl"] = "require"
+    connect_args["server_settings"] = {"application_name": config.get("app_id", f"UNKNOWN=>({__name__})")}
+
+    return create_async_engine(
+        _get_db_url(config, password, driver="postgresql+asyncpg", host=host, port=port),
+        poolclass=InstrumentedAsyncAdaptedQueuePool,
+        connect_args=connect_args,
+        json_serializer=json.dumps,
+        **pool_kwargs(config),
+    )
+
+
 engine = None
 def get_engine(config):
     global engine
 
     if engine is None:
         LOGGER.debug("Creating Postgres engine")
-        engine_kwargs = {
-            "connect_args": {"application_name": config.get("app_id", f"UNKNOWN=>({__name__})")},
-            "json_serializer": json.dumps,
-        }
-
-        password = config.get("db.password")
-
-        if not password:
-            engine_kwargs["connect_args"]["sslmode"] = "require"
-            rds = aws.client("rds")
-            password = rds.generate_db_auth_token(config.get("db.host"), config.get("db.port"), config.get("db.username"))
-            
-        engine = create_engine(
-            (
-                "postgresql://"
-                f"{quote(config.get('db.username'))}:{quote(password)}@{quote(config.get('db.host'))}:"
-                f"{config.get('db.port')}/{quote(config.get('db.name'))}"
-            ),
-            **engine_kwargs,
-        )
+        engine = _create_engine(config)
 
     return engine
 
 
+replica_set = None
+_replica_set_lock = threading.Lock()
+def get_replica_set(config):
+    # The read replicas of the db.replicas.hosts config, None when there are none.  Their health and lag is checked by a
+    # background thread started with the first read only session.
+    global replica_set
+
+    hosts = [h.strip() for h in config.get("db.replicas.hosts") or [] if h.strip()]
+    if not hosts:
+        return None
+
+    with _replica_set_lock:
+        if replica_set is None:
+            LOGGER.debug("Creating read replica engines for: %s", ", ".join(hosts))
+            port = config.get("db.replicas.port") or config.get("db.port")
+            timeout = config.get("db.replicas.connect_timeout_seconds", 5)
+            replicas = [
+                Replica(
+                    host,
+                    _create_engine(config, host, port, connect_args={"connect_timeout": timeout}),
+                    # binds a default for each host, rather than the loop variable
+                    lambda host=host: _create_async_engine(config, host, port, connect_args={"timeout": timeout}),
+                )
+                for host in hosts
+            ]
+            replica_set = ReplicaSet(
+                replicas,
+                selection=config.get("db.replicas.selection", "round_robin"),
+                max_lag_seconds=config.get("db.replicas.max_lag_seconds", 30),
+                check_interval_seconds=config.get("db.replicas.check_interval_seconds", 10),
+            )
+            replica_set.start()
+
+    return replica_set
+
+
+def stop_replica_monitor():
+    if replica_set is not None:
+        replica_set.stop()
+
+
+def _choose_replica(config, use_async=False):
+    replicas = get_replica_set(config)
+    if replicas is None:
+        return None
+
+    replica = replicas.choose(use_async=use_async)
+    if replica is None:
+        LOGGER.debug("No read replica available, using the primary")
+    return replica
+
+
+session_factory = None
+def get_session_factory(config, read_only=False):
+    # One sessionmaker for the process, rather than one per session.  Read only sessions go to a healthy read replica
+    # when there is one.
+    global session_factory
+
+    if read_only:
+        replica = _choose_replica(config)
+        if replica is not None:
+            return replica.session_factory
+
+    if session_factory is None:
+        session_factory = sessionmaker(bind=get_engine(config))
+
+    return session_factory
+
+
+async_engine = None
+def get_async_engine(config):
+    # The asyncpg engine behind async_session_scope.  Its connection pool is bound to the event loop it is used on, so
+    # it must only be used from the background event loop (see run_in_async_session)
+    global async_engine
+
+    if async_engine is None:
+        LOGGER.debug("Creating async Postgres engine")
+        async_engine = _create_async_engine(config)
+
+    return async_engine
+
+
+async_session_factory = None
+def get_async_session_factory(config, read_only=False):
+    global async_session_factory
+
+    if read_only:
+        replica = _choose_replica(config, use_async=True)
+        if replica is not None:
+            return replica.async_session_factory
+
+    if async_session_factory is None:
+        # objects are not expired on commit, since reloading them would need an await
+        async_session_factory = async_sessionmaker(bind=get_async_engine(config), expire_on_commit=False)
+
+    return async_session_factory
+
+
+async def dispose_async_engine():
+    global async_engine, async_session_factory
+
+    if async_engine is not None:
+        await async_engine.dispose()
+        async_engine = None
+        async_session_factory = None
+
+    if replica_set is not None:
+        for replica in replica_set.replicas:
+            await replica.dispose_async_engine()
+
+
+def pool_metrics():
+    # checkout statistics of the connection pools created so far
+    metrics = {}
+    if engine is not None:
+        metrics["sync"] = engine.pool.metrics()
+    if async_engine is not None:
+        metrics["async"] = async_engine.pool.metrics()
+    if replica_set is not None:
+        metrics["replicas"] = replica_set.metrics()
+    return metrics
+
+
+def _is_pg_error(orig, psycopg2_error):
+    if isinstance(orig, psycopg2_error):
+        return True
+
+    # asyncpg errors are wrapped by sqlalchemy's asyncpg dialect, which only keeps the SQLSTATE of the original
+    sqlstate = getattr(orig, "sqlstate", None)
+    if not sqlstate:
+        return False
+
+    try:
+        return issubclass(pg_errors.lookup(sqlstate), psycopg2_error)
+    except KeyError:
+        return False
+
+
 @contextmanager
 def convert_exception(sqla, psycopg2=None, new=None, param_names=None, str_match=""):
     if param_names is None:
@@ -77,7 +248,7 @@ def convert_exception(sqla, psycopg2=None, new=None, param_names=None, str_match
         if psycopg2 is None:
             raise new() from exc
 
-        if isinstance(exc.orig, psycopg2):
+        if _is_pg_error(exc.orig, psycopg2):
             if not param_names:
                 args = [str(exc.orig)]
             raise new(*args) from exc
@@ -85,13 +256,14 @@ def convert_exception(sqla, psycopg2=None, new=None, param_names=None, str_match
         raise
 
 
-def create_session(config, **kwargs):
-    return sessionmaker(bind=get_engine(config), **kwargs)()
+def create_session(config, read_only=False, **kwargs):
+    return get_session_factory(config, read_only)(**kwargs)
 
 
 @contextmanager
-def session_scope(config, **kwargs):
-    session = create_session(config, **kwargs)
+def session_scope(config, read_only=False, **kwargs):
+    # read_only sessions may be served by a read replica, which can be up to db.replicas.max_lag_seconds behind
+    session = create_session(config, read_only, **kwargs)
     try:
         yield session
         session.commit()
@@ -112,6 +284,29 @@ def application_name_suffix(session, appname):
         session.execute(text("SET application_name TO :appname"), {"appname": original_value})
 
 
+@asynccontextmanager
+async def async_session_scope(config, read_only=False, **kwargs):
+    session = get_async_session_factory(config, read_only)(**kwargs)
+    try:
+        yield session
+        await session.commit()
+    except:
+        await session.rollback()
+        raise
+    finally:
+        await session.close()
+
+
+async def run_in_async_session(config, fn, read_only=False, **kwargs):
+    # Awaits `fn(session)` with an async_session_scope session, on the background event loop the async engine lives on.
+    # Meant for the async resource handlers: a slow query only holds up the request waiting on it.
+    async def run():
+        async with async_session_scope(config, read_only, **kwargs) as session:
+            return await fn(session)
+
+    return await run_on_background_loop(run())
+
+
 def _get_column_value(instance, col_name):
     try:
         return getattr(instance, col_name)
@@ -383,3 +578,95 @@ class QueryMethodsMixin:
             except:
                 session.rollback()
                 raise
+
+    # async versions of the above, for an async_session_scope session
+
+    @classmethod
+    async def async_query(cls, session, stmt=None, slice_start=None, slice_end=None, ids=None, locations=None, **kwargs):
+        if stmt is None:
+            stmt = select(cls).filter_by(**kwargs)
+
+        if not None in [slice_start, slice_end]:
+            stmt = stmt.slice(slice_start, slice_end)
+
+        if locations:
+            LOGGER.debug("filtering query by locations: %s", locations)
+            stmt = stmt.where(cls.location_id.in_(locations))
+
+        if ids:
+            LOGGER.debug("filtering query by ids: %s", ids)
+            stmt = stmt.where(cls.id.in_(ids))
+
+        return (await session.scalars(stmt)).all()
+
+    @classmethod
+    async def async_get_by_pkey(cls, session, pkey):
+        return await session.get(cls, pkey)
+
+    @classmethod
+    async def async_create(cls, session, autocommit=True, **kwargs):
+        for key in kwargs:
+            if not hasattr(cls, key):
+                raise local_exc.InvalidParameter(key)
+
+        row = cls(**kwargs)
+        session.add(row)
+
+        if autocommit:
+            try:
+                with convert_exception(IntegrityError, psycopg2=NotNullViolation, new=local_exc.RequiredParameterNotFound), convert_exception(
+                    IntegrityError, psycopg2=UniqueViolation, new=local_exc.ItemAlreadyExists, str_match="_pkey"
+                ):
+                    await session.commit()
+            except:
+                await session.rollback()
+                raise
+
+        return row
+
+    @classmethod
+    async def async_update(cls, session, pkey, merge_nested=False, autocommit=True, **kwargs):
+        merge_fields = getattr(cls, _MERGEABLE_FIELDS_LIST, [])
+        row = await cls.async_get_by_pkey(session, pkey)
+
+        for key, value in kwargs.items():
+            if not hasattr(cls, key):
+                raise local_exc.InvalidParameter(key)
+
+            if merge_nested and key in merge_fields:
+                current = getattr(row, key, {})
+                value = _merge_into(current, value)
+
+            setattr(row, key, value)
+
+        session.add(row)
+        if autocommit:
+            try:
+                await session.commit()
+            except:
+                await session.rollback()
+                raise
+
+        return row
+
+    @classmethod
+    async def async_delete(cls, session, pkey, autocommit=True):
+        await session.delete(await cls.async_get_by_pkey(session, pkey))
+
+        if autocommit:
+            try:
+                await session.commit()
+            except:
+                await session.rollback()
+                raise
+
+    @classmethod
+    async def async_delete_by(cls, session, autocommit=True, **kwargs):
+        await session.execute(delete(cls).filter_by(**kwargs))
+
+        if autocommit:
+            try:
+                await session.commit()
+            except:
+                await session.rollback()
+                raise
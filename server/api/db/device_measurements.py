@@ -2,36 +2,475 @@
 _TABLE_NAME = "device_measurements"
 _PKEY = "id"
 
-from psycopg2.errors import UniqueViolation  # pylint: disable=no-name-in-module
-from sqlalchemy import Column, String, func, DateTime, ForeignKey, Float
-from sqlalchemy.dialects.postgresql import JSONB, UUID
-from sqlalchemy.orm import backref, relationship
-from sqlalchemy.schema import Index
+from array import array
+from datetime import datetime, timedelta, timezone
 
-from db import Base, DictifiableMixin, QueryMethodsMixin
+from psycopg2.errors import NotNullViolation, UniqueViolation  # pylint: disable=no-name-in-module
+from sqlalchemy import (
+    BigInteger, Column, Sequence, column, func, DateTime, ForeignKey, Float, and_, cast, extract, literal, literal_column, or_, select, table, union_all,
+)
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.postgresql import JSONB, UUID, aggregate_order_by, array_agg, insert as pg_insert
+from sqlalchemy.orm import backref, declared_attr, relationship
+from sqlalchemy.schema import Index, UniqueConstraint
+
+from db import Base, DictifiableMixin, QueryMethodsMixin, convert_exception, try_return_all
+from lib import exceptions as local_exc
 from db.types.nested import NestedMutableDict
+from db.types.units import UnitCode
+
+# ids are handed out in insert order, so new rows are appended to the end of the id indexes
+_ID_SEQ = Sequence("device_measurements_id_seq")
+
+_SERIES_ORIGIN = datetime(2000, 1, 1, tzinfo=timezone.utc)
+
+SERIES_AGGREGATES = {
+    "avg": lambda cls: func.avg(cls.measurement),
+    "min": lambda cls: func.min(cls.measurement),
+    "max": lambda cls: func.max(cls.measurement),
+    "last": lambda cls: array_agg(aggregate_order_by(cls.measurement, cls.taken_on.desc()))[1],
+}
+
+# the column of the rollup tables that answers each of the SERIES_AGGREGATES
+ROLLUP_AGGREGATES = {
+    "avg": "avg_measurement",
+    "min": "min_measurement",
+    "max": "max_measurement",
+    "last": "last_measurement",
+}
+
+# the columns of the rollup tables besides their (device_id, bucket) key
+_ROLLUP_VALUE_COLUMNS = ("min_measurement", "max_measurement", "avg_measurement", "first_measurement", "last_measurement", "unit", "measurement_count")
+
+
+def _date_bin(bucket_seconds, col):
+    return func.date_bin(literal(timedelta(seconds=bucket_seconds)), col, literal(_SERIES_ORIGIN))
 
 
 class DeviceMeasurements(Base, DictifiableMixin, QueryMethodsMixin):
     __tablename__ = _TABLE_NAME
 
-    id = Column(_PKEY, UUID, server_default=func.uuid_generate_v4(), primary_key=True)
+    id = Column(_PKEY, BigInteger, _ID_SEQ, server_default=_ID_SEQ.next_value(), primary_key=True)
     device_id = Column(UUID, ForeignKey("devices.id"), nullable=False)
     measurement = Column(Float, nullable=False)
-    unit = Column(String, nullable=False)
-    taken_on = Column(DateTime(timezone=True), nullable=False)
+    unit = Column(UnitCode, nullable=False)
+    # taken_on is part of the primary key because the table is range partitioned on it
+    taken_on = Column(DateTime(timezone=True), primary_key=True, nullable=False)
 
     device = relationship("Devices", back_populates="measurements")
 
     __table_args__ = (
         Index("ix_device_measurements_by_device_id", device_id, unique=False),
         Index("ix_ordered_device_measurements_by_device_id_and_measure", device_id, measurement, taken_on.desc(), unique=False),
+        Index("ix_device_measurements_by_device_id_taken_on_id", device_id, taken_on.desc(), id, unique=False),
+        # a device takes one sample at a time, anything else is a redelivery of the same sample
+        UniqueConstraint(device_id, taken_on, name="uq_device_measurements_device_id_taken_on"),
+        {"postgresql_partition_by": "RANGE (taken_on)"},
     )
+    __mapper_args__ = {"primary_key": [id]}
     
     @classmethod
     def get_by_device_id(cls, session, device_id, **kwargs):
         return session.query(cls).filter_by(device_id=device_id, **kwargs)
     
     @classmethod
-    def get_latest_measurement(cls, session, device_id, **kwargs):
-        return session.query(cls).filter_by(device_id=device_id, **kwargs).order_by(DeviceMeasurements.taken_on.desc()).first()
\ No newline at end of file
+    def _filter_time_range(cls, stmt, start=None, end=None):
+        if start is not None:
+            stmt = stmt.where(cls.taken_on >= start)
+
+        if end is not None:
+            stmt = stmt.where(cls.taken_on < end)
+
+        return stmt
+
+    @classmethod
+    def _select_page(cls, device_id, start=None, end=None, limit=100, after=None):
+        stmt = cls._filter_time_range(select(cls).where(cls.device_id == device_id), start, end)
+
+        # keyset pagination: `after` is the (taken_on, id) of the last row of the previous page
+        if after is not None:
+            after_taken_on, after_id = after
+            stmt = stmt.where(or_(cls.taken_on < after_taken_on, and_(cls.taken_on == after_taken_on, cls.id > after_id)))
+
+        # one row more than asked for, to tell whether there is a next page
+        return stmt.order_by(cls.taken_on.desc(), cls.id).limit(limit + 1)
+
+    @staticmethod
+    def _split_page(rows, limit):
+        next_key = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_key = (rows[-1].taken_on, rows[-1].id)
+
+        return rows, next_key
+
+    @classmethod
+    def get_page(cls, session, device_id, start=None, end=None, limit=100, after=None):
+        rows = try_return_all(session.scalars(cls._select_page(device_id, start, end, limit, after)))
+        return cls._split_page(rows, limit)
+
+    @classmethod
+    async def async_get_page(cls, session, device_id, start=None, end=None, limit=100, after=None):
+        rows = (await session.scalars(cls._select_page(device_id, start, end, limit, after))).all()
+        return cls._split_page(rows, limit)
+
+    @classmethod
+    def get_series(cls, session, device_id, bucket_seconds, agg="avg", start=None, end=None):
+        # buckets that are whole multiples of a rollup are answered from the rollup for everything it has compacted
+        # and only fall back to the raw rows after that, which may also have already been pruned.  A day sized bucket is
+        # answered from the hourly rollup when the daily one does not cover the start of the range yet
+        for rollup in (DeviceMeasurementsDaily, DeviceMeasurementsHourly):
+            if bucket_seconds % rollup.bucket_seconds == 0:
+                compacted_through = rollup.get_compacted_through(session)
+                if compacted_through is not None and (start is None or start < compacted_through):
+                    return rollup.get_series(session, device_id, bucket_seconds, agg, start, end, compacted_through)
+
+        bucket = _date_bin(bucket_seconds, cls.taken_on).label("bucket")
+        stmt = select(bucket, SERIES_AGGREGATES[agg](cls).label("measurement"), func.count().label("count")).where(cls.device_id == device_id)
+        stmt = cls._filter_time_range(stmt, start, end).group_by(bucket).order_by(bucket)
+
+        return session.execute(stmt).all()
+
+    @classmethod
+    def select_as_rollup(cls, start=None, end=None):
+        # a raw sample is a rollup of one
+        m = cls.measurement
+        stmt = select(
+            cls.device_id,
+            cls.taken_on.label("ts"),
+            m.label("min_measurement"),
+            m.label("max_measurement"),
+            m.label("avg_measurement"),
+            m.label("first_measurement"),
+            m.label("last_measurement"),
+            cls.unit,
+            literal_column("1", BigInteger).label("measurement_count"),
+        )
+        return cls._filter_time_range(stmt, start, end)
+
+    @classmethod
+    def stream(cls, session, device_id=None, start=None, end=None, batch_size=5000):
+        # plain rows off a server side cursor, `batch_size` at a time, for exports that must not hold the result in memory.
+        # All devices are exported when no device_id is given, one device after the other.
+        stmt = select(cls.id, cls.device_id, cls.measurement, cls.unit, cls.taken_on)
+        if device_id is not None:
+            stmt = stmt.where(cls.device_id == device_id)
+        stmt = cls._filter_time_range(stmt, start, end).order_by(cls.device_id, cls.taken_on, cls.id)
+
+        yield from session.execute(stmt.execution_options(yield_per=batch_size))
+
+    @classmethod
+    def count_by_device_in_partitions(cls, names):
+        # per device row counts of only the given partitions of the table
+        rows = union_all(*[select(column("device_id")).select_from(table(name)) for name in names]).subquery()
+        return select(rows.c.device_id, func.count().label("measurement_count")).group_by(rows.c.device_id)
+
+    @classmethod
+    def get_raw_series(cls, session, device_id, start=None, end=None, sub_buckets=None, batch_size=10000):
+        x = cast(extract("epoch", cls.taken_on), Float)
+        if sub_buckets:
+            # pre-reduced in the database (M4): of the rows in each of `sub_buckets` equal slices of the range, only the
+            # first, last, min and max ones are returned, which still holds every point a line chart of that many pixels
+            # would draw, so the number of rows fetched is bounded however dense the range is
+            bucket = _date_bin((end - start).total_seconds() / sub_buckets, cls.taken_on)
+            ranks = [
+                func.row_number().over(partition_by=bucket, order_by=order_by)
+                for order_by in (cls.taken_on, cls.taken_on.desc(), (cls.measurement, cls.taken_on), (cls.measurement.desc(), cls.taken_on))
+            ]
+            ranked = select(x.label("x"), cls.measurement, cls.taken_on, *(rank.label(f"rank_{i}") for i, rank in enumerate(ranks)))
+            ranked = cls._filter_time_range(ranked.where(cls.device_id == device_id), start, end).subquery()
+            stmt = select(ranked.c.x, ranked.c.measurement).where(or_(*(ranked.c[f"rank_{i}"] == 1 for i in range(len(ranks)))))
+            stmt = stmt.order_by(ranked.c.taken_on)
+        else:
+            stmt = select(x, cls.measurement).where(cls.device_id == device_id)
+            stmt = cls._filter_time_range(stmt, start, end).order_by(cls.taken_on)
+
+        # only the two columns are kept, as packed arrays of doubles, rather than a list of ORM objects
+        xs = array("d")
+        ys = array("d")
+        for x, y in session.execute(stmt.execution_options(yield_per=batch_size)):
+            xs.append(x)
+            ys.append(y)
+
+        return xs, ys
+
+    @classmethod
+    def get_by_taken_on(cls, session, device_id, taken_on):
+        return session.query(cls).filter_by(device_id=device_id, taken_on=taken_on).first()
+
+    @classmethod
+    async def async_get_by_taken_on(cls, session, device_id, taken_on):
+        return (await session.scalars(select(cls).filter_by(device_id=device_id, taken_on=taken_on).limit(1))).first()
+
+    @classmethod
+    def _insert_many_stmt(cls, rows):
+        for row in rows:
+            for key in row:
+                if not hasattr(cls, key):
+                    raise local_exc.InvalidParameter(key)
+
+        return pg_insert(cls).on_conflict_do_nothing(index_elements=[cls.device_id, cls.taken_on]).returning(cls.id, cls.device_id, cls.taken_on)
+
+    @staticmethod
+    def _inserted_ids(rows, returned):
+        # RETURNING only hands back the inserted rows, they are matched to the input rows on the (device_id, taken_on) the
+        # skipped ones conflicted on.  A sample repeated within the rows is only inserted once, the repeats get None.
+        inserted = {(str(device_id), taken_on): _id for _id, device_id, taken_on in returned}
+        return [inserted.pop((str(row["device_id"]), row["taken_on"]), None) for row in rows]
+
+    @staticmethod
+    def _split_raw(rows):
+        # the raw_measurement the measurement filters (see db.filters) keep next to the filtered measurement is stored
+        # in the device_measurements_raw table
+        if not any("raw_measurement" in row for row in rows):
+            return rows, None
+
+        return [{k: v for k, v in row.items() if k != "raw_measurement"} for row in rows], [row.get("raw_measurement") for row in rows]
+
+    @staticmethod
+    def _raw_rows(rows, raw_values, ids):
+        if raw_values is None:
+            return []
+
+        return [
+            {"device_id": row["device_id"], "taken_on": row["taken_on"], "measurement": raw, "unit": row["unit"]}
+            for row, raw, _id in zip(rows, raw_values, ids)
+            if raw is not None and _id is not None
+        ]
+
+    @classmethod
+    def create_many(cls, session, rows, autocommit=True):
+        # Inserts the rows in one statement, skipping the ones already stored for the device and taken_on (ex: retried
+        # by the device).  Returns, in the order of the input rows, the id of each inserted row or None for skipped ones.
+        if not rows:
+            return []
+
+        rows, raw_values = cls._split_raw(rows)
+        stmt = cls._insert_many_stmt(rows)
+        with convert_exception(IntegrityError, psycopg2=NotNullViolation, new=local_exc.RequiredParameterNotFound):
+            ids = cls._inserted_ids(rows, session.execute(stmt, rows))
+
+        raw_rows = cls._raw_rows(rows, raw_values, ids)
+        if raw_rows:
+            session.execute(DeviceMeasurementsRaw.insert_many_stmt(), raw_rows)
+
+        if autocommit:
+            try:
+                session.commit()
+            except:
+                session.rollback()
+                raise
+
+        return ids
+
+    @classmethod
+    async def async_create_many(cls, session, rows, autocommit=True):
+        if not rows:
+            return []
+
+        rows, raw_values = cls._split_raw(rows)
+        stmt = cls._insert_many_stmt(rows)
+        with convert_exception(IntegrityError, psycopg2=NotNullViolation, new=local_exc.RequiredParameterNotFound):
+            ids = cls._inserted_ids(rows, await session.execute(stmt, rows))
+
+        raw_rows = cls._raw_rows(rows, raw_values, ids)
+        if raw_rows:
+            await session.execute(DeviceMeasurementsRaw.insert_many_stmt(), raw_rows)
+
+        if autocommit:
+            try:
+                await session.commit()
+            except:
+                await session.rollback()
+                raise
+
+        return ids
+
+
+class DeviceMeasurementsRaw(Base, DictifiableMixin, QueryMethodsMixin):
+    # The measurements as they were received, before the measurement filter smoothed them, when
+    # measurements.filter.keep_raw is on.  Only kept for measurements.filter.raw_retention_days.
+    __tablename__ = "device_measurements_raw"
+
+    device_id = Column(UUID, ForeignKey("devices.id"), primary_key=True, nullable=False)
+    taken_on = Column(DateTime(timezone=True), primary_key=True, nullable=False)
+    measurement = Column(Float, nullable=False)
+    unit = Column(UnitCode, nullable=False)
+
+    __table_args__ = (
+        Index("ix_device_measurements_raw_by_taken_on", taken_on, unique=False),
+    )
+
+    @classmethod
+    def insert_many_stmt(cls):
+        return pg_insert(cls).on_conflict_do_nothing(index_elements=[cls.device_id, cls.taken_on])
+
+    @classmethod
+    def prune(cls, session, cutoff, autocommit=True):
+        res = session.execute(cls.__table__.delete().where(cls.taken_on < cutoff))
+
+        if autocommit:
+            try:
+                session.commit()
+            except:
+                session.rollback()
+                raise
+
+        return res.rowcount
+
+
+def _aggregate_rollup_rows(rows, bucket_seconds):
+    bucket = _date_bin(bucket_seconds, rows.c.ts)
+    total = func.sum(rows.c.measurement_count)
+    return select(
+        rows.c.device_id,
+        bucket.label("bucket"),
+        func.min(rows.c.min_measurement).label("min_measurement"),
+        func.max(rows.c.max_measurement).label("max_measurement"),
+        (func.sum(rows.c.avg_measurement * rows.c.measurement_count) / total).label("avg_measurement"),
+        array_agg(aggregate_order_by(rows.c.first_measurement, rows.c.ts))[1].label("first_measurement"),
+        array_agg(aggregate_order_by(rows.c.last_measurement, rows.c.ts.desc()))[1].label("last_measurement"),
+        array_agg(aggregate_order_by(rows.c.unit, rows.c.ts.desc()))[1].label("unit"),
+        cast(total, BigInteger).label("measurement_count"),
+    ).group_by(rows.c.device_id, bucket)
+
+
+class DeviceMeasurementRollupMixin(DictifiableMixin, QueryMethodsMixin):
+    bucket_seconds = None
+    source = None
+
+    @declared_attr
+    def __table_args__(cls):  # pylint: disable=no-self-argument
+        # the primary key leads with device_id, so max(bucket) (the compaction watermark, read by every bucketed series
+        # request) needs an index of its own to not scan the whole table
+        return (Index(f"ix_{cls.__tablename__}_by_bucket", "bucket", unique=False),)
+
+    @declared_attr
+    def device_id(cls):  # pylint: disable=no-self-argument
+        return Column(UUID, ForeignKey("devices.id"), primary_key=True)
+
+    bucket = Column(DateTime(timezone=True), primary_key=True)
+    min_measurement = Column(Float, nullable=False)
+    max_measurement = Column(Float, nullable=False)
+    avg_measurement = Column(Float, nullable=False)
+    first_measurement = Column(Float, nullable=False)
+    last_measurement = Column(Float, nullable=False)
+    unit = Column(UnitCode, nullable=False)
+    measurement_count = Column(BigInteger, nullable=False)
+
+    @classmethod
+    def bucket_start(cls, dt):
+        return datetime.fromtimestamp(dt.timestamp() // cls.bucket_seconds * cls.bucket_seconds, timezone.utc)
+
+    @classmethod
+    def get_compacted_through(cls, session):
+        # buckets are only ever written once they are closed, so everything before the end of the newest one is compacted
+        latest = session.execute(select(func.max(cls.bucket))).scalar()
+        if latest is None:
+            return None
+
+        return latest + timedelta(seconds=cls.bucket_seconds)
+
+    @classmethod
+    def select_as_rollup(cls, start=None, end=None):
+        stmt = select(
+            cls.device_id,
+            cls.bucket.label("ts"),
+            cls.min_measurement,
+            cls.max_measurement,
+            cls.avg_measurement,
+            cls.first_measurement,
+            cls.last_measurement,
+            cls.unit,
+            cls.measurement_count,
+        )
+        if start is not None:
+            stmt = stmt.where(cls.bucket >= start)
+
+        if end is not None:
+            stmt = stmt.where(cls.bucket < end)
+
+        return stmt
+
+    @classmethod
+    def get_recompute_start(cls, session, lookback=None):
+        # where the next compaction starts reading its source rows from, None when nothing has been compacted yet.  The
+        # source rows after it must not be pruned, or the buckets recomputed from them would be overwritten incomplete
+        start = cls.get_compacted_through(session)
+        if start is not None and lookback:
+            # recompute recent buckets as well, to pick up samples that arrived late
+            start = cls.bucket_start(start - lookback)
+
+        return start
+
+    @classmethod
+    def compact(cls, session, now, lookback=None, autocommit=True):
+        end = cls.bucket_start(now)
+        start = cls.get_recompute_start(session, lookback)
+
+        if start is not None and start >= end:
+            return 0
+
+        rows = cls.source.select_as_rollup(start, end).subquery()
+        stmt = pg_insert(cls).from_select(
+            ["device_id", "bucket", *_ROLLUP_VALUE_COLUMNS],
+            _aggregate_rollup_rows(rows, cls.bucket_seconds),
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[cls.device_id, cls.bucket],
+            set_={col: stmt.excluded[col] for col in _ROLLUP_VALUE_COLUMNS},
+        )
+        res = session.execute(stmt)
+
+        if autocommit:
+            try:
+                session.commit()
+            except:
+                session.rollback()
+                raise
+
+        return res.rowcount
+
+    @classmethod
+    def prune(cls, session, cutoff, autocommit=True):
+        res = session.execute(cls.__table__.delete().where(cls.bucket < cutoff))
+
+        if autocommit:
+            try:
+                session.commit()
+            except:
+                session.rollback()
+                raise
+
+        return res.rowcount
+
+    @classmethod
+    def get_series(cls, session, device_id, bucket_seconds, agg="avg", start=None, end=None, compacted_through=None):
+        if compacted_through is None:
+            compacted_through = cls.get_compacted_through(session)
+
+        compacted_end = compacted_through if end is None else min(end, compacted_through)
+        recent_start = compacted_through if start is None else max(start, compacted_through)
+        compacted = cls.select_as_rollup(start, compacted_end).where(cls.device_id == device_id)
+        recent = DeviceMeasurements.select_as_rollup(recent_start, end).where(DeviceMeasurements.device_id == device_id)
+        rows = _aggregate_rollup_rows(union_all(compacted, recent).subquery(), bucket_seconds).subquery()
+
+        stmt = select(rows.c.bucket, rows.c[ROLLUP_AGGREGATES[agg]].label("measurement"), rows.c.measurement_count.label("count"))
+        return session.execute(stmt.order_by(rows.c.bucket)).all()
+
+
+class DeviceMeasurementsHourly(Base, DeviceMeasurementRollupMixin):
+    __tablename__ = "device_measurements_hourly"
+
+    bucket_seconds = 3600
+    source = DeviceMeasurements
+
+
+class DeviceMeasurementsDaily(Base, DeviceMeasurementRollupMixin):
+    __tablename__ = "device_measurements_daily"
+
+    bucket_seconds = 86400
+    source = DeviceMeasurementsHourly
+
+
+ROLLUPS = [DeviceMeasurementsHourly, DeviceMeasurementsDaily]
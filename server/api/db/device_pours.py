@@ -0,0 +1,109 @@
+# pylint: disable=wrong-import-position
+_TABLE_NAME = "device_pours"
+_PKEY = "id"
+
+from sqlalchemy import BigInteger, Column, DateTime, Float, ForeignKey, Sequence, and_, extract, func, or_, select
+from sqlalchemy.dialects.postgresql import UUID, insert as pg_insert
+from sqlalchemy.schema import UniqueConstraint
+
+from db import Base, DictifiableMixin, QueryMethodsMixin
+
+_ID_SEQ = Sequence("device_pours_id_seq")
+
+
+class DevicePours(Base, DictifiableMixin, QueryMethodsMixin):
+    # Pours detected in the measurements of a device by lib.pours.PourDetector, either as the measurements are ingested
+    # (see Devices.record_measurements) or replayed from history by the maintenance script
+
+    __tablename__ = _TABLE_NAME
+
+    id = Column(_PKEY, BigInteger, _ID_SEQ, server_default=_ID_SEQ.next_value(), primary_key=True)
+    device_id = Column(UUID, ForeignKey("devices.id"), nullable=False)
+    started_on = Column(DateTime(timezone=True), nullable=False)
+    ended_on = Column(DateTime(timezone=True), nullable=False)
+    volume_ml = Column(Float, nullable=False)
+
+    __table_args__ = (
+        # also the index for listing and aggregating the pours of a device over a time range.  A pour detected again
+        # (ex: by the backfill, for a time range the ingest path already covered) conflicts on it and is skipped.
+        UniqueConstraint(device_id, started_on, name="uq_device_pours_device_id_started_on"),
+    )
+
+    @classmethod
+    def _insert_many_stmt(cls):
+        return pg_insert(cls).on_conflict_do_nothing(index_elements=[cls.device_id, cls.started_on])
+
+    @classmethod
+    def create_many(cls, session, rows, autocommit=True):
+        if not rows:
+            return
+
+        session.execute(cls._insert_many_stmt(), rows)
+
+        if autocommit:
+            try:
+                session.commit()
+            except:
+                session.rollback()
+                raise
+
+    @classmethod
+    async def async_create_many(cls, session, rows, autocommit=True):
+        if not rows:
+            return
+
+        await session.execute(cls._insert_many_stmt(), rows)
+
+        if autocommit:
+            try:
+                await session.commit()
+            except:
+                await session.rollback()
+                raise
+
+    @classmethod
+    def _filter_time_range(cls, stmt, start=None, end=None):
+        if start is not None:
+            stmt = stmt.where(cls.started_on >= start)
+
+        if end is not None:
+            stmt = stmt.where(cls.started_on < end)
+
+        return stmt
+
+    @classmethod
+    def _select_page(cls, device_id, start=None, end=None, limit=100, after=None):
+        stmt = cls._filter_time_range(select(cls).where(cls.device_id == device_id), start, end)
+
+        # keyset pagination: `after` is the (started_on, id) of the last row of the previous page
+        if after is not None:
+            after_started_on, after_id = after
+            stmt = stmt.where(or_(cls.started_on < after_started_on, and_(cls.started_on == after_started_on, cls.id > after_id)))
+
+        # one row more than asked for, to tell whether there is a next page
+        return stmt.order_by(cls.started_on.desc(), cls.id).limit(limit + 1)
+
+    @classmethod
+    async def async_get_page(cls, session, device_id, start=None, end=None, limit=100, after=None):
+        rows = (await session.scalars(cls._select_page(device_id, start, end, limit, after))).all()
+
+        next_key = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_key = (rows[-1].started_on, rows[-1].id)
+
+        return rows, next_key
+
+    @classmethod
+    async def async_get_stats(cls, session, device_id, start=None, end=None):
+        stmt = select(
+            func.count().label("pour_count"),
+            func.coalesce(func.sum(cls.volume_ml), 0).label("total_volume_ml"),
+            func.avg(cls.volume_ml).label("avg_volume_ml"),
+            func.max(cls.volume_ml).label("max_volume_ml"),
+            func.avg(extract("epoch", cls.ended_on - cls.started_on)).label("avg_duration_seconds"),
+            func.min(cls.started_on).label("first_started_on"),
+            func.max(cls.started_on).label("last_started_on"),
+        ).where(cls.device_id == device_id)
+
+        return (await session.execute(cls._filter_time_range(stmt, start, end))).one()
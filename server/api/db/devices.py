@@ -3,16 +3,23 @@ _TABLE_NAME = "devices"
 _PKEY = "id"
 
 from psycopg2.errors import UniqueViolation  # pylint: disable=no-name-in-module
-from sqlalchemy import Column, String, func, and_, Float, Integer, ColumnDefault
+import math
+
+from sqlalchemy import (
+    BigInteger, Column, DateTime, String, func, and_, bindparam, case, cast, extract, literal, or_, select, text, true, update, Float, Integer, ColumnDefault,
+)
 from sqlalchemy.dialects.postgresql import JSONB, UUID
-from sqlalchemy.orm import relationship
-from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import aliased, relationship
 from sqlalchemy.schema import Index
 
 from lib.logging import getLogger
 from db import Base, DictifiableMixin, QueryMethodsMixin, try_return_all
 from db.device_measurements import DeviceMeasurements
+from db.device_pours import DevicePours
 from db.types.nested import NestedMutableDict
+from db.types.units import unit_name
+from lib.forecast import DEFAULT_RATE_HALF_LIFE_HOURS, ML_PER_MASS_UNIT, ML_PER_VOLUME_UNIT, ml_per_unit
+from lib.pours import PourDetector
 
 LOG = getLogger(__name__)
 
@@ -35,37 +42,16 @@ class Devices(Base, DictifiableMixin, QueryMethodsMixin):
     api_key = Column(String, nullable=False)
     meta = Column(NestedMutableDict.as_mutable(JSONB), nullable=True)
 
-    _measurement_count = None
-    @hybrid_property
-    def measurement_count(self):
-        return self._measurement_count
-    @measurement_count.setter
-    def measurement_count(self, value):
-        self._measurement_count = value
-
-    _latest_measurement = None
-    @hybrid_property
-    def latest_measurement(self):
-        return self._latest_measurement
-    @latest_measurement.setter
-    def latest_measurement(self, value):
-        self._latest_measurement = value
-
-    _latest_measurement_unit = None
-    @hybrid_property
-    def latest_measurement_unit(self):
-        return self._latest_measurement_unit
-    @latest_measurement_unit.setter
-    def latest_measurement_unit(self, value):
-        self._latest_measurement_unit = value
-    
-    _latest_measurement_taken_on = None
-    @hybrid_property
-    def latest_measurement_taken_on(self):
-        return self._latest_measurement_taken_on
-    @latest_measurement_taken_on.setter
-    def latest_measurement_taken_on(self, value):
-        self._latest_measurement_taken_on = value
+    latest_measurement = Column(Float, nullable=True)
+    latest_measurement_unit = Column(String, nullable=True)
+    latest_measurement_taken_on = Column(DateTime(timezone=True), nullable=True)
+    measurement_count = Column(BigInteger, server_default=text("0"), nullable=False)
+    consumption_ml_per_hour = Column(Float, nullable=True)
+    # the pour in progress, see lib.pours.PourDetector
+    pour_started_on = Column(DateTime(timezone=True), nullable=True)
+    pour_start_ml = Column(Float, nullable=True)
+    # the checkpointed noise filter of the device's measurements, see db.filters
+    filter_state = Column(JSONB, nullable=True)
 
     measurements = relationship("DeviceMeasurements", back_populates="device")
 
@@ -76,55 +62,271 @@ class Devices(Base, DictifiableMixin, QueryMethodsMixin):
 
     @classmethod
     def _build_query_with_measurement_stats(cls, session, **kwargs):
-        return session.query(cls, func.count(DeviceMeasurements.id).label("measurement_count")).join(DeviceMeasurements, isouter=True).group_by(Devices.id)
-
-    @classmethod
-    def _parse_result_with_measurement_stats(cls, session, res, **kwargs):
-        dev = None
-        if type(res) is Devices:
-            dev = res
-        else:
-            dev = res[0]
-            dev.measurement_count = res[1]
-
-        latest_measurement = DeviceMeasurements.get_latest_measurement(session, dev.id)
-        if latest_measurement:
-            dev.latest_measurement = latest_measurement.measurement
-            dev.latest_measurement_unit = latest_measurement.unit
-            dev.latest_measurement_taken_on = latest_measurement.taken_on    
-
-        return dev
-    
-    @classmethod
-    def _all_with_measurement_stats(cls, session, query=None, **kwargs):
-        if query is None:
-            query = Devices._build_query_with_measurement_stats(session)
-
-        res = try_return_all(query)
-        if not res:
-            return res
-        
-        devices = []
-        for r in res:
-            devices.append(Devices._parse_result_with_measurement_stats(session, r))
+        return session.query(cls).filter_by(**kwargs)
 
-        return devices
-    
     @classmethod
     def get_with_measurement_stats(cls, session, pk_id, **kwargs):
         LOG.debug(f"Querying for pk {pk_id}")
-        res = cls._build_query_with_measurement_stats(session, **kwargs).filter(Devices.id == pk_id).first()
-        return cls._parse_result_with_measurement_stats(session, res, **kwargs)
+        return cls._build_query_with_measurement_stats(session, **kwargs).filter(Devices.id == pk_id).first()
         
     @classmethod
     def get_all_with_measurement_stats(cls, session, **kwargs):
-        return Devices._all_with_measurement_stats(session, **kwargs)
+        return try_return_all(cls._build_query_with_measurement_stats(session, **kwargs))
                  
     @classmethod
     def get_by_chip_id(cls, session, chip_type, chip_id, **kwargs):
-        q = Devices._build_query_with_measurement_stats(session, **kwargs).filter(and_(Devices.chip_type.ilike(chip_type), Devices.chip_id.ilike(chip_id)))
-        return Devices._all_with_measurement_stats(session, query=q, **kwargs)
-    
+        q = cls._build_query_with_measurement_stats(session, **kwargs).filter(and_(Devices.chip_type.ilike(chip_type), Devices.chip_id.ilike(chip_id)))
+        return try_return_all(q)
+
+    @classmethod
+    def _ml_per_latest_measurement_unit(cls):
+        # lib.forecast.ml_per_unit of the stored latest measurement, NULL for a unit that does not fit the device type
+        return case(
+            *[(and_(cls.device_type == "weight", cls.latest_measurement_unit == unit), f) for unit, f in ML_PER_MASS_UNIT.items()],
+            *[(cls.latest_measurement_unit == unit, f) for unit, f in ML_PER_VOLUME_UNIT.items()],
+        )
+
+    @classmethod
+    def _consumption_rate(cls, latest, half_life_hours):
+        # lib.forecast.update_rate in SQL, over the old row's values: the step from the stored latest measurement to the
+        # new one is folded into the exponentially weighted consumption rate.  A batch of measurements counts as one step
+        # to its latest measurement.  The rate is kept as it is when the step can not be measured (no earlier
+        # measurement, a unit that does not fit the device, or no time passed).
+        prev_ml = cls.latest_measurement * cls._ml_per_latest_measurement_unit()
+        new_ml = latest["measurement"] * case(
+            (cls.device_type == "weight", ml_per_unit("weight", latest["unit"])), else_=ml_per_unit("flow", latest["unit"])
+        )
+        # weight devices measure what is left in the keg, flow devices what was poured
+        consumed_ml = (prev_ml - new_ml) * case((cls.device_type == "weight", 1), else_=-1)
+        elapsed = cast(extract("epoch", literal(latest["taken_on"], DateTime(timezone=True)) - cls.latest_measurement_taken_on), Float)
+
+        rate = func.coalesce(cls.consumption_ml_per_hour, 0)
+        alpha = 1 - func.exp(-elapsed * (math.log(2) / (half_life_hours * 3600)))
+        updated = func.greatest(rate + alpha * (consumed_ml / elapsed * 3600 - rate), 0)
+
+        return case((and_(consumed_ml.is_not(None), elapsed > 0), updated), else_=cls.consumption_ml_per_hour)
+
+    @classmethod
+    def _pour_state_stmt(cls, pk_id):
+        # locks the device row until the end of the transaction, so concurrent requests of a device detect pours in turn.
+        # FOR NO KEY UPDATE rather than FOR UPDATE: the measurements inserted earlier in the transaction hold FOR KEY SHARE
+        # on the row (their foreign key check), which FOR UPDATE conflicts with, deadlocking two concurrent writers
+        return (
+            select(
+                cls.device_type, cls.latest_measurement, cls.latest_measurement_unit, cls.latest_measurement_taken_on, cls.pour_started_on, cls.pour_start_ml,
+            )
+            .where(cls.id == pk_id)
+            .with_for_update(key_share=True)
+        )
+
+    @staticmethod
+    def _detect_pours(pk_id, state, measurements, pour_settings):
+        # Feeds the new measurements to a detector picking up from the device's latest measurement and pour in progress.
+        # Returns the pours they ended and the pour state to store back on the device.
+        last_ml = None
+        f = ml_per_unit(state.device_type, state.latest_measurement_unit)
+        if state.latest_measurement is not None and f is not None:
+            last_ml = state.latest_measurement * f
+
+        detector = PourDetector(
+            state.device_type,
+            pour_settings,
+            last_taken_on=state.latest_measurement_taken_on if last_ml is not None else None,
+            last_ml=last_ml,
+            started_on=state.pour_started_on,
+            start_ml=state.pour_start_ml,
+        )
+
+        pours = []
+        for m in sorted(measurements, key=lambda m: m["taken_on"]):
+            pour = detector.feed(m["measurement"], m["unit"], m["taken_on"])
+            if pour is not None:
+                pours.append(pour | {"device_id": pk_id})
+
+        return pours, {"pour_started_on": detector.started_on, "pour_start_ml": detector.start_ml}
+
+    @classmethod
+    def _record_measurements_stmt(cls, pk_id, measurements, half_life_hours=DEFAULT_RATE_HALF_LIFE_HOURS, pour_state=None):
+        latest = max(measurements, key=lambda m: m["taken_on"])
+        is_newer = or_(cls.latest_measurement_taken_on.is_(None), cls.latest_measurement_taken_on <= latest["taken_on"])
+
+        return (
+            update(cls)
+            .where(cls.id == pk_id)
+            .values(
+                measurement_count=cls.measurement_count + len(measurements),
+                latest_measurement=case((is_newer, latest["measurement"]), else_=cls.latest_measurement),
+                latest_measurement_unit=case((is_newer, latest["unit"]), else_=cls.latest_measurement_unit),
+                latest_measurement_taken_on=case((is_newer, latest["taken_on"]), else_=cls.latest_measurement_taken_on),
+                consumption_ml_per_hour=case((is_newer, cls._consumption_rate(latest, half_life_hours)), else_=cls.consumption_ml_per_hour),
+                **(pour_state or {}),
+            )
+            .execution_options(synchronize_session="fetch")
+        )
+
+    @classmethod
+    def record_measurements(cls, session, pk_id, measurements, half_life_hours=DEFAULT_RATE_HALF_LIFE_HOURS, pour_settings=None, autocommit=True):
+        # Keeps the latest measurement state, measurement count and consumption rate on the device in step with the
+        # measurements inserted in the same transaction, so reading devices never has to aggregate over the measurements
+        # table.  With pour_settings, the pours the measurements end are stored too.
+        if not measurements:
+            return
+
+        pour_state = None
+        if pour_settings is not None:
+            state = session.execute(cls._pour_state_stmt(pk_id)).first()
+            if state is not None:
+                pours, pour_state = cls._detect_pours(pk_id, state, measurements, pour_settings)
+                DevicePours.create_many(session, pours, autocommit=False)
+
+        session.execute(cls._record_measurements_stmt(pk_id, measurements, half_life_hours, pour_state))
+
+        if autocommit:
+            try:
+                session.commit()
+            except:
+                session.rollback()
+                raise
+
+    @classmethod
+    async def async_record_measurements(cls, session, pk_id, measurements, half_life_hours=DEFAULT_RATE_HALF_LIFE_HOURS, pour_settings=None, autocommit=True):
+        if not measurements:
+            return
+
+        pour_state = None
+        if pour_settings is not None:
+            state = (await session.execute(cls._pour_state_stmt(pk_id))).first()
+            if state is not None:
+                pours, pour_state = cls._detect_pours(pk_id, state, measurements, pour_settings)
+                await DevicePours.async_create_many(session, pours, autocommit=False)
+
+        await session.execute(cls._record_measurements_stmt(pk_id, measurements, half_life_hours, pour_state))
+
+        if autocommit:
+            try:
+                await session.commit()
+            except:
+                await session.rollback()
+                raise
+
+    @classmethod
+    def _update_by_pkey_stmt(cls, column):
+        # A core UPDATE of `column` by id, executed with one parameter set per device.  Unlike an ORM bulk update by
+        # primary key, it does not check the matched row counts, so devices deleted in the meantime are skipped rather
+        # than failing the whole batch with a StaleDataError.
+        return update(cls.__table__).where(cls.__table__.c.id == bindparam("_id")).values({column: bindparam(column)})
+
+    @classmethod
+    def set_consumption_rates(cls, session, rates, autocommit=True):
+        # `rates` maps device ids to their consumption rate (ml per hour), ex: replayed from history by the maintenance
+        # script.  The ingest path keeps the rates up to date incrementally, see _consumption_rate.
+        if not rates:
+            return
+
+        session.execute(cls._update_by_pkey_stmt("consumption_ml_per_hour"), [{"_id": pk_id, "consumption_ml_per_hour": rate} for pk_id, rate in rates.items()])
+
+        if autocommit:
+            try:
+                session.commit()
+            except:
+                session.rollback()
+                raise
+
+    @classmethod
+    def save_filter_states(cls, session, states, autocommit=True):
+        # `states` maps device ids to the state of their measurement filter
+        if not states:
+            return
+
+        session.execute(cls._update_by_pkey_stmt("filter_state"), [{"_id": pk_id, "filter_state": state} for pk_id, state in states.items()])
+
+        if autocommit:
+            try:
+                session.commit()
+            except:
+                session.rollback()
+                raise
+
+    @classmethod
+    def stream(cls, session, columns, batch_size=5000):
+        # the given columns of every device as plain rows off a server side cursor, for exports
+        stmt = select(*[getattr(cls, col) for col in columns]).order_by(cls.id)
+
+        yield from session.execute(stmt.execution_options(yield_per=batch_size))
+
+    @classmethod
+    def forget_measurements(cls, session, counts, autocommit=True):
+        # Takes measurements removed in bulk (ex: an expired partition) off the maintained counts, `counts` being a
+        # select of (device_id, measurement_count), rather than recounting what is left with refresh_measurement_stats
+        removed = counts.subquery("removed")
+        session.execute(
+            update(cls)
+            .where(cls.id == removed.c.device_id)
+            .values(measurement_count=func.greatest(cls.measurement_count - removed.c.measurement_count, 0))
+            .execution_options(synchronize_session=False)
+        )
+
+        if autocommit:
+            try:
+                session.commit()
+            except:
+                session.rollback()
+                raise
+
+    @classmethod
+    def _build_measurement_stats_select(cls, include_count=True):
+        # One statement for any number of devices: the latest sample comes from a LEFT JOIN LATERAL (... LIMIT 1) which is
+        # an index lookup per device, rather than a query per device or a GROUP BY over the whole measurements table
+        dev = aliased(cls, name="dev")
+        latest = (
+            select(DeviceMeasurements.measurement, DeviceMeasurements.unit, DeviceMeasurements.taken_on)
+            .where(DeviceMeasurements.device_id == dev.id)
+            .order_by(DeviceMeasurements.taken_on.desc())
+            .limit(1)
+            .lateral("latest")
+        )
+        stmt = (
+            select(
+                dev.id.label("id"),
+                latest.c.measurement.label("latest_measurement"),
+                unit_name(latest.c.unit).label("latest_measurement_unit"),
+                latest.c.taken_on.label("latest_measurement_taken_on"),
+            )
+            .select_from(dev)
+            .outerjoin(latest, true())
+        )
+
+        if include_count:
+            counts = select(func.count().label("measurement_count")).where(DeviceMeasurements.device_id == dev.id).lateral("counts")
+            stmt = stmt.add_columns(counts.c.measurement_count).outerjoin(counts, true())
+
+        return stmt, dev
+
+    @classmethod
+    def refresh_measurement_stats(cls, session, pk_id=None, include_count=True, autocommit=True):
+        # Rebuilds the denormalized measurement state (see record_measurements) from the measurements table, for one
+        # device or all of them.  Used after measurements are written or removed outside of the ingest path.
+        stmt, dev = cls._build_measurement_stats_select(include_count=include_count)
+        if pk_id is not None:
+            stmt = stmt.where(dev.id == pk_id)
+        stats = stmt.subquery("stats")
+
+        values = {
+            "latest_measurement": stats.c.latest_measurement,
+            "latest_measurement_unit": stats.c.latest_measurement_unit,
+            "latest_measurement_taken_on": stats.c.latest_measurement_taken_on,
+        }
+        if include_count:
+            values["measurement_count"] = stats.c.measurement_count
+
+        session.execute(update(cls).where(cls.id == stats.c.id).values(**values).execution_options(synchronize_session=False))
+
+        if autocommit:
+            try:
+                session.commit()
+            except:
+                session.rollback()
+                raise
 
     @classmethod
     def get_by_api_key(cls, session, api_key, **kwargs):
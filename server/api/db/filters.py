@@ -0,0 +1,119 @@
+import atexit
+import threading
+from logging import getLogger
+
+from db import session_scope
+from db.devices import Devices
+from lib.filters import DeviceFilter, filter_settings
+
+LOG = getLogger(__name__)
+
+
+class MeasurementFilterBank:
+    # The noise filters (see lib.filters) of the devices measured by this process, applied to incoming measurements
+    # before they are stored.  The filters live in memory: a device's filter is restored from the state checkpointed on
+    # its row the first time the process sees the device, and the states of the filters that changed are written back
+    # every `checkpoint_interval_seconds` by a background thread, and once more when it stops.
+
+    def __init__(self, config, settings, checkpoint_interval_seconds=30, keep_raw=False):
+        self.config = config
+        self.settings = settings
+        self.checkpoint_interval = checkpoint_interval_seconds
+        self.keep_raw = keep_raw
+
+        self._filters = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="measurement-filter-checkpointer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+        self._thread = None
+        self._checkpoint()
+
+    def smooth(self, device_id, checkpointed_state, measurements):
+        # Replaces the measurement of each of the device's measurements (in place) with the filtered one, in time order.
+        # With keep_raw, the raw value is kept as raw_measurement, which DeviceMeasurements.create_many stores in the
+        # device_measurements_raw table.
+        device_id = str(device_id)
+        with self._lock:
+            _filter = self._filters.get(device_id)
+            if _filter is None:
+                _filter = self._filters[device_id] = DeviceFilter(self.settings, checkpointed_state)
+
+            for m in sorted(measurements, key=lambda m: m["taken_on"]):
+                raw = m["measurement"]
+                m["measurement"] = _filter.smooth(raw, m["unit"], m["taken_on"])
+                if self.keep_raw:
+                    m["raw_measurement"] = raw
+
+            self._dirty.add(device_id)
+
+        return measurements
+
+    def _run(self):
+        while not self._stop.wait(self.checkpoint_interval):
+            self._checkpoint()
+
+    def _checkpoint(self):
+        with self._lock:
+            states = {device_id: self._filters[device_id].state() for device_id in self._dirty}
+            self._dirty.clear()
+
+        if not states:
+            return
+
+        try:
+            with session_scope(self.config) as db_session:
+                Devices.save_filter_states(db_session, states)
+        except Exception as ex:  # pylint: disable=broad-except
+            LOG.error("Failed to checkpoint the measurement filters of %s device(s), retrying with the next checkpoint: %s", len(states), ex)
+            with self._lock:
+                self._dirty.update(states)
+            return
+
+        LOG.debug("Checkpointed the measurement filters of %s device(s)", len(states))
+
+
+filter_bank = None
+_filter_bank_lock = threading.Lock()
+
+
+def get_filter_bank(config):
+    # The process wide filter bank, started on first use.  None when measurements.filter.type is none, in which case
+    # measurements are stored as they are received.
+    global filter_bank
+
+    settings = filter_settings(config)
+    if settings is None:
+        return None
+
+    with _filter_bank_lock:
+        if filter_bank is None:
+            LOG.debug("Starting the %s measurement filters", settings.type)
+            filter_bank = MeasurementFilterBank(
+                config,
+                settings,
+                checkpoint_interval_seconds=config.get("measurements.filter.checkpoint_interval_seconds", 30),
+                keep_raw=config.get("measurements.filter.keep_raw", False),
+            )
+            filter_bank.start()
+            atexit.register(filter_bank.stop)
+
+    return filter_bank
+
+
+def stop_filter_bank():
+    if filter_bank is not None:
+        filter_bank.stop()
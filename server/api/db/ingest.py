@@ -0,0 +1,219 @@
+import atexit
+import threading
+import time
+from collections import deque
+from itertools import groupby
+from logging import getLogger
+
+from sqlalchemy.exc import IntegrityError
+
+from db import session_scope
+from db.devices import Devices
+from db.device_measurements import DeviceMeasurements
+from lib.forecast import rate_half_life_hours
+from lib.pours import pour_settings
+
+LOG = getLogger(__name__)
+
+
+class IngestQueueFull(Exception):
+    pass
+
+
+class MeasurementIngestBuffer:
+    # Write-behind buffer for measurements: request handlers enqueue validated measurements and return, and a background
+    # thread writes them in bulk (create_many + record_measurements) every `flush_interval_ms` or as soon as `flush_rows`
+    # are waiting.  The queue is bounded, enqueue raises IngestQueueFull once it holds `max_queue_size` measurements.
+
+    def __init__(self, config, flush_interval_ms=250, flush_rows=1000, max_queue_size=50000):
+        self.config = config
+        self.flush_interval = flush_interval_ms / 1000
+        self.flush_rows = flush_rows
+        self.max_queue_size = max_queue_size
+
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread = None
+
+        self._metrics_lock = threading.Lock()
+        self._metrics = {
+            "enqueued": 0,
+            "rejected": 0,
+            "flushes": 0,
+            "inserted": 0,
+            "duplicates": 0,
+            "dropped": 0,
+            "failed_flushes": 0,
+            "last_flush_rows": 0,
+            "last_flush_ms": None,
+            "max_flush_ms": None,
+            "total_flush_ms": 0.0,
+        }
+
+    def start(self):
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="measurement-ingest-flusher", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=30):
+        # flushes whatever is still queued before returning
+        with self._cond:
+            if self._thread is None:
+                return
+            self._stopping = True
+            self._cond.notify()
+            thread = self._thread
+
+        thread.join(timeout)
+        if thread.is_alive():
+            LOG.error("Measurement ingest flusher did not stop within %ss, %s queued measurements were not written", timeout, len(self._queue))
+        self._thread = None
+
+    def enqueue(self, measurements):
+        with self._cond:
+            if self._stopping:
+                raise IngestQueueFull("The measurement ingest queue is shutting down")
+
+            if len(self._queue) + len(measurements) > self.max_queue_size:
+                self._incr("rejected", len(measurements))
+                raise IngestQueueFull(f"The measurement ingest queue is full ({len(self._queue)} of {self.max_queue_size} measurements queued)")
+
+            self._queue.extend(measurements)
+            self._incr("enqueued", len(measurements))
+            if len(self._queue) >= self.flush_rows:
+                self._cond.notify()
+
+    def metrics(self):
+        with self._metrics_lock:
+            metrics = dict(self._metrics)
+
+        metrics["queue_depth"] = len(self._queue)
+        metrics["max_queue_size"] = self.max_queue_size
+        total_flush_ms = metrics.pop("total_flush_ms")
+        metrics["avg_flush_ms"] = total_flush_ms / metrics["flushes"] if metrics["flushes"] else None
+        return metrics
+
+    def _incr(self, key, value=1):
+        with self._metrics_lock:
+            self._metrics[key] += value
+
+    def _take(self):
+        with self._cond:
+            if len(self._queue) < self.flush_rows and not self._stopping:
+                self._cond.wait(self.flush_interval)
+
+            batch = []
+            while self._queue and len(batch) < self.flush_rows:
+                batch.append(self._queue.popleft())
+            return batch, self._stopping and not self._queue
+
+    def _requeue(self, batch):
+        with self._cond:
+            self._queue.extendleft(reversed(batch))
+
+    def _run(self):
+        done = False
+        while not done:
+            batch, done = self._take()
+            if not batch:
+                continue
+
+            try:
+                self._write(batch)
+            except Exception:  # pylint: disable=broad-except
+                # ex: the database is unavailable, the measurements are retried on the next flush.  Meanwhile the queue
+                # fills up and enqueue starts refusing new measurements.
+                LOG.exception("Failed to write %s queued measurements, retrying", len(batch))
+                self._incr("failed_flushes")
+                self._requeue(batch)
+                if self._stopping:
+                    LOG.error("Giving up on %s queued measurements, the ingest buffer is shutting down", len(self._queue))
+                    return
+                time.sleep(self.flush_interval)
+
+    def _write(self, batch):
+        try:
+            self._flush(batch)
+        except IntegrityError:
+            # a bad row fails the whole statement and would keep failing, ex: its device was deleted since it was queued.
+            # The batch is written again per device, and the rows of a device that still fails one by one, so that only
+            # the bad rows are dropped.  Rows already written before a later failure come back as duplicates if the
+            # batch is retried.
+            LOG.warning("Failed to write %s queued measurements, writing them per device", len(batch))
+            self._incr("failed_flushes")
+
+            batch = sorted(batch, key=lambda m: str(m["device_id"]))
+            for device_id, measurements in groupby(batch, key=lambda m: str(m["device_id"])):
+                measurements = list(measurements)
+                try:
+                    self._flush(measurements)
+                    continue
+                except IntegrityError:
+                    LOG.warning("Failed to write %s queued measurements of device %s, writing them one by one", len(measurements), device_id)
+
+                for measurement in measurements:
+                    try:
+                        self._flush([measurement])
+                    except IntegrityError:
+                        LOG.exception("Dropping a queued measurement of device %s that could not be written", device_id)
+                        self._incr("dropped")
+
+    def _flush(self, batch):
+        started = time.monotonic()
+        half_life_hours = rate_half_life_hours(self.config)
+        pours = pour_settings(self.config)
+        with session_scope(self.config) as db_session:
+            ids = DeviceMeasurements.create_many(db_session, batch, autocommit=False)
+            inserted = [m for m, _id in zip(batch, ids) if _id is not None]
+
+            inserted.sort(key=lambda m: str(m["device_id"]))
+            for device_id, measurements in groupby(inserted, key=lambda m: str(m["device_id"])):
+                Devices.record_measurements(db_session, device_id, list(measurements), half_life_hours=half_life_hours, pour_settings=pours, autocommit=False)
+        elapsed_ms = (time.monotonic() - started) * 1000
+
+        with self._metrics_lock:
+            self._metrics["flushes"] += 1
+            self._metrics["inserted"] += len(inserted)
+            self._metrics["duplicates"] += len(batch) - len(inserted)
+            self._metrics["last_flush_rows"] = len(batch)
+            self._metrics["last_flush_ms"] = elapsed_ms
+            self._metrics["max_flush_ms"] = max(self._metrics["max_flush_ms"] or 0, elapsed_ms)
+            self._metrics["total_flush_ms"] += elapsed_ms
+
+        LOG.debug("Flushed %s queued measurements (%s duplicates) in %.1fms", len(batch), len(batch) - len(inserted), elapsed_ms)
+
+
+ingest_buffer = None
+_ingest_buffer_lock = threading.Lock()
+
+
+def get_ingest_buffer(config):
+    # The process wide buffer, started on first use.  None when measurements.ingest.enabled is off, in which case
+    # measurements are written synchronously by the request handlers.
+    global ingest_buffer
+
+    if not config.get("measurements.ingest.enabled", False):
+        return None
+
+    with _ingest_buffer_lock:
+        if ingest_buffer is None:
+            LOG.debug("Starting measurement ingest buffer")
+            ingest_buffer = MeasurementIngestBuffer(
+                config,
+                flush_interval_ms=config.get("measurements.ingest.flush_interval_ms", 250),
+                flush_rows=config.get("measurements.ingest.flush_rows", 1000),
+                max_queue_size=config.get("measurements.ingest.max_queue_size", 50000),
+            )
+            ingest_buffer.start()
+            atexit.register(ingest_buffer.stop)
+
+    return ingest_buffer
+
+
+def stop_ingest_buffer():
+    if ingest_buffer is not None:
+        ingest_buffer.stop()
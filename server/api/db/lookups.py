@@ -0,0 +1,76 @@
+# Cached statements for the lookups run on (nearly) every request.
+#
+# The statements are lambda statements: sqlalchemy builds and compiles each one once, keyed on the code location of the
+# lambda, and afterwards only extracts the new bound values from the closure.  The ORM Query versions rebuild the whole
+# statement and its cache key on every call.  Where the caller only reads a few columns, plain rows are returned rather
+# than ORM entities, which also skips the identity map and attribute instrumentation.
+
+from sqlalchemy import and_, lambda_stmt, select
+
+from db.devices import Devices
+from db.service_accounts import ServiceAccount
+from db.users import Users
+
+# the columns AuthUser is built from
+USER_AUTH_COLUMNS = (
+    Users.id, Users.first_name, Users.last_name, Users.email, Users.profile_pic, Users.google_oidc_id, Users.api_key, Users.admin,
+    Users.password_hash.isnot(None).label("password_enabled"),
+)
+DEVICE_AUTH_COLUMNS = (Devices.id, Devices.name, Devices.api_key)
+SERVICE_ACCOUNT_AUTH_COLUMNS = (ServiceAccount.id, ServiceAccount.name, ServiceAccount.api_key)
+
+# the device columns the measurement handlers need to validate, filter and build measurements
+DEVICE_MEASUREMENT_COLUMNS = (Devices.id, Devices.name, Devices.device_type, Devices.filter_state)
+
+
+def _user_by_api_key(api_key):
+    return lambda_stmt(lambda: select(*USER_AUTH_COLUMNS).where(Users.api_key == api_key).limit(1))
+
+
+def _device_by_api_key(api_key):
+    return lambda_stmt(lambda: select(*DEVICE_AUTH_COLUMNS).where(Devices.api_key == api_key).limit(1))
+
+
+def _service_account_by_api_key(api_key):
+    return lambda_stmt(lambda: select(*SERVICE_ACCOUNT_AUTH_COLUMNS).where(ServiceAccount.api_key == api_key).limit(1))
+
+
+def _user_by_pkey(pkey):
+    return lambda_stmt(lambda: select(*USER_AUTH_COLUMNS).where(Users.id == pkey))
+
+
+def _device_by_pkey(pkey):
+    return lambda_stmt(lambda: select(*DEVICE_MEASUREMENT_COLUMNS).where(Devices.id == pkey))
+
+
+def _devices_by_chip_id(chip_type, chip_id):
+    return lambda_stmt(lambda: select(Devices).where(and_(Devices.chip_type.ilike(chip_type), Devices.chip_id.ilike(chip_id))))
+
+
+def user_by_api_key(session, api_key):
+    return session.execute(_user_by_api_key(api_key)).first()
+
+
+def device_by_api_key(session, api_key):
+    return session.execute(_device_by_api_key(api_key)).first()
+
+
+def service_account_by_api_key(session, api_key):
+    return session.execute(_service_account_by_api_key(api_key)).first()
+
+
+def user_by_pkey(session, pkey):
+    return session.execute(_user_by_pkey(pkey)).first()
+
+
+def device_by_pkey(session, pkey):
+    return session.execute(_device_by_pkey(pkey)).first()
+
+
+async def async_device_by_pkey(session, pkey):
+    return (await session.execute(_device_by_pkey(pkey))).first()
+
+
+def devices_by_chip_id(session, chip_type, chip_id):
+    # full ORM entities, the callers return the devices
+    return session.scalars(_devices_by_chip_id(chip_type, chip_id)).all()
@@ -0,0 +1,157 @@
+import re
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import text
+
+from lib.logging import getLogger
+
+LOG = getLogger(__name__)
+
+INTERVALS = ["day", "week", "month"]
+
+_BOUND_RE = re.compile(r"FOR VALUES FROM \('([^']+)'\) TO \('([^']+)'\)")
+
+
+def interval_start(dt, interval):
+    dt = dt.astimezone(timezone.utc)
+    if interval == "day":
+        return datetime(dt.year, dt.month, dt.day, tzinfo=timezone.utc)
+    if interval == "week":
+        return datetime(dt.year, dt.month, dt.day, tzinfo=timezone.utc) - timedelta(days=dt.weekday())
+    if interval == "month":
+        return datetime(dt.year, dt.month, 1, tzinfo=timezone.utc)
+    raise ValueError(f"invalid partition interval '{interval}', expected one of {INTERVALS}")
+
+
+def next_interval_start(dt, interval):
+    if interval == "day":
+        return dt + timedelta(days=1)
+    if interval == "week":
+        return dt + timedelta(days=7)
+    if interval == "month":
+        return dt.replace(year=dt.year + dt.month // 12, month=dt.month % 12 + 1)
+    raise ValueError(f"invalid partition interval '{interval}', expected one of {INTERVALS}")
+
+
+def partition_name(table, lower):
+    return f"{table}_p{lower:%Y%m%d}"
+
+
+def default_partition_name(table):
+    return f"{table}_default"
+
+
+def _parse_bound(val):
+    return datetime.fromisoformat(val).astimezone(timezone.utc)
+
+
+def list_partitions(session, table):
+
+    """
+    Returns the range partitions of `table` as a list of (name, lower, upper), ordered by lower, and the name of the
+    default partition (or None).
+    """
+
+    rows = session.execute(
+        text(
+            """
+            SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            JOIN pg_class p ON p.oid = i.inhparent
+            WHERE p.relname = :table
+            """
+        ),
+        {"table": table},
+    ).all()
+
+    ranges = []
+    default = None
+    for name, bound in rows:
+        if bound == "DEFAULT":
+            default = name
+            continue
+
+        match = _BOUND_RE.match(bound)
+        if not match:
+            LOG.warning("Skipping partition %s of %s, unsupported partition bound: %s", name, table, bound)
+            continue
+        ranges.append((name, _parse_bound(match.group(1)), _parse_bound(match.group(2))))
+
+    return sorted(ranges, key=lambda r: r[1]), default
+
+
+def create_partition(session, table, column, lower, upper, default=None):
+    name = partition_name(table, lower)
+    lower_str = lower.isoformat()
+    upper_str = upper.isoformat()
+
+    moved = 0
+    if default:
+        # Rows for the new range that landed in the default partition have to be moved out of it first, or postgres
+        # refuses to create the partition
+        session.execute(
+            text(f'CREATE TEMP TABLE "{name}_moved" ON COMMIT DROP AS SELECT * FROM "{default}" WHERE "{column}" >= :lower AND "{column}" < :upper'),
+            {"lower": lower, "upper": upper},
+        )
+        moved = session.execute(text(f'DELETE FROM "{default}" WHERE "{column}" >= :lower AND "{column}" < :upper'), {"lower": lower, "upper": upper}).rowcount
+
+    LOG.info("Creating partition %s of %s for [%s, %s)", name, table, lower_str, upper_str)
+    session.execute(text(f"""CREATE TABLE "{name}" PARTITION OF "{table}" FOR VALUES FROM ('{lower_str}') TO ('{upper_str}')"""))
+
+    if moved:
+        LOG.info("Moving %s rows from the default partition %s into %s", moved, default, name)
+        session.execute(text(f'INSERT INTO "{name}" SELECT * FROM "{name}_moved"'))
+
+    return name
+
+
+def ensure_partitions(session, table, column, interval, start, end, autocommit=True):
+
+    """
+    Creates the partitions of `table` needed to cover [start, end), skipping any range overlapping an existing
+    partition.  Returns the names of the created partitions.
+    """
+
+    existing, default = list_partitions(session, table)
+
+    created = []
+    lower = interval_start(start, interval)
+    while lower < end:
+        upper = next_interval_start(lower, interval)
+        if not any(lower < e_upper and e_lower < upper for _, e_lower, e_upper in existing):
+            created.append(create_partition(session, table, column, lower, upper, default=default))
+        lower = upper
+
+    if autocommit:
+        session.commit()
+
+    return created
+
+
+def expirable_partitions(session, table, cutoff):
+
+    """Returns the names of the partitions of `table` that only hold data older than `cutoff`."""
+
+    existing, _ = list_partitions(session, table)
+    return [name for name, _, upper in existing if upper <= cutoff]
+
+
+def expire_partitions(session, table, cutoff, drop=False, autocommit=True):
+
+    """
+    Detaches (and when `drop` is set, drops) every partition of `table` that only holds data older than `cutoff`.
+    Returns the names of the expired partitions.
+    """
+
+    expired = expirable_partitions(session, table, cutoff)
+    for name in expired:
+        LOG.info("%s partition %s of %s, all of its data is older than %s", "Dropping" if drop else "Detaching", name, table, cutoff.isoformat())
+        session.execute(text(f'ALTER TABLE "{table}" DETACH PARTITION "{name}"'))
+        if drop:
+            session.execute(text(f'DROP TABLE "{name}"'))
+
+    if autocommit:
+        session.commit()
+
+    return expired
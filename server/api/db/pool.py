@@ -0,0 +1,82 @@
+import threading
+import time
+from logging import getLogger
+
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+LOG = getLogger(__name__)
+
+
+def pool_kwargs(config):
+    # the create_engine pool arguments, from the db.pool.* config
+    return {
+        "pool_size": config.get("db.pool.size", 5),
+        "max_overflow": config.get("db.pool.max_overflow", 10),
+        "pool_timeout": config.get("db.pool.timeout_seconds", 30),
+        "pool_recycle": config.get("db.pool.recycle_seconds", -1),
+        "pool_pre_ping": config.get("db.pool.pre_ping", True),
+        "pool_use_lifo": config.get("db.pool.use_lifo", False),
+    }
+
+
+class InstrumentedPoolMixin:
+    # Keeps checkout statistics on top of the queue pool: how often connections are checked out, how long callers wait
+    # for one, how often they time out waiting, and how far the pool went into overflow.  A growing wait time or any
+    # timeouts mean the pool is too small for the number of request threads using it.
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "checkouts": 0,
+            "timeouts": 0,
+            "waited": 0,
+            "max_wait_ms": 0.0,
+            "total_wait_ms": 0.0,
+            "max_overflow_reached": 0,
+        }
+
+    def _do_get(self):
+        started = time.monotonic()
+        try:
+            conn = super()._do_get()
+        except PoolTimeoutError:
+            with self._stats_lock:
+                self._stats["timeouts"] += 1
+            LOG.warning("Timed out waiting for a database connection: %s", self.status())
+            raise
+
+        wait_ms = (time.monotonic() - started) * 1000
+        overflow = self.overflow()
+        with self._stats_lock:
+            self._stats["checkouts"] += 1
+            self._stats["total_wait_ms"] += wait_ms
+            self._stats["max_wait_ms"] = max(self._stats["max_wait_ms"], wait_ms)
+            # connections handed out straight from the pool take well under a millisecond
+            if wait_ms >= 1:
+                self._stats["waited"] += 1
+            self._stats["max_overflow_reached"] = max(self._stats["max_overflow_reached"], overflow)
+
+        return conn
+
+    def metrics(self):
+        with self._stats_lock:
+            metrics = dict(self._stats)
+
+        total_wait_ms = metrics.pop("total_wait_ms")
+        metrics["avg_wait_ms"] = total_wait_ms / metrics["checkouts"] if metrics["checkouts"] else None
+        metrics["size"] = self.size()
+        metrics["max_overflow"] = self._max_overflow
+        metrics["checked_out"] = self.checkedout()
+        metrics["checked_in"] = self.checkedin()
+        metrics["overflow"] = max(self.overflow(), 0)
+        return metrics
+
+
+class InstrumentedQueuePool(InstrumentedPoolMixin, QueuePool):
+    pass
+
+
+class InstrumentedAsyncAdaptedQueuePool(InstrumentedPoolMixin, AsyncAdaptedQueuePool):
+    pass
@@ -0,0 +1,155 @@
+import itertools
+import threading
+from logging import getLogger
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.orm import sessionmaker
+
+LOG = getLogger(__name__)
+
+SELECTION_STRATEGIES = ("round_robin", "least_connections")
+
+# Whether the host is a replica at all, whether its WAL receiver is streaming from the primary and how long ago it last
+# heard from it, and how far behind its replayed transactions are (0 when it replayed everything it received, ex: when
+# nothing was written on the primary for a while and the last replayed transaction is old).  Reading the WAL receiver
+# status needs the privileges of pg_read_all_stats (ex: the pg_monitor role), it reads as not streaming otherwise.
+_REPLICATION_SQL = text(
+    "SELECT pg_is_in_recovery() AS in_recovery, "
+    "(SELECT status FROM pg_stat_wal_receiver) AS receiver_status, "
+    "(SELECT EXTRACT(EPOCH FROM now() - last_msg_receipt_time) FROM pg_stat_wal_receiver) AS receipt_age, "
+    "CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END AS replay_lag"
+)
+
+
+def replication_lag(row):
+    # The replica's lag in seconds, from a _REPLICATION_SQL row: how far behind its replay is, or how long since it last
+    # heard from the primary, whichever is larger.  Raises ValueError when the host is not replicating, ex: it is a
+    # primary or its WAL receiver disconnected, in which case it would only ever fall further behind.
+    if not row.in_recovery:
+        raise ValueError("not a replica, the host is not in recovery")
+    if row.receiver_status != "streaming" or row.receipt_age is None:
+        raise ValueError(f"the WAL receiver is not streaming from the primary (status: {row.receiver_status})")
+    return max(float(row.replay_lag or 0), float(row.receipt_age))
+
+
+class Replica:
+    # A read replica with its own engines.  It is only handed out once a health check has found it reachable and
+    # replicating within the allowed lag.
+
+    def __init__(self, host, engine, async_engine_factory):
+        self.host = host
+        self.engine = engine
+        self.session_factory = sessionmaker(bind=engine)
+        self._async_engine_factory = async_engine_factory
+        self._async_engine = None
+        self._async_session_factory = None
+        self._lock = threading.Lock()
+
+        self.healthy = False
+        self.lag_seconds = None
+        self.error = None
+
+    @property
+    def async_engine(self):
+        with self._lock:
+            if self._async_engine is None:
+                self._async_engine = self._async_engine_factory()
+            return self._async_engine
+
+    @property
+    def async_session_factory(self):
+        if self._async_session_factory is None:
+            self._async_session_factory = async_sessionmaker(bind=self.async_engine, expire_on_commit=False)
+        return self._async_session_factory
+
+    async def dispose_async_engine(self):
+        if self._async_engine is not None:
+            await self._async_engine.dispose()
+            self._async_engine = None
+            self._async_session_factory = None
+
+    def check(self, max_lag_seconds):
+        try:
+            with self.engine.connect() as conn:
+                lag = replication_lag(conn.execute(_REPLICATION_SQL).one())
+        except Exception as ex:  # pylint: disable=broad-except
+            if self.healthy or self.error is None:
+                LOG.warning("Read replica %s is unavailable, reads fall back to the primary: %s", self.host, ex)
+            self.healthy = False
+            self.error = str(ex)
+            return
+
+        healthy = lag <= max_lag_seconds
+        if healthy != self.healthy:
+            if healthy:
+                LOG.info("Read replica %s is available, %.1fs behind the primary", self.host, lag)
+            else:
+                LOG.warning("Read replica %s is %.1fs behind the primary (max %ss), reads fall back to the primary", self.host, lag, max_lag_seconds)
+
+        self.lag_seconds = lag
+        self.error = None
+        self.healthy = healthy
+
+    def metrics(self):
+        metrics = {"host": self.host, "healthy": self.healthy, "lag_seconds": self.lag_seconds, "error": self.error, "pool": self.engine.pool.metrics()}
+        if self._async_engine is not None:
+            metrics["async_pool"] = self._async_engine.pool.metrics()
+        return metrics
+
+
+class ReplicaSet:
+    # Picks the replica for read only sessions, round robin or the one with the fewest checked out connections, out of
+    # the healthy ones.  A background thread re-checks every replica's health and lag every `check_interval_seconds`.
+
+    def __init__(self, replicas, selection="round_robin", max_lag_seconds=30, check_interval_seconds=10):
+        if selection not in SELECTION_STRATEGIES:
+            raise ValueError(f"Invalid replica selection '{selection}', expected one of: {', '.join(SELECTION_STRATEGIES)}")
+
+        self.replicas = replicas
+        self.selection = selection
+        self.max_lag_seconds = max_lag_seconds
+        self.check_interval = check_interval_seconds
+
+        self._counter = itertools.count()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="read-replica-monitor", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def check(self):
+        for replica in self.replicas:
+            replica.check(self.max_lag_seconds)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.check()
+            self._stop.wait(self.check_interval)
+
+    def choose(self, use_async=False):
+        # None when no replica is healthy, the primary has to be used then
+        healthy = [r for r in self.replicas if r.healthy]
+        if not healthy:
+            return None
+
+        if self.selection == "least_connections":
+            pool = lambda r: (r.async_engine if use_async else r.engine).pool
+            return min(healthy, key=lambda r: pool(r).checkedout())
+
+        return healthy[next(self._counter) % len(healthy)]
+
+    def metrics(self):
+        return [r.metrics() for r in self.replicas]
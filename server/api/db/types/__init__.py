@@ -1 +1 @@
-from . import nested
+from . import nested, units
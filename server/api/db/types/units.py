@@ -0,0 +1,31 @@
+from sqlalchemy import String, case, cast, type_coerce
+from sqlalchemy.types import SmallInteger, TypeDecorator
+
+from lib.units import UNIT_CODES, UNIT_NAMES, normalize_unit
+
+__all__ = ["UnitCode", "unit_name"]
+
+
+class UnitCode(TypeDecorator):
+    # A measurement unit stored as the smallint code of lib.units.UNIT_CODES rather than as text, the python side
+    # still reads and writes the unit names
+
+    impl = SmallInteger
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+
+        return UNIT_CODES[normalize_unit(value)]
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+
+        return UNIT_NAMES.get(value)
+
+
+def unit_name(col):
+    # the unit name of a UnitCode column in SQL, for when the value is copied into a text column within the database
+    return cast(case(UNIT_NAMES, value=type_coerce(col, SmallInteger)), String)
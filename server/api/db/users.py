@@ -2,7 +2,6 @@
 _TABLE_NAME = "users"
 _PKEY = "id"
 
-from argon2 import PasswordHasher
 from psycopg2.errors import UniqueViolation  # pylint: disable=no-name-in-module
 from sqlalchemy import Column, String, func, Boolean
 from sqlalchemy.dialects.postgresql import JSONB, UUID
@@ -52,20 +51,6 @@ class Users(Base, DictifiableMixin, QueryMethodsMixin):
 
         return res[0]
 
-    @classmethod
-    def update(cls, session, pkey, password=None, **kwargs):  # pylint: disable=arguments-differ
-        if password and not kwargs.get("password_hash"):
-            ph = PasswordHasher()
-            kwargs["password_hash"] = ph.hash(password)
-        return super().update(session, pkey, **kwargs)
-
-    @classmethod
-    def create(cls, session, password=None, **kwargs):
-        if password and not kwargs.get("password_hash"):
-            ph = PasswordHasher()
-            kwargs["password_hash"] = ph.hash(password)
-        return super().create(session, **kwargs)
-
     @classmethod
     def disable_password(cls, session, pkey):
         return super().update(session, pkey, password_hash=None)
\ No newline at end of file
@@ -0,0 +1,122 @@
+"""Partition device_measurements by taken_on
+
+Revision ID: 9b3e5f7a1c28
+Revises: 2f6a8d0c51e7
+Create Date: 2026-10-18 11:40:20.117385+00:00
+
+"""
+from datetime import datetime, timezone
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9b3e5f7a1c28'
+down_revision = '2f6a8d0c51e7'
+branch_labels = None
+depends_on = None
+
+# number of monthly partitions to create ahead of the current month.  After this, maintenance.py keeps them topped up
+PREMAKE_MONTHS = 3
+
+
+def _next_month(dt):
+    return dt.replace(year=dt.year + dt.month // 12, month=dt.month % 12 + 1)
+
+
+def _create_indexes():
+    op.create_index('ix_device_measurements_by_device_id', 'device_measurements', ['device_id'], unique=False)
+    op.create_index(
+        'ix_ordered_device_measurements_by_device_id_and_measure',
+        'device_measurements',
+        ['device_id', 'measurement', sa.literal_column('taken_on DESC')],
+        unique=False,
+    )
+    op.create_index(
+        'ix_device_measurements_by_device_id_taken_on_id', 'device_measurements', ['device_id', sa.literal_column('taken_on DESC'), 'id'], unique=False,
+    )
+
+
+def _drop_indexes(table):
+    op.drop_index('ix_device_measurements_by_device_id_taken_on_id', table_name=table)
+    op.drop_index('ix_ordered_device_measurements_by_device_id_and_measure', table_name=table)
+    op.drop_index('ix_device_measurements_by_device_id', table_name=table)
+
+
+def upgrade():
+    op.rename_table('device_measurements', 'device_measurements_unpartitioned')
+    op.execute('ALTER TABLE device_measurements_unpartitioned RENAME CONSTRAINT device_measurements_pkey TO device_measurements_unpartitioned_pkey')
+    op.execute(
+        'ALTER TABLE device_measurements_unpartitioned RENAME CONSTRAINT device_measurements_device_id_fkey TO device_measurements_unpartitioned_device_id_fkey'
+    )
+    _drop_indexes('device_measurements_unpartitioned')
+
+    op.create_table('device_measurements',
+    sa.Column('id', sa.UUID(), server_default=sa.text('uuid_generate_v4()'), nullable=False),
+    sa.Column('device_id', sa.UUID(), nullable=False),
+    sa.Column('measurement', sa.Float(), nullable=False),
+    sa.Column('unit', sa.String(), nullable=False),
+    sa.Column('taken_on', sa.DateTime(timezone=True), nullable=False),
+    sa.ForeignKeyConstraint(['device_id'], ['devices.id'], ),
+    sa.PrimaryKeyConstraint('id', 'taken_on'),
+    postgresql_partition_by='RANGE (taken_on)'
+    )
+    _create_indexes()
+
+    # monthly partitions covering everything from the oldest measurement through a few months from now, with a default
+    # partition to catch any samples with timestamps outside of that (ex: a device with an unset clock)
+    conn = op.get_bind()
+    now = datetime.now(timezone.utc)
+    oldest = conn.execute(sa.text('SELECT min(taken_on) FROM device_measurements_unpartitioned')).scalar() or now
+    oldest = oldest.astimezone(timezone.utc)
+    lower = datetime(oldest.year, oldest.month, 1, tzinfo=timezone.utc)
+    end = datetime(now.year, now.month, 1, tzinfo=timezone.utc)
+    for _ in range(PREMAKE_MONTHS + 1):
+        end = _next_month(end)
+
+    while lower < end:
+        upper = _next_month(lower)
+        op.execute(
+            f"CREATE TABLE device_measurements_p{lower:%Y%m%d} PARTITION OF device_measurements "
+            f"FOR VALUES FROM ('{lower.isoformat()}') TO ('{upper.isoformat()}')"
+        )
+        lower = upper
+    op.execute('CREATE TABLE device_measurements_default PARTITION OF device_measurements DEFAULT')
+
+    op.execute(
+        """
+        INSERT INTO device_measurements (id, device_id, measurement, unit, taken_on)
+        SELECT id, device_id, measurement, unit, taken_on FROM device_measurements_unpartitioned
+        """
+    )
+    op.drop_table('device_measurements_unpartitioned')
+
+
+def downgrade():
+    op.rename_table('device_measurements', 'device_measurements_partitioned')
+    _drop_indexes('device_measurements_partitioned')
+    op.execute('ALTER TABLE device_measurements_partitioned RENAME CONSTRAINT device_measurements_pkey TO device_measurements_partitioned_pkey')
+    op.execute(
+        'ALTER TABLE device_measurements_partitioned RENAME CONSTRAINT device_measurements_device_id_fkey TO device_measurements_partitioned_device_id_fkey'
+    )
+
+    op.create_table('device_measurements',
+    sa.Column('id', sa.UUID(), server_default=sa.text('uuid_generate_v4()'), nullable=False),
+    sa.Column('device_id', sa.UUID(), nullable=False),
+    sa.Column('measurement', sa.Float(), nullable=False),
+    sa.Column('unit', sa.String(), nullable=False),
+    sa.Column('taken_on', sa.DateTime(timezone=True), nullable=False),
+    sa.ForeignKeyConstraint(['device_id'], ['devices.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    _create_indexes()
+
+    op.execute(
+        """
+        INSERT INTO device_measurements (id, device_id, measurement, unit, taken_on)
+        SELECT id, device_id, measurement, unit, taken_on FROM device_measurements_partitioned
+        """
+    )
+    # dropping the partitioned table drops all of its partitions with it
+    op.drop_table('device_measurements_partitioned')
@@ -0,0 +1,163 @@
+"""Store device measurements with sequential bigint ids and smallint unit codes
+
+Revision ID: b7c41e9d2a05
+Revises: 6e2b9d4f8a13
+Create Date: 2026-10-18 17:12:04.318520+00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7c41e9d2a05'
+down_revision = '6e2b9d4f8a13'
+branch_labels = None
+depends_on = None
+
+ROLLUP_TABLES = ['device_measurements_hourly', 'device_measurements_daily']
+
+# lib.units.UNIT_CODES as of this revision
+UNIT_CODES = {
+    'g': 1,
+    'oz': 2,
+    'lb': 3,
+    'ml': 10,
+    'l': 11,
+    'gal': 12,
+    'gal (imperial)': 13,
+    'pt': 14,
+    'p (imperial)': 15,
+    'qt': 16,
+    'qt (imperial)': 17,
+    'cup': 18,
+    'cup (imperial)': 19,
+    'oz (imperial)': 20,
+}
+
+_UNIT_TO_CODE = 'CASE lower(btrim(unit)) ' + ' '.join(f"WHEN '{unit}' THEN {code}" for unit, code in UNIT_CODES.items()) + ' END'
+_CODE_TO_UNIT = 'CASE unit ' + ' '.join(f"WHEN {code} THEN '{unit}'" for unit, code in UNIT_CODES.items()) + ' END'
+
+
+def _check_units(conn):
+    # units outside of UNIT_CODES can not be stored as a code, they have to be fixed (or the rows removed) first
+    for table in ['device_measurements'] + ROLLUP_TABLES:
+        unknown = conn.execute(sa.text(f'SELECT DISTINCT unit FROM {table} WHERE ({_UNIT_TO_CODE}) IS NULL')).scalars().all()
+        if unknown:
+            raise RuntimeError(f"{table} has measurements with unsupported units: {', '.join(repr(u) for u in unknown)}")
+
+
+def _set_aside(conn, table):
+    # Renames the table and its partitions out of the way, and drops its constraints and indexes so the new table can
+    # reuse their names.  Returns the (name, partition bound) of the partitions, to create them again on the new table.
+    partitions = conn.execute(sa.text(
+        """
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = :table
+        """
+    ), {'table': table}).all()
+
+    op.rename_table(table, f'{table}_old')
+    op.drop_index('ix_device_measurements_by_device_id_taken_on_id', table_name=f'{table}_old')
+    op.drop_index('ix_ordered_device_measurements_by_device_id_and_measure', table_name=f'{table}_old')
+    op.drop_index('ix_device_measurements_by_device_id', table_name=f'{table}_old')
+    op.drop_constraint('uq_device_measurements_device_id_taken_on', f'{table}_old', type_='unique')
+    op.drop_constraint('device_measurements_pkey', f'{table}_old', type_='primary')
+    op.drop_constraint('device_measurements_device_id_fkey', f'{table}_old', type_='foreignkey')
+
+    for name, _ in partitions:
+        op.rename_table(name, f'{name}_old')
+
+    return partitions
+
+
+def _create_table(id_column, unit_column, partitions):
+    op.create_table('device_measurements',
+    id_column,
+    sa.Column('device_id', postgresql.UUID(), nullable=False),
+    sa.Column('measurement', sa.Float(), nullable=False),
+    unit_column,
+    sa.Column('taken_on', sa.DateTime(timezone=True), nullable=False),
+    postgresql_partition_by='RANGE (taken_on)'
+    )
+
+    # the same partitions as the old table had
+    for name, bound in partitions:
+        op.execute(f'CREATE TABLE {name} PARTITION OF device_measurements {bound}')
+
+
+def _create_constraints_and_indexes():
+    # created after the rows are copied, building them once is much faster than maintaining them row by row
+    op.create_primary_key('device_measurements_pkey', 'device_measurements', ['id', 'taken_on'])
+    op.create_foreign_key('device_measurements_device_id_fkey', 'device_measurements', 'devices', ['device_id'], ['id'])
+    op.create_unique_constraint('uq_device_measurements_device_id_taken_on', 'device_measurements', ['device_id', 'taken_on'])
+    op.create_index('ix_device_measurements_by_device_id', 'device_measurements', ['device_id'], unique=False)
+    op.create_index(
+        'ix_ordered_device_measurements_by_device_id_and_measure',
+        'device_measurements',
+        ['device_id', 'measurement', sa.literal_column('taken_on DESC')],
+        unique=False,
+    )
+    op.create_index(
+        'ix_device_measurements_by_device_id_taken_on_id', 'device_measurements', ['device_id', sa.literal_column('taken_on DESC'), 'id'], unique=False,
+    )
+
+
+def upgrade():
+    conn = op.get_bind()
+    _check_units(conn)
+
+    partitions = _set_aside(conn, 'device_measurements')
+
+    op.execute('CREATE SEQUENCE device_measurements_id_seq AS bigint')
+    _create_table(
+        sa.Column('id', sa.BigInteger(), server_default=sa.text("nextval('device_measurements_id_seq')"), nullable=False),
+        sa.Column('unit', sa.SmallInteger(), nullable=False),
+        partitions,
+    )
+    op.execute('ALTER SEQUENCE device_measurements_id_seq OWNED BY device_measurements.id')
+
+    # rows are copied in time order, so the new ids follow the order the samples were taken in
+    op.execute(
+        f"""
+        INSERT INTO device_measurements (device_id, measurement, unit, taken_on)
+        SELECT device_id, measurement, {_UNIT_TO_CODE}, taken_on FROM device_measurements_old ORDER BY taken_on, id
+        """
+    )
+    # dropping the partitioned table drops all of its partitions with it
+    op.drop_table('device_measurements_old')
+    _create_constraints_and_indexes()
+
+    for table in ROLLUP_TABLES:
+        op.execute(f'ALTER TABLE {table} ALTER COLUMN unit TYPE smallint USING {_UNIT_TO_CODE}')
+
+    op.execute('ANALYZE device_measurements')
+
+
+def downgrade():
+    conn = op.get_bind()
+
+    for table in ROLLUP_TABLES:
+        op.execute(f'ALTER TABLE {table} ALTER COLUMN unit TYPE varchar USING {_CODE_TO_UNIT}')
+
+    partitions = _set_aside(conn, 'device_measurements')
+
+    # the original measurement ids are gone, the rows get new random ones
+    _create_table(
+        sa.Column('id', postgresql.UUID(), server_default=sa.text('uuid_generate_v4()'), nullable=False),
+        sa.Column('unit', sa.String(), nullable=False),
+        partitions,
+    )
+    op.execute(
+        f"""
+        INSERT INTO device_measurements (device_id, measurement, unit, taken_on)
+        SELECT device_id, measurement, {_CODE_TO_UNIT}, taken_on FROM device_measurements_old
+        """
+    )
+    # also drops the id sequence, which is owned by the old table's id column
+    op.drop_table('device_measurements_old')
+    _create_constraints_and_indexes()
@@ -0,0 +1,78 @@
+import asyncio
+import threading
+
+from lib import logging
+
+LOG = logging.getLogger(__name__)
+
+_loop = None
+_thread = None
+_lock = threading.Lock()
+
+
+def get_background_loop():
+
+    """
+    Returns the process wide event loop running in a background thread, starting it on first use.
+
+    Flask runs each async view on its own short lived event loop, so anything bound to a loop for longer than a request
+    (ex: an asyncpg connection pool) has to live on this one instead.
+    """
+
+    global _loop, _thread
+
+    with _lock:
+        if _loop is None:
+            LOG.debug("Starting background event loop")
+            _loop = asyncio.new_event_loop()
+            _thread = threading.Thread(target=_loop.run_forever, name="background-event-loop", daemon=True)
+            _thread.start()
+
+    return _loop
+
+
+async def run_on_background_loop(coro):
+
+    """Awaits `coro` on the background event loop, from any other event loop."""
+
+    loop = get_background_loop()
+    try:
+        if asyncio.get_running_loop() is loop:
+            return await coro
+    except RuntimeError:
+        pass
+
+    return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, loop))
+
+
+def run_sync_on_background_loop(coro, timeout=None):
+
+    """Runs `coro` on the background event loop and blocks the calling (non event loop) thread until it is done."""
+
+    return asyncio.run_coroutine_threadsafe(coro, get_background_loop()).result(timeout)
+
+
+def stop_background_loop(cleanup=None, timeout=30):
+
+    """Stops the background event loop, after awaiting the `cleanup` coroutine on it when given."""
+
+    global _loop, _thread
+
+    with _lock:
+        loop, thread = _loop, _thread
+        _loop = _thread = None
+
+    if loop is None:
+        if cleanup is not None:
+            cleanup.close()
+        return
+
+    if cleanup is not None:
+        try:
+            asyncio.run_coroutine_threadsafe(cleanup, loop).result(timeout)
+        except Exception:  # pylint: disable=broad-except
+            LOG.exception("Error cleaning up the background event loop")
+
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(timeout)
+    loop.close()
@@ -0,0 +1,72 @@
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache:
+
+    """
+    A thread safe cache of at most `max_size` entries (the least recently used is evicted first), each expiring
+    `ttl_seconds` after it was set, unless set with a ttl of its own.  None is a value like any other, so misses can be
+    cached too: get() returns `default` only when there is no live entry for the key.
+    """
+
+    def __init__(self, max_size=1024, ttl_seconds=60, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, key, default=None):
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is _MISSING:
+                return default
+
+            expires_at, value = entry
+            if expires_at <= now:
+                del self._entries[key]
+                return default
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl_seconds=None):
+        if ttl_seconds is None:
+            ttl_seconds = self.ttl_seconds
+
+        expires_at = self.clock() + ttl_seconds
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def discard(self, predicate):
+
+        """
+        Removes the entries whose value matches `predicate`, returns how many were removed.
+        """
+
+        with self._lock:
+            keys = [key for key, (_, value) in self._entries.items() if predicate(value)]
+            for key in keys:
+                del self._entries[key]
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -40,6 +40,14 @@ def to_int(val, *_):
     return int(val)
 
 
+@value_converter
+def to_float(val, *_):
+    if isinstance(val, float):
+        return val
+
+    return float(val)
+
+
 @value_converter
 def to_bool(val, *_):
     if isinstance(val, bool):
@@ -86,7 +94,7 @@ class Config(metaclass=ThreadSafeSingleton):
     default_schema = {"db.port": "int", "logging.levels": "dict"}
 
     key_aliases = {"APP_ID": ["keg-volume-monitor"]}
-    type_conversions = {"int": to_int, "bool": to_bool, "list": to_list, "dict": to_dict}
+    type_conversions = {"int": to_int, "float": to_float, "bool": to_bool, "list": to_list, "dict": to_dict}
 
     def __init__(self, **kwargs):
         self.logger = logging.getLogger("config")
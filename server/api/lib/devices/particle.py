@@ -1,8 +1,6 @@
-from lib import logging
+from lib import http, logging
 from lib.config import Config
 
-import aiohttp
-
 CONFIG = Config()
 
 LOG = logging.getLogger(__name__)
@@ -11,6 +9,9 @@ DEFAULT_ERROR_STATUS_CODE = 424
 
 BASE_URL = CONFIG.get("particle.base_url", "https://api.particle.io")
 
+# the config prefix of the particle cloud's shared client session settings, see lib.http
+HTTP_CLIENT = "particle.http"
+
 PARTICLE_CLOUD_FN = {
     "startCalibration": {
         "errors": {}
@@ -88,22 +89,24 @@ def _req(fn):
 
 @_req
 async def _get(device_chip_id, uri, **kwargs):
-    async with aiohttp.ClientSession() as session:
-        async with session.get(uri, **kwargs) as response:
-            return response.status, await response.json()
+    return await http.request_json("GET", uri, client=HTTP_CLIENT, **kwargs)
 
 
 @_req
 async def _post(device_chip_id, uri, **kwargs):
-    async with aiohttp.ClientSession() as session:
-        async with session.post(uri, **kwargs) as response:
-            return response.status, await response.json()
+    return await http.request_json("POST", uri, client=HTTP_CLIENT, **kwargs)
 
 
 def _enabled():
     return CONFIG.get("particle.device_services.enabled", False)
 
 
+def start_client():
+    # opens the particle cloud's client session at startup rather than on the first call
+    if _enabled():
+        http.start_http_session(HTTP_CLIENT)
+
+
 def _particle_func(fn):
     def wrapper(*args, **kwargs):
         enabled = _enabled()
@@ -122,8 +125,8 @@ async def ping(device_chip_id):
     try:
         resp_code, data = await _post(device_chip_id, "/ping")
         return data.get("online", False)
-    except Exception as ex:
-        print(ex)
+    except Exception:
+        LOG.exception(f"Unable to ping Particle device {device_chip_id}")
         return False
 
 
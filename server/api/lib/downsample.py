@@ -0,0 +1,44 @@
+def lttb(xs, ys, threshold):
+
+    """
+    Downsamples a series with the Largest-Triangle-Three-Buckets algorithm, keeping the visual shape of the
+    series within `threshold` points.  `xs` must be sorted ascending.
+
+    Returns the indexes of the points to keep, always including the first and last point.
+    """
+
+    n = len(xs)
+    if threshold >= n or threshold < 3:
+        return list(range(n))
+
+    every = (n - 2) / (threshold - 2)
+
+    a = 0
+    sampled = [a]
+    for i in range(threshold - 2):
+        # average point of the next bucket, used as the third vertex of the triangle
+        avg_start = int((i + 1) * every) + 1
+        avg_end = min(int((i + 2) * every) + 1, n)
+        avg_len = avg_end - avg_start
+        avg_x = sum(xs[avg_start:avg_end]) / avg_len
+        avg_y = sum(ys[avg_start:avg_end]) / avg_len
+
+        range_start = int(i * every) + 1
+        range_end = int((i + 1) * every) + 1
+
+        a_x = xs[a]
+        a_y = ys[a]
+
+        max_area = -1
+        next_a = range_start
+        for j in range(range_start, range_end):
+            area = abs((a_x - avg_x) * (ys[j] - a_y) - (a_x - xs[j]) * (avg_y - a_y))
+            if area > max_area:
+                max_area = area
+                next_a = j
+
+        sampled.append(next_a)
+        a = next_a
+
+    sampled.append(n - 1)
+    return sampled
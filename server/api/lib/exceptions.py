@@ -35,3 +35,19 @@ class ItemAlreadyExists(Error):
 
         super().__init__(message)
 
+
+
+class InvalidBearerToken(Error):
+    def __init__(self, message=None):
+        if not message:
+            message = "Invalid Bearer token format"
+
+        super().__init__(message)
+
+
+class PasswordHasherBusy(Error):
+    def __init__(self, message=None):
+        if not message:
+            message = "Too many password checks in progress, try again shortly"
+
+        super().__init__(message)
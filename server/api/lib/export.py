@@ -0,0 +1,224 @@
+import csv
+import io
+import os
+from datetime import datetime, timezone
+from itertools import groupby
+from uuid import UUID
+
+from lib import json
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover - pyarrow is only needed for the columnar exports
+    pa = None
+    pq = None
+
+FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+COLUMNAR_FORMATS = {
+    "parquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+
+
+def _export_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, UUID):
+        return str(value)
+    return value
+
+
+def encode_rows(rows, columns, fmt, chunk_bytes=65536):
+
+    """
+    Encodes an iterable of row tuples as NDJSON or CSV (with a header row), `columns` being the names of the row's
+    values.  Yields utf-8 encoded chunks of roughly `chunk_bytes`, so only one chunk is ever held in memory.
+    """
+
+    if fmt not in FORMATS:
+        raise ValueError(f"Unsupported export format '{fmt}', expected one of: {', '.join(FORMATS)}")
+
+    buf = io.StringIO()
+    if fmt == "csv":
+        writer = csv.writer(buf, lineterminator="\n")
+        writer.writerow(columns)
+        write = lambda row: writer.writerow([_export_value(v) for v in row])
+    else:
+        write = lambda row: buf.write(json.dumps({col: _export_value(v) for col, v in zip(columns, row)}) + "\n")
+
+    for row in rows:
+        write(row)
+        if buf.tell() >= chunk_bytes:
+            yield buf.getvalue().encode("utf-8")
+            buf.seek(0)
+            buf.truncate()
+
+    if buf.tell():
+        yield buf.getvalue().encode("utf-8")
+
+
+def require_pyarrow():
+    if pa is None:
+        raise RuntimeError("pyarrow is required for the parquet and arrow exports, install it with: poetry install --extras exports")
+
+
+def measurement_schema(include_device_id=True):
+
+    """The arrow schema of the (id, device_id, measurement, unit, taken_on) rows of DeviceMeasurements.stream."""
+
+    fields = [pa.field("id", pa.int64(), nullable=False)]
+    if include_device_id:
+        fields.append(pa.field("device_id", pa.string(), nullable=False))
+    fields += [
+        pa.field("measurement", pa.float32(), nullable=False),
+        pa.field("unit", pa.string(), nullable=False),
+        pa.field("taken_on", pa.timestamp("ms", tz="UTC"), nullable=False),
+    ]
+    return pa.schema(fields)
+
+
+def device_schema():
+
+    """The arrow schema of the devices export, the field names being the Devices columns to select."""
+
+    return pa.schema(
+        [
+            pa.field("id", pa.string(), nullable=False),
+            pa.field("name", pa.string()),
+            pa.field("device_type", pa.string()),
+            pa.field("chip_type", pa.string()),
+            pa.field("chip_id", pa.string()),
+            pa.field("chip_model", pa.string()),
+            pa.field("state", pa.int32()),
+            pa.field("start_volume", pa.float32()),
+            pa.field("start_volume_unit", pa.string()),
+            pa.field("display_volume_unit", pa.string()),
+            pa.field("empty_keg_weight", pa.float32()),
+            pa.field("empty_keg_weight_unit", pa.string()),
+            pa.field("latest_measurement", pa.float32()),
+            pa.field("latest_measurement_unit", pa.string()),
+            pa.field("latest_measurement_taken_on", pa.timestamp("ms", tz="UTC")),
+            pa.field("measurement_count", pa.int64()),
+        ]
+    )
+
+
+def record_batches(rows, schema, batch_size=65536):
+
+    """Transposes an iterable of row tuples, in the order of the `schema` fields, into arrow record batches of `batch_size` rows."""
+
+    columns = [[] for _ in schema]
+    for row in rows:
+        for col, value in zip(columns, row):
+            col.append(str(value) if isinstance(value, UUID) else value)
+
+        if len(columns[0]) >= batch_size:
+            yield pa.RecordBatch.from_arrays([pa.array(col, type=field.type) for col, field in zip(columns, schema)], schema=schema)
+            columns = [[] for _ in schema]
+
+    if columns[0]:
+        yield pa.RecordBatch.from_arrays([pa.array(col, type=field.type) for col, field in zip(columns, schema)], schema=schema)
+
+
+def _open_columnar_writer(sink, schema, fmt):
+    if fmt == "parquet":
+        return pq.ParquetWriter(sink, schema, compression="zstd")
+
+    if fmt == "arrow":
+        return pa.ipc.new_stream(sink, schema)
+
+    raise ValueError(f"Unsupported columnar format '{fmt}', expected one of: {', '.join(COLUMNAR_FORMATS)}")
+
+
+class _ChunkSink(io.RawIOBase):
+    # a write only file object that hands back whatever was written to it since the last drain
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._pos = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        self._pos += len(b)
+        return len(b)
+
+    def tell(self):
+        return self._pos
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def encode_columnar(rows, schema, fmt, batch_size=65536):
+
+    """
+    Encodes an iterable of row tuples as a parquet file or an arrow IPC stream.  Yields the encoded bytes one record
+    batch (a parquet row group) at a time, so only one batch is ever held in memory.
+    """
+
+    require_pyarrow()
+
+    sink = _ChunkSink()
+    writer = _open_columnar_writer(sink, schema, fmt)
+    for batch in record_batches(rows, schema, batch_size):
+        writer.write_batch(batch)
+        chunk = sink.drain()
+        if chunk:
+            yield chunk
+
+    writer.close()
+    chunk = sink.drain()
+    if chunk:
+        yield chunk
+
+
+def write_partitioned_measurements(rows, out_dir, batch_size=65536):
+
+    """
+    Writes the (id, device_id, measurement, unit, taken_on) rows of DeviceMeasurements.stream, ordered by device and
+    time, as a hive partitioned parquet dataset: <out_dir>/device_id=<id>/month=<YYYY-MM>/part-0.parquet.  Returns the
+    paths of the written files.
+    """
+
+    require_pyarrow()
+
+    schema = measurement_schema(include_device_id=False)
+    partition_key = lambda row: (str(row[1]), row[4].astimezone(timezone.utc).strftime("%Y-%m"))
+
+    paths = []
+    for (device_id, month), group in groupby(rows, key=partition_key):
+        path = os.path.join(out_dir, f"device_id={device_id}", f"month={month}", "part-0.parquet")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        writer = _open_columnar_writer(path, schema, "parquet")
+        for batch in record_batches((row[:1] + row[2:] for row in group), schema, batch_size):
+            writer.write_batch(batch)
+        writer.close()
+        paths.append(path)
+
+    return paths
+
+
+def write_columnar_file(rows, schema, path, fmt="parquet", batch_size=65536):
+
+    """Writes an iterable of row tuples to a single parquet or arrow IPC file."""
+
+    require_pyarrow()
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "wb") as f:
+        for chunk in encode_columnar(rows, schema, fmt, batch_size):
+            f.write(chunk)
+
+    return path
@@ -0,0 +1,143 @@
+import statistics
+from collections import namedtuple
+
+from lib.time import parse_iso8601_utc
+
+FILTER_TYPES = ("none", "median", "kalman")
+
+FilterSettings = namedtuple("FilterSettings", ["type", "median_window", "kalman_process_noise", "kalman_measurement_noise"])
+
+DEFAULT_FILTER_SETTINGS = FilterSettings(type="none", median_window=5, kalman_process_noise=1, kalman_measurement_noise=5)
+
+
+def filter_settings(config):
+
+    """
+    The measurements.filter.* settings, None when incoming measurements are stored as they are.
+    """
+
+    _type = config.get("measurements.filter.type", DEFAULT_FILTER_SETTINGS.type)
+    if _type not in FILTER_TYPES:
+        raise ValueError(f"Invalid measurement filter type '{_type}', expected one of: {', '.join(FILTER_TYPES)}")
+
+    if _type == "none":
+        return None
+
+    return FilterSettings(
+        type=_type,
+        median_window=config.get("measurements.filter.median_window", DEFAULT_FILTER_SETTINGS.median_window),
+        kalman_process_noise=config.get("measurements.filter.kalman.process_noise", DEFAULT_FILTER_SETTINGS.kalman_process_noise),
+        kalman_measurement_noise=config.get("measurements.filter.kalman.measurement_noise", DEFAULT_FILTER_SETTINGS.kalman_measurement_noise),
+    )
+
+
+class MedianFilter:
+
+    """
+    The median of the last `window` samples.  Jitter is removed while steps (ex: a pour) pass through whole, half a
+    window late.
+    """
+
+    def __init__(self, window=5, values=None):
+        self.window = window
+        self.values = list(values or [])[-window:]
+
+    def update(self, value):
+        self.values.append(value)
+        del self.values[:-self.window]
+        return statistics.median(self.values)
+
+    def state(self):
+        return {"values": self.values}
+
+    @classmethod
+    def from_state(cls, settings, state):
+        return cls(settings.median_window, values=state.get("values"))
+
+
+class KalmanFilter:
+
+    """
+    A 1-D Kalman filter of a level that stays put between samples, give or take `process_noise`, read with
+    `measurement_noise` (both standard deviations, in the unit of the measurements).
+
+    A sample further than `gate_sigmas` from the estimate is taken as a real step (ex: a pour or a new keg) rather than
+    noise, and the filter restarts from it instead of slowly converging on it.
+    """
+
+    def __init__(self, process_noise=1, measurement_noise=5, gate_sigmas=4, estimate=None, variance=None):
+        self.q = process_noise ** 2
+        self.r = measurement_noise ** 2
+        self.gate_sigmas = gate_sigmas
+        self.estimate = estimate
+        self.variance = variance
+
+    def update(self, value):
+        if self.estimate is None:
+            self.estimate, self.variance = value, self.r
+            return value
+
+        variance = self.variance + self.q
+        innovation = value - self.estimate
+        if innovation ** 2 > self.gate_sigmas ** 2 * (variance + self.r):
+            self.estimate, self.variance = value, self.r
+            return value
+
+        gain = variance / (variance + self.r)
+        self.estimate += gain * innovation
+        self.variance = (1 - gain) * variance
+        return self.estimate
+
+    def state(self):
+        return {"estimate": self.estimate, "variance": self.variance}
+
+    @classmethod
+    def from_state(cls, settings, state):
+        return cls(settings.kalman_process_noise, settings.kalman_measurement_noise, estimate=state.get("estimate"), variance=state.get("variance"))
+
+
+FILTERS = {"median": MedianFilter, "kalman": KalmanFilter}
+
+
+class DeviceFilter:
+
+    """
+    The filter of one device.  Samples must come in time order: a sample that is not newer than the last one filtered
+    (ex: a retry of a sample already stored) is returned as it is, and a change of unit restarts the filter.
+
+    state() is a JSON-able dict to checkpoint the filter with, and to restore it from with `state`.  A state of another
+    filter type is ignored.
+    """
+
+    def __init__(self, settings, state=None):
+        self.settings = settings
+        self.unit = None
+        self.last_taken_on = None
+        self.filter = None
+
+        if state and state.get("type") == settings.type:
+            self.unit = state.get("unit")
+            self.last_taken_on = parse_iso8601_utc(state["taken_on"]) if state.get("taken_on") else None
+            self.filter = FILTERS[settings.type].from_state(settings, state.get("filter") or {})
+
+    def _new_filter(self):
+        return FILTERS[self.settings.type].from_state(self.settings, {})
+
+    def smooth(self, value, unit, taken_on):
+        if self.last_taken_on is not None and taken_on <= self.last_taken_on:
+            return value
+
+        if self.filter is None or unit != self.unit:
+            self.filter = self._new_filter()
+            self.unit = unit
+
+        self.last_taken_on = taken_on
+        return self.filter.update(value)
+
+    def state(self):
+        return {
+            "type": self.settings.type,
+            "unit": self.unit,
+            "taken_on": self.last_taken_on.isoformat() if self.last_taken_on else None,
+            "filter": self.filter.state() if self.filter else None,
+        }
@@ -0,0 +1,104 @@
+import datetime
+import math
+
+from lib.units import convert_to_g, convert_to_ml
+from lib.util import calculate_volume_ml_from_weight
+
+DEFAULT_RATE_HALF_LIFE_HOURS = 72
+
+MASS_UNITS = ("g", "oz", "lb")
+VOLUME_UNITS = ("ml", "l", "gal", "gal (imperial)", "pt", "p (imperial)", "qt", "qt (imperial)", "cup", "cup (imperial)", "oz", "oz (imperial)")
+
+# ml of beer per unit of a measurement.  Weight devices measure mass (an "oz" is a weight oz), flow devices volume.
+ML_PER_MASS_UNIT = {unit: float(calculate_volume_ml_from_weight(convert_to_g(1, unit))) for unit in MASS_UNITS}
+ML_PER_VOLUME_UNIT = {unit: float(convert_to_ml(1, unit)) for unit in VOLUME_UNITS}
+
+
+def rate_half_life_hours(config):
+    return config.get("measurements.forecast.rate_half_life_hours", DEFAULT_RATE_HALF_LIFE_HOURS)
+
+
+def ml_per_unit(device_type, unit):
+
+    """
+    The ml of beer one `unit` of a measurement from a device of `device_type` stands for, None for an unknown unit.
+    """
+
+    if device_type == "weight" and unit in ML_PER_MASS_UNIT:
+        return ML_PER_MASS_UNIT[unit]
+
+    return ML_PER_VOLUME_UNIT.get(unit)
+
+
+def consumed_ml(device_type, prev_ml, ml):
+
+    """
+    The ml consumed from one measurement (in ml) to the next.  Weight devices measure what is left in the keg, flow
+    devices what was poured.
+    """
+
+    return prev_ml - ml if device_type == "weight" else ml - prev_ml
+
+
+def decay_alpha(elapsed_seconds, half_life_hours):
+
+    """
+    The weight of a new sample in an exponentially weighted average over time, for a sample `elapsed_seconds` after
+    the previous one.  Samples far apart weigh more, so the average forgets at the same pace however often the device
+    reports.
+    """
+
+    return 1 - math.exp(-elapsed_seconds * math.log(2) / (half_life_hours * 3600))
+
+
+def update_rate(rate_ml_per_hour, consumed, elapsed_seconds, half_life_hours=DEFAULT_RATE_HALF_LIFE_HOURS):
+
+    """
+    Folds the ml `consumed` between two samples `elapsed_seconds` apart into the consumption rate (ml per hour).  A
+    negative consumption (ex: scale jitter, or a new keg) lowers the rate, which never goes below 0.
+    """
+
+    if elapsed_seconds <= 0:
+        return rate_ml_per_hour
+
+    rate = rate_ml_per_hour or 0
+    rate += decay_alpha(elapsed_seconds, half_life_hours) * (consumed / elapsed_seconds * 3600 - rate)
+    return max(rate, 0)
+
+
+def replay_rate(device_type, measurements, half_life_hours=DEFAULT_RATE_HALF_LIFE_HOURS):
+
+    """
+    The consumption rate (ml per hour) after folding in each step between the (measurement, unit, taken_on)
+    `measurements` of a device, in time order.  None when there are not at least two measurements to step between.
+    """
+
+    rate = None
+    prev = None
+    for measurement, unit, taken_on in measurements:
+        f = ml_per_unit(device_type, unit)
+        if f is None:
+            continue
+
+        ml = measurement * f
+        if prev is not None:
+            rate = update_rate(rate, consumed_ml(device_type, prev[0], ml), (taken_on - prev[1]).total_seconds(), half_life_hours)
+        prev = (ml, taken_on)
+
+    return rate
+
+
+def estimate_empty_on(remaining_ml, rate_ml_per_hour, as_of):
+
+    """
+    When `remaining_ml` runs out at the consumption rate, projected from `as_of` (the time of the latest
+    measurement).  None when nothing is being consumed.
+    """
+
+    if not rate_ml_per_hour or rate_ml_per_hour <= 0 or as_of is None:
+        return None
+
+    try:
+        return as_of + datetime.timedelta(hours=max(remaining_ml, 0) / rate_ml_per_hour)
+    except OverflowError:
+        return None
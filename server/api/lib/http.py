@@ -0,0 +1,132 @@
+import re
+import time
+from email.utils import parsedate_to_datetime
+
+import aiohttp
+
+from lib import logging
+from lib.aio import run_on_background_loop, run_sync_on_background_loop
+from lib.cache import TTLCache
+from lib.config import Config
+
+CONFIG = Config()
+
+LOG = logging.getLogger(__name__)
+
+_MAX_AGE_RE = re.compile(r"(?:^|,)\s*(?:s-maxage|max-age)\s*=\s*\"?(\d+)", re.IGNORECASE)
+_NO_CACHE_RE = re.compile(r"(?:^|,)\s*(?:no-store|no-cache)\b", re.IGNORECASE)
+
+DEFAULT_CLIENT = "http"
+
+_sessions = {}
+_json_cache = TTLCache(max_size=64)
+
+
+def _get_session(client):
+    # The shared session of `client`, the config prefix of its settings (ex: http or particle.http), each with its own
+    # connection pool.  Sessions are bound to the background event loop and only ever used from it.
+    session = _sessions.get(client)
+    if session is None or session.closed:
+        LOG.debug("Opening the %s client session", client)
+        connector = aiohttp.TCPConnector(
+            limit=CONFIG.get(f"{client}.max_connections", 100),
+            limit_per_host=CONFIG.get(f"{client}.max_connections_per_host", 0),
+            keepalive_timeout=CONFIG.get(f"{client}.keepalive_seconds", 15),
+            ttl_dns_cache=CONFIG.get(f"{client}.dns_cache_seconds", 300),
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=CONFIG.get(f"{client}.timeout_seconds", 10),
+            connect=CONFIG.get(f"{client}.connect_timeout_seconds", 5),
+        )
+        session = _sessions[client] = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    return session
+
+
+async def _request_json(method, url, client=DEFAULT_CLIENT, **kwargs):
+    async with _get_session(client).request(method, url, **kwargs) as response:
+        return response.status, response.headers, await response.json(content_type=None)
+
+
+def start_http_session(client=DEFAULT_CLIENT):
+
+    """Opens the shared session of `client` ahead of its first request, ex: at startup."""
+
+    async def _open():
+        _get_session(client)
+
+    run_sync_on_background_loop(_open())
+
+
+async def request_json(method, url, client=DEFAULT_CLIENT, **kwargs):
+
+    """
+    Sends a request with the process wide aiohttp session of `client` (which lives on the background event loop, so its
+    connections are kept alive and reused across requests), and returns the response status and parsed JSON body.
+    `kwargs` are passed to aiohttp's ClientSession.request.
+    """
+
+    status, _, body = await run_on_background_loop(_request_json(method, url, client=client, **kwargs))
+    return status, body
+
+
+def cache_lifetime(headers, now=None):
+
+    """
+    The number of seconds a response can be reused for according to its Cache-Control header (max-age less the Age
+    header), or else its Expires header, 0 when it must not be reused.
+    """
+
+    cache_control = headers.get("Cache-Control", "")
+    if _NO_CACHE_RE.search(cache_control):
+        return 0
+
+    max_age = _MAX_AGE_RE.search(cache_control)
+    if max_age:
+        try:
+            age = int(headers.get("Age", 0))
+        except ValueError:
+            age = 0
+        return max(0, int(max_age.group(1)) - age)
+
+    expires = headers.get("Expires")
+    if expires:
+        try:
+            expires_on = parsedate_to_datetime(expires).timestamp()
+            date = headers.get("Date")
+            sent_on = parsedate_to_datetime(date).timestamp() if date else (now or time.time())
+        except (TypeError, ValueError):
+            return 0
+        return max(0, int(expires_on - sent_on))
+
+    return 0
+
+
+async def get_cached_json(url):
+
+    """
+    GETs a JSON document (ex: an OIDC discovery document or JWKS), reusing it for as long as the cache headers of the
+    response allow.  Raises aiohttp.ClientResponseError on an error status, and asyncio.TimeoutError after
+    http.timeout_seconds.
+    """
+
+    body = _json_cache.get(url)
+    if body is not None:
+        return body
+
+    _, headers, body = await run_on_background_loop(_request_json("GET", url, raise_for_status=True))
+    lifetime = cache_lifetime(headers)
+    if lifetime:
+        LOG.debug("Caching %s for %ss", url, lifetime)
+        _json_cache.set(url, body, ttl_seconds=lifetime)
+    return body
+
+
+async def close_http_sessions():
+
+    """Closes the shared sessions, awaited on the background event loop when it stops."""
+
+    sessions = list(_sessions.values())
+    _sessions.clear()
+    for session in sessions:
+        if not session.closed:
+            await session.close()
@@ -0,0 +1,114 @@
+import asyncio
+import atexit
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+
+from lib import logging
+from lib.exceptions import PasswordHasherBusy
+
+LOG = logging.getLogger(__name__)
+
+# argon2-cffi's own defaults (RFC 9106 low memory profile), so hashes made before the parameters were configurable do
+# not need a rehash
+DEFAULT_TIME_COST = 3
+DEFAULT_MEMORY_COST_KIB = 65536
+DEFAULT_PARALLELISM = 4
+
+
+def password_hasher(config):
+
+    """
+    An argon2 PasswordHasher with the auth.passwords.argon2.* parameters.
+    """
+
+    return PasswordHasher(
+        time_cost=config.get("auth.passwords.argon2.time_cost", DEFAULT_TIME_COST),
+        memory_cost=config.get("auth.passwords.argon2.memory_cost_kib", DEFAULT_MEMORY_COST_KIB),
+        parallelism=config.get("auth.passwords.argon2.parallelism", DEFAULT_PARALLELISM),
+    )
+
+
+class PasswordHasherPool:
+
+    """
+    Runs argon2 hashing and verification on `max_workers` dedicated threads (argon2-cffi releases the GIL while it
+    hashes), so a burst of logins uses at most that many cores and that many times the argon2 memory cost.
+
+    At most `max_pending` more operations wait for a thread, further ones raise PasswordHasherBusy right away: the
+    callers are request threads, and a login waiting on the pool still holds one, so an unbounded queue would let a
+    burst of logins take every request thread from the device ingest.
+    """
+
+    def __init__(self, hasher, max_workers=2, max_pending=4):
+        self.hasher = hasher
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix="password-hasher")
+        self._slots = threading.BoundedSemaphore(max_workers + max_pending)
+
+    def _submit(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHasherBusy()
+
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    async def hash(self, password):
+        return await asyncio.wrap_future(self._submit(self.hasher.hash, password))
+
+    async def verify(self, password_hash, password):
+
+        """
+        True when `password` matches `password_hash`, False when it does not or the hash is not a valid argon2 hash.
+        """
+
+        try:
+            return await asyncio.wrap_future(self._submit(self.hasher.verify, password_hash, password))
+        except (VerificationError, InvalidHashError):
+            return False
+
+    def hash_sync(self, password):
+        return self._submit(self.hasher.hash, password).result()
+
+    def needs_rehash(self, password_hash):
+        return self.hasher.check_needs_rehash(password_hash)
+
+    def stop(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+hasher_pool = None
+_hasher_pool_lock = threading.Lock()
+
+
+def get_password_hasher(config):
+
+    """
+    Returns the process wide PasswordHasherPool, configured by auth.passwords.*, starting it on first use.
+    """
+
+    global hasher_pool
+
+    with _hasher_pool_lock:
+        if hasher_pool is None:
+            LOG.debug("Starting the password hasher pool")
+            hasher_pool = PasswordHasherPool(
+                password_hasher(config),
+                max_workers=config.get("auth.passwords.max_workers", 2),
+                max_pending=config.get("auth.passwords.max_pending", 4),
+            )
+            atexit.register(hasher_pool.stop)
+
+    return hasher_pool
+
+
+def stop_password_hasher():
+    if hasher_pool is not None:
+        hasher_pool.stop()
@@ -0,0 +1,85 @@
+from collections import namedtuple
+
+from lib.forecast import consumed_ml, ml_per_unit
+
+PourSettings = namedtuple("PourSettings", ["noise_ml", "min_volume_ml", "max_gap_seconds"])
+
+DEFAULT_POUR_SETTINGS = PourSettings(noise_ml=5, min_volume_ml=30, max_gap_seconds=60)
+
+
+def pour_settings(config):
+
+    """
+    The measurements.pours.* settings, None when pour detection is disabled.
+    """
+
+    if not config.get("measurements.pours.enabled", True):
+        return None
+
+    return PourSettings(
+        noise_ml=config.get("measurements.pours.noise_ml", DEFAULT_POUR_SETTINGS.noise_ml),
+        min_volume_ml=config.get("measurements.pours.min_volume_ml", DEFAULT_POUR_SETTINGS.min_volume_ml),
+        max_gap_seconds=config.get("measurements.pours.max_gap_seconds", DEFAULT_POUR_SETTINGS.max_gap_seconds),
+    )
+
+
+class PourDetector:
+
+    """
+    Segments the measurements of a device, fed one at a time in time order, into pours.
+
+    A pour is a run of samples that each consume more than `noise_ml` since the previous one, at most
+    `max_gap_seconds` apart.  It starts at the sample before the first drop and ends at the last one, and is only
+    reported once a later sample shows the level settled (or arrives too late to be part of it).  Pours of less than
+    `min_volume_ml` are dropped.
+
+    The whole state is the previous sample and the start of the pour in progress, so it can be kept on the device row
+    between requests.
+    """
+
+    def __init__(self, device_type, settings, last_taken_on=None, last_ml=None, started_on=None, start_ml=None):
+        self.device_type = device_type
+        self.settings = settings
+        self.last_taken_on = last_taken_on
+        self.last_ml = last_ml
+        self.started_on = started_on
+        self.start_ml = start_ml
+
+    def feed(self, measurement, unit, taken_on):
+
+        """
+        Returns the pour the measurement ended, as a dict of started_on, ended_on and volume_ml, else None.
+        """
+
+        f = ml_per_unit(self.device_type, unit)
+        if f is None:
+            return None
+        ml = measurement * f
+
+        if self.last_taken_on is None:
+            self.last_taken_on, self.last_ml = taken_on, ml
+            return None
+
+        elapsed = (taken_on - self.last_taken_on).total_seconds()
+        if elapsed <= 0:
+            # a redelivered or out of order sample
+            return None
+
+        pour = None
+        if consumed_ml(self.device_type, self.last_ml, ml) > self.settings.noise_ml and elapsed <= self.settings.max_gap_seconds:
+            if self.started_on is None:
+                self.started_on, self.start_ml = self.last_taken_on, self.last_ml
+        elif self.started_on is not None:
+            pour = self._close()
+
+        self.last_taken_on, self.last_ml = taken_on, ml
+        return pour
+
+    def _close(self):
+        volume_ml = consumed_ml(self.device_type, self.start_ml, self.last_ml)
+        pour = None
+        if volume_ml >= self.settings.min_volume_ml:
+            pour = {"started_on": self.started_on, "ended_on": self.last_taken_on, "volume_ml": volume_ml}
+
+        self.started_on = self.start_ml = None
+        return pour
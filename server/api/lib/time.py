@@ -1,4 +1,8 @@
 import datetime
+import re
+
+_DURATION_RE = re.compile(r"^(\d+)([smhdw])$")
+_DURATION_UNIT_SECONDS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
 
 
 def parse_iso8601_utc(in_str):
@@ -22,3 +26,23 @@ def utcnow_aware():
 def utcfromtimestamp_aware(timestamp):
 
     return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+
+def parse_timestamp_utc(in_str):
+
+    """Parse either a unix timestamp or an isoformat()'d str into an aware datetime in UTC."""
+
+    try:
+        return utcfromtimestamp_aware(float(in_str))
+    except ValueError:
+        return parse_iso8601_utc(in_str)
+
+
+def parse_duration_seconds(in_str):
+
+    """Parse a short duration str (ex: 30s, 5m, 1h, 7d, 2w) into a number of seconds."""
+
+    match = _DURATION_RE.match(in_str.strip().lower())
+    if not match:
+        raise ValueError(f"invalid duration: '{in_str}'")
+
+    return int(match.group(1)) * _DURATION_UNIT_SECONDS[match.group(2)]
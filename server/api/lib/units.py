@@ -90,4 +90,31 @@ def convert_from_g(val, unit:str):
     else:
         raise Exception(f"invalid volume unit for conversion: '{unit}'")
     
-    return val
\ No newline at end of file
+    return val
+
+# The stored code of each supported measurement unit, see db.types.units.UnitCode.  Codes must never be reused or
+# renumbered, since they are what is stored in the measurement tables.
+UNIT_CODES = {
+    "g": 1,
+    "oz": 2,
+    "lb": 3,
+    "ml": 10,
+    "l": 11,
+    "gal": 12,
+    "gal (imperial)": 13,
+    "pt": 14,
+    "p (imperial)": 15,
+    "qt": 16,
+    "qt (imperial)": 17,
+    "cup": 18,
+    "cup (imperial)": 19,
+    "oz (imperial)": 20,
+}
+
+UNIT_NAMES = {code: unit for unit, code in UNIT_CODES.items()}
+
+def normalize_unit(unit: str):
+    if not isinstance(unit, str) or unit.strip().lower() not in UNIT_CODES:
+        raise ValueError(f"unsupported unit '{unit}', expected one of: {', '.join(UNIT_CODES)}")
+
+    return unit.strip().lower()
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import sys
+from datetime import timedelta
+from itertools import groupby
+
+from lib import logging
+from lib.config import Config
+
+CONFIG = Config()
+CONFIG.setup(config_files=["default.json"])
+logging.init(fmt=logging.DEFAULT_LOG_FMT)
+
+LOGGER = logging.getLogger(__name__)
+
+from db import partitions, session_scope
+from db.devices import Devices as DevicesDB
+from db.device_pours import DevicePours as DevicePoursDB
+from db.device_measurements import (
+    ROLLUPS,
+    DeviceMeasurements as DeviceMeasurementsDB,
+    DeviceMeasurementsDaily as DeviceMeasurementsDailyDB,
+    DeviceMeasurementsHourly as DeviceMeasurementsHourlyDB,
+    DeviceMeasurementsRaw as DeviceMeasurementsRawDB,
+)
+from lib.forecast import rate_half_life_hours, replay_rate
+from lib.pours import PourDetector, pour_settings
+from lib.time import parse_timestamp_utc, utcnow_aware
+
+
+def rollup_lookback():
+    return timedelta(hours=CONFIG.get("measurements.rollups.lookback_hours", 24))
+
+
+def compact_measurements(db_session, now):
+    lookback = rollup_lookback()
+    for rollup in ROLLUPS:
+        compacted = rollup.compact(db_session, now, lookback=lookback)
+        LOGGER.info("Compacted %s bucket(s) into %s", compacted, rollup.__tablename__)
+
+    hourly_retention_days = CONFIG.get("measurements.rollups.hourly_retention_days")
+    if hourly_retention_days:
+        # the next daily compaction recomputes its recent days from the hourly buckets, which must all still be there
+        daily_recompute_start = DeviceMeasurementsDailyDB.get_recompute_start(db_session, lookback)
+        if daily_recompute_start is None:
+            LOGGER.info("No hourly buckets have been compacted into days yet, keeping all of %s", DeviceMeasurementsHourlyDB.__tablename__)
+        else:
+            cutoff = min(now - timedelta(days=hourly_retention_days), daily_recompute_start)
+            pruned = DeviceMeasurementsHourlyDB.prune(db_session, cutoff)
+            LOGGER.info("Pruned %s bucket(s) from %s", pruned, DeviceMeasurementsHourlyDB.__tablename__)
+
+    raw_retention_days = CONFIG.get("measurements.filter.raw_retention_days")
+    if raw_retention_days:
+        pruned = DeviceMeasurementsRawDB.prune(db_session, now - timedelta(days=raw_retention_days))
+        LOGGER.info("Pruned %s measurement(s) from %s", pruned, DeviceMeasurementsRawDB.__tablename__)
+
+
+def expire_measurements(db_session, now, retention_days, drop=False):
+    table = DeviceMeasurementsDB.__tablename__
+    cutoff = now - timedelta(days=retention_days)
+
+    # raw measurements are only ever removed once they have been rolled up
+    compact_measurements(db_session, now)
+    # and the measurements the next hourly compaction recomputes its recent hours from are kept as well
+    recompute_start = DeviceMeasurementsHourlyDB.get_recompute_start(db_session, rollup_lookback())
+    if recompute_start is None:
+        LOGGER.info("No measurements have been compacted yet, keeping all partitions of %s", table)
+        return
+    cutoff = min(cutoff, recompute_start)
+
+    expiring = partitions.expirable_partitions(db_session, table, cutoff)
+    if not expiring:
+        LOGGER.info("No partitions of %s to expire", table)
+        return
+
+    try:
+        # the maintained measurement counts on the devices are decremented by what is in the expiring partitions
+        # only, and the latest measurement state is re-read, all in the same transaction as the expiry
+        DevicesDB.forget_measurements(db_session, DeviceMeasurementsDB.count_by_device_in_partitions(expiring), autocommit=False)
+        expired = partitions.expire_partitions(db_session, table, cutoff, drop=drop, autocommit=False)
+        DevicesDB.refresh_measurement_stats(db_session, include_count=False, autocommit=False)
+        db_session.commit()
+    except:
+        db_session.rollback()
+        raise
+
+    LOGGER.info("%s %s expired partition(s) of %s: %s", "Dropped" if drop else "Detached", len(expired), table, expired)
+
+
+def manage_measurement_partitions(args):
+    table = DeviceMeasurementsDB.__tablename__
+    interval = CONFIG.get("measurements.partitions.interval", "month")
+    premake = args.premake if args.premake is not None else CONFIG.get("measurements.partitions.premake", 3)
+    retention_days = args.retention_days if args.retention_days is not None else CONFIG.get("measurements.retention_days")
+    drop = args.drop or CONFIG.get("measurements.partitions.drop_expired", False)
+
+    now = utcnow_aware()
+    end = partitions.interval_start(now, interval)
+    for _ in range(premake + 1):
+        end = partitions.next_interval_start(end, interval)
+
+    with session_scope(CONFIG) as db_session:
+        created = partitions.ensure_partitions(db_session, table, "taken_on", interval, now, end)
+        LOGGER.info("Created %s new partition(s) of %s: %s", len(created), table, created)
+
+        if not retention_days:
+            LOGGER.info("No measurement retention configured, keeping all partitions")
+            return
+
+        expire_measurements(db_session, now, retention_days, drop=drop)
+
+
+def manage_measurement_rollups(args):
+    retention_days = args.retention_days if args.retention_days is not None else CONFIG.get("measurements.retention_days")
+    drop = args.drop or CONFIG.get("measurements.partitions.drop_expired", False)
+
+    now = utcnow_aware()
+    with session_scope(CONFIG) as db_session:
+        if not retention_days:
+            compact_measurements(db_session, now)
+            return
+
+        expire_measurements(db_session, now, retention_days, drop=drop)
+
+
+def forecast_consumption(args):
+    # Seeds the consumption rate of every device from its recent history, ex: after upgrading, or after changing
+    # measurements.forecast.rate_half_life_hours.  Samples older than `half_lives` half lives barely weigh in the rate.
+    half_life_hours = rate_half_life_hours(CONFIG)
+    start = utcnow_aware() - timedelta(hours=half_life_hours * args.half_lives)
+
+    with session_scope(CONFIG) as db_session:
+        device_types = {str(dev_id): dev_type for dev_id, dev_type in DevicesDB.stream(db_session, ["id", "device_type"])}
+
+        rates = {}
+        measurements = DeviceMeasurementsDB.stream(db_session, start=start)
+        for device_id, rows in groupby(measurements, key=lambda row: str(row.device_id)):
+            rate = replay_rate(device_types.get(device_id), ((row.measurement, row.unit, row.taken_on) for row in rows), half_life_hours)
+            if rate is not None:
+                rates[device_id] = rate
+
+        DevicesDB.set_consumption_rates(db_session, rates)
+        LOGGER.info("Replayed the consumption rate of %s device(s) from their measurements since %s", len(rates), start.isoformat())
+
+
+def backfill_pours(args):
+    # Replays the stored measurements of every device through the pour detector.  The measurements are read off a server
+    # side cursor `chunk_size` rows at a time, and the pours are stored `chunk_size` at a time, each chunk in its own
+    # transaction.  Pours that are already stored (ex: by the ingest path, or an earlier run) are skipped, so the backfill
+    # can be stopped and run again.
+    settings = pour_settings(CONFIG)
+    if settings is None:
+        LOGGER.info("Pour detection is disabled (measurements.pours.enabled)")
+        return
+
+    start = parse_timestamp_utc(args.since) if args.since else None
+
+    def store(pours):
+        with session_scope(CONFIG) as db_session:
+            DevicePoursDB.create_many(db_session, pours)
+        LOGGER.debug("Stored %s pour(s)", len(pours))
+
+    total = 0
+    with session_scope(CONFIG) as db_session:
+        device_types = {str(dev_id): dev_type for dev_id, dev_type in DevicesDB.stream(db_session, ["id", "device_type"])}
+
+        pours = []
+        measurements = DeviceMeasurementsDB.stream(db_session, start=start, batch_size=args.chunk_size)
+        for device_id, rows in groupby(measurements, key=lambda row: str(row.device_id)):
+            detector = PourDetector(device_types.get(device_id), settings)
+            for row in rows:
+                pour = detector.feed(row.measurement, row.unit, row.taken_on)
+                if pour is not None:
+                    pours.append(pour | {"device_id": device_id})
+
+                if len(pours) >= args.chunk_size:
+                    store(pours)
+                    total += len(pours)
+                    pours = []
+
+        if pours:
+            store(pours)
+            total += len(pours)
+
+    LOGGER.info("Detected %s pour(s) in the stored measurements", total)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Keg Volume Monitor database maintenance tasks")
+
+    # parse logging level arg:
+    parser.add_argument(
+        "-l",
+        "--log",
+        dest="loglevel",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+        default=os.environ.get("LOG_LEVEL", "INFO").upper(),
+        help="Set the logging level",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    partitions_parser = subparsers.add_parser(
+        "partitions", help="Create upcoming device_measurements partitions and detach or drop the ones past the retention period"
+    )
+    partitions_parser.add_argument(
+        "--premake", type=int, help="Number of partitions to create ahead of the current one.  Default: measurements.partitions.premake",
+    )
+    partitions_parser.add_argument(
+        "--retention-days", type=int, help="Expire partitions holding only data older than this.  Default: measurements.retention_days",
+    )
+    partitions_parser.add_argument("--drop", action="store_true", help="Drop expired partitions instead of only detaching them")
+    partitions_parser.set_defaults(func=manage_measurement_partitions)
+
+    compact_parser = subparsers.add_parser(
+        "compact", help="Roll closed hours and days of device_measurements up into the hourly and daily rollups and expire raw data past the retention period"
+    )
+    compact_parser.add_argument(
+        "--retention-days", type=int, help="Expire raw partitions holding only rolled up data older than this.  Default: measurements.retention_days",
+    )
+    compact_parser.add_argument("--drop", action="store_true", help="Drop expired partitions instead of only detaching them")
+    compact_parser.set_defaults(func=manage_measurement_rollups)
+
+    forecast_parser = subparsers.add_parser(
+        "forecast", help="Replay the recent measurements of every device into its consumption rate, used for the estimated empty date"
+    )
+    forecast_parser.add_argument("--half-lives", type=int, default=10, help="How many rate half lives of measurements to replay.  Default: 10")
+    forecast_parser.set_defaults(func=forecast_consumption)
+
+    pours_parser = subparsers.add_parser(
+        "pours", help="Backfill device_pours by replaying the stored measurements of every device through the pour detector"
+    )
+    pours_parser.add_argument("--since", help="Only replay measurements taken on or after this time (unix timestamp or ISO 8601).  Default: all of them")
+    pours_parser.add_argument("--chunk-size", type=int, default=5000, help="The number of measurements read, and pours stored, at a time.  Default: 5000")
+    pours_parser.set_defaults(func=backfill_pours)
+
+    args = parser.parse_args()
+    logging.getLogger().setLevel(getattr(logging, args.loglevel))
+
+    try:
+        args.func(args)
+    except KeyboardInterrupt:
+        LOGGER.info("User interrupted - Goodbye")
+        sys.exit()
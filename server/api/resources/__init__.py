@@ -7,7 +7,7 @@ from lib.config import Config
 from lib import logging
 from lib.util import snake_to_camel
 
-from flask import current_app, request, redirect
+from flask import current_app, g, request, redirect
 from flask_login import current_user
 from flask_login.config import EXEMPT_METHODS
 from flask_restx import Resource
@@ -101,15 +101,21 @@ class AsyncBaseResource(BaseResource):
         else:
             return method(*args, **kwargs)
 
+async def get_current_user():
+    # The user loaders are async, so flask-login keeps the coroutine they return as the request's user.  It is awaited
+    # once, and the user it resolves to replaces it for the rest of the request.
+    cu = current_user._get_current_object()  # pylint: disable=protected-access
+    if inspect.iscoroutine(cu):
+        cu = await cu
+        g._login_user = cu  # pylint: disable=protected-access
+    return cu
+
 def async_login_required(allow_device=True, allow_service_account=True, require_admin=False, allow_callback=False):
     def dec(func):
         @wraps(func)
         async def wrapper(*args, **kwargs):
             is_authenticated = False
-            if inspect.iscoroutine(current_user):
-                cu = await current_user
-            else:
-                cu = current_user
+            cu = await get_current_user()
 
             if cu:
                 is_authenticated = cu.is_authenticated
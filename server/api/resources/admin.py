@@ -0,0 +1,22 @@
+from db import ingest, pool_metrics
+from resources import AsyncBaseResource, async_login_required, SWAGGER_AUTHORIZATIONS
+
+from flask_restx import Namespace
+
+api = Namespace('admin', description='Admin APIs', authorizations=SWAGGER_AUTHORIZATIONS)
+
+
+@api.route('/metrics')
+class Metrics(AsyncBaseResource):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+    @api.doc('get_metrics', security=["apiKey"], description='Runtime metrics of the API server process')
+    @async_login_required(allow_device=False, require_admin=True)
+    async def get(self, *args, current_user=None, **kwargs):
+        # the ingest buffer is only reported once something started it, reading the metrics does not
+        buffer = ingest.ingest_buffer
+        return {
+            "ingest": self.transform_response(buffer.metrics()) if buffer else {"enabled": False},
+            "dbPools": self.transform_response(pool_metrics()),
+        }
@@ -1,19 +1,27 @@
+import base64
+import hashlib
 import json
-import inspect
+import threading
+from binascii import Error as binasciiError
 
-import requests
-from argon2 import PasswordHasher
-from argon2.exceptions import VerifyMismatchError
+import aiohttp
 from flask import redirect, request
-from flask_login import UserMixin, login_user, logout_user, current_user
+from flask_login import UserMixin, login_user, logout_user
 from flask_restx import Namespace, fields, reqparse
 
 from oauthlib.oauth2 import WebApplicationClient
 
 import asyncio
-from db import session_scope
+from db import lookups, session_scope
 from db.users import Users as UsersDB
-from resources import BaseResource, AsyncBaseResource
+from lib import exceptions as local_exc
+from lib import logging
+from lib import http
+from lib.cache import TTLCache
+from lib.passwords import get_password_hasher
+from resources import BaseResource, AsyncBaseResource, get_current_user
+
+LOGGER = logging.getLogger(__name__)
 
 api = Namespace('auth', description='Auth APIs')
 session_urls = Namespace('auth_session_urls', description='Auth Session Urls')
@@ -22,7 +30,10 @@ login_mod = api.model("Login", {
 
 })
 class AuthUser(UserMixin):
-    def __init__(self, id_, first_name, last_name, email, profile_pic, google_oidc_id, api_key, admin=False, human=False, service_account=False, device=False):
+    def __init__(
+        self, id_, first_name, last_name, email, profile_pic, google_oidc_id, api_key,
+        admin=False, human=False, service_account=False, device=False, password_enabled=False,
+    ):
         super().__init__()
 
         self.id = id_
@@ -36,13 +47,33 @@ class AuthUser(UserMixin):
         self.human = human
         self.service_account = service_account
         self.device = device
+        self.password_enabled = password_enabled
+
+    def to_dict(self):
+        # the user fields, so the /me endpoints can answer from the request's user without loading it again
+        return {
+            "id": self.id,
+            "first_name": self.first_name,
+            "last_name": self.last_name,
+            "email": self.email,
+            "profile_pic": self.profile_pic,
+            "google_oidc_id": self.google_oidc_id,
+            "api_key": self.api_key,
+            "admin": self.admin,
+            "password_enabled": self.password_enabled,
+        }
 
     @staticmethod
     def from_user(user):
         if not user:
             return None
 
-        return AuthUser(user.id, user.first_name, user.last_name, user.email, user.profile_pic, user.google_oidc_id, user.api_key, admin=user.admin, human=True)
+        # users are either rows of lookups.USER_AUTH_COLUMNS or Users entities
+        password_enabled = user.password_enabled if hasattr(user, "password_enabled") else user.password_hash is not None
+        return AuthUser(
+            user.id, user.first_name, user.last_name, user.email, user.profile_pic, user.google_oidc_id, user.api_key,
+            admin=user.admin, human=True, password_enabled=password_enabled,
+        )
     
     @staticmethod
     def from_device(device):
@@ -59,26 +90,131 @@ class AuthUser(UserMixin):
         return AuthUser(svc_acc.id, svc_acc.name, None, None, None, None, svc_acc.api_key, service_account=True)
 
 
+_NOT_CACHED = object()
+
+principal_cache = None
+_principal_cache_lock = threading.Lock()
+
+
+def get_principal_cache(config):
+    # The process wide cache of the principals authenticated by bearer token, keyed by the sha256 digest of the token
+    # (the tokens themselves are not kept), and of the users logged in with a session cookie, keyed by ("session", user
+    # id).  None when auth.principal_cache.enabled is false.
+    global principal_cache
+
+    if not config.get("auth.principal_cache.enabled", True):
+        return None
+
+    with _principal_cache_lock:
+        if principal_cache is None:
+            principal_cache = TTLCache(
+                max_size=config.get("auth.principal_cache.max_size", 10000),
+                ttl_seconds=config.get("auth.principal_cache.ttl_seconds", 30),
+            )
+    return principal_cache
+
+
+def forget_principal(principal_id=None):
+    # Drops the cached tokens and session of a user, device or service account whose api key (or anything else carried
+    # by its AuthUser) was changed, or which was deleted, along with all the cached misses in case the account was given
+    # a key that was tried before it existed.  Other API processes only see the change once their entries expire.
+    if principal_cache is None:
+        return
+
+    principal_id = str(principal_id) if principal_id is not None else None
+    count = principal_cache.discard(lambda user: user is None or str(user.id) == principal_id)
+    LOGGER.debug("Dropped %s cached principal(s) for %s", count, principal_id)
+
+
+def _cached_principal(config, key, load):
+    # Returns the principal cached under `key`, or loads and caches it.  Misses are cached for
+    # auth.principal_cache.negative_ttl_seconds
+    cache = get_principal_cache(config)
+    if cache is None:
+        return load()
+
+    user = cache.get(key, _NOT_CACHED)
+    if user is not _NOT_CACHED:
+        return user
+
+    user = load()
+    if user is None:
+        cache.set(key, None, ttl_seconds=config.get("auth.principal_cache.negative_ttl_seconds", 5))
+    else:
+        cache.set(key, user)
+    return user
+
+
+def load_user_from_bearer_token(config, bearer_token):
+    # bearer tokens are base64 encoded `<type>|<api key>` pairs, type being one of user, svc or device.  Returns None
+    # when no account matches the api key and raises InvalidBearerToken when the token itself is malformed.  Both found
+    # accounts and misses are cached (see get_principal_cache)
+    digest = hashlib.sha256(bearer_token.encode("utf-8")).digest()
+    return _cached_principal(config, digest, lambda: _load_user_from_bearer_token(config, bearer_token))
+
+
+def load_user_from_session(config, user_id):
+    # the user of a session cookie, cached like the bearer token principals
+    def load():
+        with session_scope(config) as db_session:
+            return AuthUser.from_user(lookups.user_by_pkey(db_session, user_id))
+
+    return _cached_principal(config, ("session", str(user_id)), load)
+
+
+def _load_user_from_bearer_token(config, bearer_token):
+    try:
+        bearer_token = base64.b64decode(bearer_token).decode('ascii')
+        LOGGER.debug(f"Bearer token decoded successfully.  Decoded bearer token: {bearer_token}")
+    except (TypeError, binasciiError, UnicodeDecodeError):
+        raise local_exc.InvalidBearerToken()
+    parts = bearer_token.split('|')
+    if len(parts) != 2:
+        raise local_exc.InvalidBearerToken()
+
+    type = parts[0].lower()
+    key = parts[1]
+    LOGGER.info(f"Bearer token type: {type}")
+    LOGGER.info(f"API Key: {key}")
+    if type == "user":
+        with session_scope(config) as db_session:
+            return AuthUser.from_user(lookups.user_by_api_key(db_session, key))
+    elif type == "svc":
+        with session_scope(config) as db_session:
+            return AuthUser.from_service_account(lookups.service_account_by_api_key(db_session, key))
+    elif type == "device":
+        with session_scope(config) as db_session:
+            return AuthUser.from_device(lookups.device_by_api_key(db_session, key))
+
+    raise local_exc.InvalidBearerToken()
+
+
 class GoogleResourceMixin():
-    def __init__(self):
-        super().__init__()
+    def __init__(self, *args, **kwargs):
+        # first in the bases of the resources, so it runs before the resource's own init, which does not chain on
+        super().__init__(*args, **kwargs)
         self.client_id = self.config.get("auth.oidc.google.client_id")
         self.client_secret = self.config.get("auth.oidc.google.client_secret")
         self.discovery_url = self.config.get("auth.oidc.google.discovery_url")
 
         self.client = WebApplicationClient(self.client_id)
 
-    def get_provider_cfg(self):
-        return requests.get(self.discovery_url).json()
+    async def get_provider_cfg(self):
+        # the discovery document, reused for as long as its cache headers allow
+        try:
+            return await http.get_cached_json(self.discovery_url)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as ex:
+            self.logger.error("Unable to fetch the google discovery document from %s: %s", self.discovery_url, ex)
+            api.abort(502, "Unable to reach google")
 
 @session_urls.route('', '/login/google"')
-class GoogleLogin(BaseResource, GoogleResourceMixin):
+class GoogleLogin(GoogleResourceMixin, AsyncBaseResource):
     async def get(self):
         if not self.config.get("auth.oidc.google.enabled"):
             api.abort(403, "Google authentication is disabled")
 
         # Find out what URL to hit for Google login
-        google_provider_cfg = self.get_provider_cfg()
+        google_provider_cfg = await self.get_provider_cfg()
         authorization_endpoint = google_provider_cfg["authorization_endpoint"]
 
         # Use library to construct the request for Google login and provide
@@ -92,41 +228,55 @@ class GoogleLogin(BaseResource, GoogleResourceMixin):
         return redirect(request_uri)
 
 @session_urls.route('"/login/google/callback"')
-class GoogleCallback(BaseResource, GoogleResourceMixin):
+class GoogleCallback(GoogleResourceMixin, AsyncBaseResource):
     async def get(self):
         # Get authorization code Google sent back to you
         code = request.args.get("code")
 
         # Find out what URL to hit to get tokens that allow you to ask for
         # things on behalf of a user
-        google_provider_cfg = self.get_provider_cfg()
+        google_provider_cfg = await self.get_provider_cfg()
         token_endpoint = google_provider_cfg["token_endpoint"]
 
         # Prepare and send a request to get tokens! Yay tokens!
         token_url, headers, body = self.client.prepare_token_request(
             token_endpoint, authorization_response=request.url, redirect_url=request.base_url, code=code
         )
-        token_response = requests.post(
-            token_url,
-            headers=headers,
-            data=body,
-            auth=(self.client_id, self.client_secret),
-        )
-
-        # Parse the tokens!
-        self.client.parse_request_body_response(json.dumps(token_response.json()))
-
-        # Now that you have tokens (yay) let's find and hit the URL
-        # from Google that gives you the user's profile information,
-        # including their Google profile image and email
-        userinfo_endpoint = google_provider_cfg["userinfo_endpoint"]
-        uri, headers, body = self.client.add_token(userinfo_endpoint)
-        userinfo_response = requests.get(uri, headers=headers, data=body)
+        try:
+            credentials = base64.b64encode(f"{self.client_id}:{self.client_secret}".encode("utf-8")).decode("ascii")
+            status, token_response = await http.request_json(
+                "POST",
+                token_url,
+                headers={**headers, "Authorization": f"Basic {credentials}"},
+                data=body,
+            )
+            if status != 200:
+                error = token_response.get("error") if isinstance(token_response, dict) else None
+                self.logger.error("The google token exchange failed with a %s: %s", status, token_response)
+                if error == "invalid_grant":
+                    # the code was already used, has expired or was not issued to us
+                    api.abort(401, "The google authorization code is invalid or has expired, please log in again")
+                api.abort(502, "Unable to complete the google login")
+
+            # Parse the tokens!
+            self.client.parse_request_body_response(json.dumps(token_response))
+
+            # Now that you have tokens (yay) let's find and hit the URL
+            # from Google that gives you the user's profile information,
+            # including their Google profile image and email
+            userinfo_endpoint = google_provider_cfg["userinfo_endpoint"]
+            uri, headers, body = self.client.add_token(userinfo_endpoint)
+            status, userinfo = await http.request_json("GET", uri, headers=headers, data=body)
+            if status != 200 or not isinstance(userinfo, dict):
+                self.logger.error("Unable to fetch the google user info, got a %s: %s", status, userinfo)
+                api.abort(502, "Unable to complete the google login")
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as ex:
+            self.logger.error("Unable to complete the google token exchange: %s", ex)
+            api.abort(502, "Unable to reach google")
 
         # You want to make sure their email is verified.
         # The user authenticated with Google, authorized your
         # app, and now you've verified their email through Google!
-        userinfo = userinfo_response.json()
         self.logger.debug("user info: %s", userinfo)
         if userinfo.get("email_verified"):
             unique_id = userinfo.get("sub")
@@ -166,7 +316,11 @@ class GoogleCallback(BaseResource, GoogleResourceMixin):
                 UsersDB.update(db_session, user.id, **update_data)
 
             # Begin user session by logging the user in
-            login_user(AuthUser.from_user(user))
+            auth_user = AuthUser.from_user(user)
+            login_user(auth_user)
+
+        if update_data:
+            forget_principal(auth_user.id)
 
         # Send user back to homepage
         return redirect("/home")
@@ -174,11 +328,8 @@ class GoogleCallback(BaseResource, GoogleResourceMixin):
 @session_urls.route("/logout")
 class Logout(AsyncBaseResource):
     async def get(self):
-        if inspect.iscoroutine(current_user):
-            cu = await current_user
-        else:
-            cu = current_user
-        
+        cu = await get_current_user()
+
         await asyncio.sleep(1)
         if not cu:
             return redirect("/login")
@@ -195,23 +346,18 @@ class Logout(AsyncBaseResource):
 @session_urls.route("/me")
 class Me(AsyncBaseResource):
     async def get(self):
-        if inspect.iscoroutine(current_user):
-            cu = await current_user
-        else:
-            cu = current_user
+        cu = await get_current_user()
 
         if not cu:
             return None
 
-        if not cu.is_authenticated:
+        if not cu.is_authenticated or not cu.human:
             return None
-        
-        with session_scope(self.config) as db_session:
-            user = UsersDB.get_by_pkey(db_session, cu.id)
-            remove_keys = ["password_hash"]
-            if not user.admin:
-                remove_keys.append("admin")
-            return self.transform_response(user, remove_keys=remove_keys)
+
+        remove_keys = ["password_enabled"]
+        if not cu.admin:
+            remove_keys.append("admin")
+        return self.transform_response(cu, remove_keys=remove_keys)
 
 
 @api.route("/login")
@@ -234,14 +380,26 @@ class Login(AsyncBaseResource):
             if not password_hash:
                 api.abort(400, "The user does not have a password set.  Please try logging in with google.")
 
-            self.logger.debug(f"checking user {email} with password {password}")
-            ph = PasswordHasher()
-            try:
-                if not ph.verify(password_hash, password):
-                    api.abort(401)
-            except VerifyMismatchError:
-                api.abort(401)
+            auth_user = AuthUser.from_user(user)
 
-            login_user(AuthUser.from_user(user))
+        # the password is checked on the password hasher pool, after the db session (and its connection) is released
+        self.logger.debug(f"checking user {email} password")
+        hasher = get_password_hasher(self.config)
+        try:
+            if not await hasher.verify(password_hash, password):
+                api.abort(401)
+        except local_exc.PasswordHasherBusy as ex:
+            api.abort(503, str(ex))
 
+        if hasher.needs_rehash(password_hash):
+            # the password was hashed with other argon2 parameters than the configured ones
+            try:
+                password_hash = await hasher.hash(password)
+            except local_exc.PasswordHasherBusy:
+                self.logger.debug(f"password hasher busy, not rehashing user {email} password")
+            else:
+                with session_scope(self.config) as db_session:
+                    UsersDB.update(db_session, auth_user.id, password_hash=password_hash)
+
+        login_user(auth_user)
         return True
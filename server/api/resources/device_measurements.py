@@ -1,78 +1,426 @@
-from datetime import datetime
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as binasciiError
+from datetime import datetime, timedelta
 import inspect
+import json
+import zlib
 
-from db import session_scope
+from db import lookups, run_in_async_session, session_scope
 from db.devices import Devices as DevicesDB
-from db.device_measurements import DeviceMeasurements as DeviceMeasurementsDB
-from lib.time import utcnow_aware, utcfromtimestamp_aware
+from db.device_measurements import SERIES_AGGREGATES, DeviceMeasurements as DeviceMeasurementsDB
+from db.filters import get_filter_bank
+from db.ingest import IngestQueueFull, get_ingest_buffer
+from lib.downsample import lttb
+from lib.forecast import rate_half_life_hours
+from lib.pours import pour_settings
+from lib.time import parse_duration_seconds, parse_iso8601_utc, parse_timestamp_utc, utcnow_aware, utcfromtimestamp_aware
+from lib.units import normalize_unit
 from resources import AsyncBaseResource, async_login_required, SWAGGER_AUTHORIZATIONS
 
+from flask import request
 from flask_login import current_user as _current_user
-from flask_restx import Namespace, fields
+from flask_restx import Namespace, fields, reqparse
 
 api = Namespace('device_measurements', description='Manage Device Measurements', authorizations=SWAGGER_AUTHORIZATIONS)
 
 save_device_measurement_mod = api.model('SaveDeviceMeasurement', {
     'm': fields.Float(required=True, description='The value of the taken measurement'),
-    'u': fields.String(required=False, description='The unit of the taken measurement.  If not provided, the unit the device was calibrated with is used, else the default unit for the given device type'),
+    'u': fields.String(
+        required=False,
+        description='The unit of the taken measurement, ex: g, oz, lb, ml, l, gal.  '
+        'If not provided, the unit the device was calibrated with is used, else the default unit for the given device type',
+    ),
     "ts": fields.Integer(requires=False, description="The timestamp that the measurement was taken.  If not provided, the the timestamp fo the request is used.")
 })
 device_measurement_mod = api.model('DeviceMeasurement', {
-    'id': fields.String(required=True, description='The id of the device', readonly=True),
+    'id': fields.Integer(required=True, description='The id of the measurement', readonly=True),
     'deviceId': fields.String(required=True, description="The device Id"),
     'measurement': fields.Float(required=True, description='The value of the taken measurement'),
     'unit': fields.String(required=False, description='The unit of the taken measurement'),
     "takenOn": fields.DateTime(requires=False, description="The datetime that the measurement was taken.")
 })
 
+series_point_mod = api.model('DeviceMeasurementSeriesPoint', {
+    'takenOn': fields.DateTime(description="The start of the bucket, or the datetime the measurement was taken in lttb mode"),
+    'measurement': fields.Float(description='The aggregated value of the bucket, or the measurement in lttb mode'),
+    'count': fields.Integer(description='The number of measurements in the bucket.  Not included in lttb mode')
+})
+batch_result_mod = api.model('DeviceMeasurementBatchResult', {
+    'index': fields.Integer(description='The position of the measurement in the submitted batch'),
+    'status': fields.Integer(
+        description='The HTTP style status for the measurement: 201 when saved, 202 when queued to be saved, 200 when it was already stored, 400 when rejected',
+    ),
+    'id': fields.Integer(description='The id of the saved measurement'),
+    'duplicate': fields.Boolean(
+        description='Set when a measurement with the same timestamp was already stored for the device, the measurement is then skipped',
+    ),
+    'error': fields.String(description='The reason the measurement was rejected')
+})
+batch_response_mod = api.model('DeviceMeasurementBatchResponse', {
+    'created': fields.Integer(description='The number of measurements saved'),
+    'queued': fields.Integer(description='The number of measurements accepted for writing, when the ingest buffer is enabled'),
+    'duplicates': fields.Integer(description='The number of measurements skipped because they were already stored'),
+    'failed': fields.Integer(description='The number of measurements rejected'),
+    'results': fields.List(fields.Nested(batch_result_mod))
+})
+
+class DeviceMeasurementResource(AsyncBaseResource):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+    def verify_device_access(self, device_id, current_user):
+        if not current_user.human:
+            if str(current_user.id).lower() != device_id.lower():
+                self.logger.error(
+                    f"Request to store measurements failed, the provided device id ({device_id}) does not match the id of the device "
+                    f"authentication session ({current_user.id})"
+                )
+                api.abort(400, "Device id does not match the id of the authenticated device session")
+
+    def build_measurement(self, dev, data):
+        m = data.get("m")
+        if isinstance(m, bool) or not isinstance(m, (int, float)):
+            raise ValueError("'m' is required and must be a number")
+
+        unit = data.get("u")
+        if unit is None:
+            # TODO once the calibration units are stored for the device, we need to first try and use that and then fall back to the config default
+            unit = "g" if dev.device_type == "weight" else "ml"
+        elif not isinstance(unit, str):
+            raise ValueError("'u' must be a string")
+        else:
+            unit = normalize_unit(unit)
+
+        measurement = {
+            "device_id": dev.id,
+            "measurement": m,
+            "unit": unit
+        }
+
+        ts = data.get("ts")
+        if ts is None:
+            measurement["taken_on"] = utcnow_aware()
+        elif isinstance(ts, bool) or not isinstance(ts, (int, float)):
+            raise ValueError("'ts' must be a unix timestamp")
+        else:
+            try:
+                measurement["taken_on"] = utcfromtimestamp_aware(ts)
+            except (OverflowError, OSError, ValueError):
+                raise ValueError(f"'ts' is not a valid unix timestamp: {ts}")
+
+        return measurement
+
+    def smooth_measurements(self, dev, measurements):
+        # runs the measurements through the device's noise filter, when measurements.filter.type is set
+        bank = get_filter_bank(self.config)
+        if bank is not None:
+            bank.smooth(dev.id, dev.filter_state, measurements)
+
+    def enqueue_measurements(self, measurements):
+        # Hands the measurements to the write-behind ingest buffer when it is enabled.  Returns False when it is not, and
+        # the measurements have to be written by the caller.
+        buffer = get_ingest_buffer(self.config)
+        if buffer is None:
+            return False
+
+        try:
+            buffer.enqueue(measurements)
+        except IngestQueueFull as ex:
+            self.logger.warning(f"Rejecting {len(measurements)} measurements: {ex}")
+            api.abort(503, str(ex))
+
+        return True
+
+    async def get_device(self, device_id):
+        async def get(db_session):
+            return await lookups.async_device_by_pkey(db_session, device_id)
+
+        return await run_in_async_session(self.config, get)
+
+    def get_batch_payload(self):
+        max_bytes = self.config.get("measurements.batch.max_payload_bytes")
+        raw = request.get_data()
+
+        encoding = request.headers.get("Content-Encoding", "").lower()
+        if encoding == "gzip":
+            decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+            try:
+                raw = decompressor.decompress(raw, max_bytes + 1)
+            except zlib.error:
+                api.abort(400, "Invalid gzip payload")
+        elif encoding and encoding != "identity":
+            api.abort(415, f"Unsupported content encoding '{encoding}'")
+
+        if len(raw) > max_bytes:
+            api.abort(413, f"Measurement batch payload exceeds the max size of {max_bytes} bytes")
+
+        try:
+            data = json.loads(raw)
+        except ValueError:
+            api.abort(400, "Invalid JSON payload")
+
+        if isinstance(data, dict):
+            data = data.get("measurements")
+
+        if not isinstance(data, list):
+            api.abort(400, "Expected a list of measurements")
+
+        max_size = self.config.get("measurements.batch.max_size")
+        if len(data) > max_size:
+            api.abort(413, f"Measurement batch contains {len(data)} measurements, the max allowed is {max_size}")
+
+        return data
+
+    def parse_time_arg(self, args, key):
+        value = args.get(key)
+        if not value:
+            return None
+
+        try:
+            return parse_timestamp_utc(value)
+        except (OverflowError, OSError, ValueError):
+            api.abort(400, f"Invalid '{key}' value '{value}', expected a unix timestamp or an ISO 8601 datetime")
+
+
+def encode_cursor(key):
+    taken_on, _id = key
+    return urlsafe_b64encode(json.dumps([taken_on.isoformat(), _id]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        taken_on, _id = json.loads(urlsafe_b64decode(cursor.encode()))
+        return parse_iso8601_utc(taken_on), int(_id)
+    except (binasciiError, TypeError, ValueError):
+        api.abort(400, "Invalid cursor")
+
+
 @api.route('', '/')
-class DeviceMeasurements(AsyncBaseResource):
+class DeviceMeasurements(DeviceMeasurementResource):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
     
-    @api.doc('list_device_measurements', security=["apiKey"])
+    @api.doc(
+        'list_device_measurements',
+        security=["apiKey"],
+        description='Lists measurements newest first.  '
+        'When more results are available, the X-Next-Cursor response header contains the cursor for the next page.',
+    )
+    @api.param('from', 'Only include measurements taken on or after this time (unix timestamp or ISO 8601)', _in="query")
+    @api.param('to', 'Only include measurements taken before this time (unix timestamp or ISO 8601)', _in="query")
+    @api.param('limit', 'The max number of measurements to return', _in="query", type=int)
+    @api.param('cursor', 'The cursor returned in the X-Next-Cursor header of the previous page', _in="query")
     @async_login_required(allow_device=False)
     #@api.marshal_list_with(device_measurement_mod)
-    async def get(self, device_id):
-        with session_scope(self.config) as db_session:
-            measurements = DeviceMeasurementsDB.query(db_session, device_id=device_id)
-            if measurements:
-                return self.transform_response(measurements)
-        return []
+    async def get(self, device_id, *args, current_user=None, **kwargs):
+        parser = reqparse.RequestParser()
+        parser.add_argument('from', location='args')
+        parser.add_argument('to', location='args')
+        parser.add_argument('limit', type=int, location='args')
+        parser.add_argument('cursor', location='args')
+        args = parser.parse_args()
+
+        start = self.parse_time_arg(args, "from")
+        end = self.parse_time_arg(args, "to")
+
+        limit = args.get("limit")
+        max_limit = self.config.get("measurements.page.max_limit")
+        if limit is None:
+            limit = self.config.get("measurements.page.default_limit")
+        elif limit < 1 or limit > max_limit:
+            api.abort(400, f"Invalid limit {limit}, must be between 1 and {max_limit}")
+
+        after = None
+        if args.get("cursor"):
+            after = decode_cursor(args["cursor"])
+
+        async def get_page(db_session):
+            return await DeviceMeasurementsDB.async_get_page(db_session, device_id, start=start, end=end, limit=limit, after=after)
+
+        measurements, next_key = await run_in_async_session(self.config, get_page, read_only=True)
+        res = self.transform_response(measurements) if measurements else []
+
+        headers = {}
+        if next_key:
+            headers["X-Next-Cursor"] = encode_cursor(next_key)
+        return res, 200, headers
     
     @api.doc('save_device_measurement', security=["apiKey"])
     @api.expect(save_device_measurement_mod, validate=True)
     @async_login_required()
     async def post(self, device_id, *args, current_user=None, **kwargs):
-        if not current_user.human:
-            if str(current_user.id).lower() != device_id.lower():
-                self.logger.error(f"Request to store measurements failed, the provided device id ({device_id}) does not match the id of the device authentication session ({current_user.id})")
-                api.abort(400, "Device id does not match the id of the authenticated device session")
+        self.verify_device_access(device_id, current_user)
+
+        dev = await self.get_device(device_id)
+        if not dev:
+            api.abort(404)
+
+        try:
+            measurement = self.build_measurement(dev, api.payload)
+        except ValueError as ex:
+            api.abort(400, str(ex))
+
+        self.smooth_measurements(dev, [measurement])
+        if self.enqueue_measurements([measurement]):
+            return self.transform_response(measurement), 202
+
+        async def save(db_session):
+            [_id] = await DeviceMeasurementsDB.async_create_many(db_session, [measurement], autocommit=False)
+            if _id is None:
+                # the sample was already stored, ex: a retry of a request that did not get its response back
+                return await DeviceMeasurementsDB.async_get_by_taken_on(db_session, dev.id, measurement["taken_on"])
+
+            await DevicesDB.async_record_measurements(
+                db_session,
+                dev.id,
+                [measurement],
+                half_life_hours=rate_half_life_hours(self.config),
+                pour_settings=pour_settings(self.config),
+                autocommit=False,
+            )
+            return measurement | {"id": _id}
+
+        return self.transform_response(await run_in_async_session(self.config, save))
+
+
+@api.route('/batch')
+class DeviceMeasurementsBatch(DeviceMeasurementResource):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+    @api.doc(
+        'save_device_measurements_batch',
+        security=["apiKey"],
+        description='Save a list of measurements in a single request.  The body may be gzip compressed by setting the "Content-Encoding: gzip" header.',
+    )
+    @api.expect([save_device_measurement_mod], validate=False)
+    @api.response(201, 'All measurements saved', batch_response_mod)
+    @api.response(202, 'All measurements queued to be saved, when the ingest buffer is enabled', batch_response_mod)
+    @api.response(207, 'Some measurements were rejected', batch_response_mod)
+    @api.response(400, 'No measurements were saved', batch_response_mod)
+    @async_login_required()
+    async def post(self, device_id, *args, current_user=None, **kwargs):
+        self.verify_device_access(device_id, current_user)
+        data = self.get_batch_payload()
+
+        dev = await self.get_device(device_id)
+        if not dev:
+            api.abort(404)
+
+        results = []
+        rows = []
+        for i, item in enumerate(data):
+            try:
+                if not isinstance(item, dict):
+                    raise ValueError("Expected a measurement object")
+                rows.append(self.build_measurement(dev, item))
+                results.append({"index": i, "status": 201})
+            except ValueError as ex:
+                results.append({"index": i, "status": 400, "error": str(ex)})
+
+        self.smooth_measurements(dev, rows)
+        if rows and self.enqueue_measurements(rows):
+            for res in results:
+                if res["status"] == 201:
+                    res["status"] = 202
+
+            failed = len(results) - len(rows)
+            return {"queued": len(rows), "failed": failed, "results": results}, 207 if failed else 202
+
+        async def save(db_session):
+            ids = await DeviceMeasurementsDB.async_create_many(db_session, rows, autocommit=False)
+            saved = [row for row, _id in zip(rows, ids) if _id is not None]
+            await DevicesDB.async_record_measurements(
+                db_session, dev.id, saved, half_life_hours=rate_half_life_hours(self.config), pour_settings=pour_settings(self.config), autocommit=False,
+            )
+            return ids
+
+        ids = iter(await run_in_async_session(self.config, save))
+        for res in results:
+            if res["status"] == 201:
+                _id = next(ids)
+                if _id is None:
+                    res["status"] = 200
+                    res["duplicate"] = True
+                else:
+                    res["id"] = _id
+
+        created = sum(1 for res in results if res["status"] == 201)
+        duplicates = len(rows) - created
+        failed = len(results) - len(rows)
+        self.logger.debug(f"Saved batch of measurements for device {device_id}: {created} created, {duplicates} duplicates, {failed} failed")
+
+        status = 201
+        if failed:
+            status = 207 if rows else 400
+
+        return {"created": created, "duplicates": duplicates, "failed": failed, "results": results}, status
+
+
+@api.route('/series')
+class DeviceMeasurementsSeries(DeviceMeasurementResource):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+    @api.doc(
+        'get_device_measurement_series',
+        security=["apiKey"],
+        description='Returns a downsampled series of the measurements, suitable for charting.  Defaults to the last 24 hours.',
+    )
+    @api.param('from', 'Only include measurements taken on or after this time (unix timestamp or ISO 8601).  Default: 24 hours before `to`', _in="query")
+    @api.param('to', 'Only include measurements taken before this time (unix timestamp or ISO 8601).  Default: now', _in="query")
+    @api.param(
+        'mode',
+        'bucket: aggregate the measurements into fixed time buckets. lttb: pick the points that best preserve the shape of the series.  Default: bucket',
+        _in="query",
+    )
+    @api.param('bucket', 'The bucket width for bucket mode, ex: 30s, 5m, 1h, 1d.  Default: 5m', _in="query")
+    @api.param('agg', 'The bucket aggregate for bucket mode, one of: avg, min, max, last.  Default: avg', _in="query")
+    @api.param('points', 'The max number of points to return in lttb mode', _in="query", type=int)
+    @api.response(200, 'Success', [series_point_mod])
+    @async_login_required(allow_device=False)
+    async def get(self, device_id, *args, current_user=None, **kwargs):
+        parser = reqparse.RequestParser()
+        parser.add_argument('from', location='args')
+        parser.add_argument('to', location='args')
+        parser.add_argument('mode', location='args', default="bucket", choices=("bucket", "lttb"))
+        parser.add_argument('bucket', location='args', default="5m")
+        parser.add_argument('agg', location='args', default="avg", choices=tuple(SERIES_AGGREGATES.keys()))
+        parser.add_argument('points', type=int, location='args')
+        args = parser.parse_args()
+
+        end = self.parse_time_arg(args, "to") or utcnow_aware()
+        start = self.parse_time_arg(args, "from") or end - timedelta(days=1)
+        if start >= end:
+            api.abort(400, "'from' must be before 'to'")
+
+        max_points = self.config.get("measurements.series.max_points")
+
+        if args["mode"] == "lttb":
+            points = args.get("points") or self.config.get("measurements.series.default_points")
+            if points < 3 or points > max_points:
+                api.abort(400, f"Invalid points {points}, must be between 3 and {max_points}")
+
+            with session_scope(self.config, read_only=True) as db_session:
+                xs, ys = DeviceMeasurementsDB.get_raw_series(
+                    db_session, device_id, start=start, end=end, sub_buckets=points * self.config.get("measurements.series.lttb_oversampling"),
+                )
+
+            return [{"takenOn": utcfromtimestamp_aware(xs[i]).isoformat(), "measurement": ys[i]} for i in lttb(xs, ys, points)]
+
+        try:
+            bucket_seconds = parse_duration_seconds(args["bucket"])
+        except ValueError as ex:
+            api.abort(400, str(ex))
+
+        if bucket_seconds < 1:
+            api.abort(400, "bucket must be at least 1 second")
+
+        buckets = (end - start).total_seconds() / bucket_seconds
+        if buckets > max_points:
+            api.abort(400, f"The requested range would return {int(buckets)} buckets, the max allowed is {max_points}.  Use a larger bucket or a smaller range")
+
+        with session_scope(self.config, read_only=True) as db_session:
+            rows = DeviceMeasurementsDB.get_series(db_session, device_id, bucket_seconds, agg=args["agg"], start=start, end=end)
 
-        with session_scope(self.config) as db_session:
-            dev = DevicesDB.get_by_pkey(db_session, device_id)
-            if not dev:
-                api.abort(404)
-
-            data = api.payload
-            keys = data.keys()
-            if "u" not in keys:
-                # TODO once the calibration units are stored for the device, we need to first try and use that and then fall back to the config default
-                data["u"] = "g" if dev.device_type == "weight" else "ml"
-            else:
-                # TODO make sure the units are supported
-                pass
-
-            measurement= {
-                "device_id": device_id,
-                "measurement": data["m"],
-                "unit": data["u"]
-            }
-
-            if "ts" in keys:
-                measurement["taken_on"] = utcfromtimestamp_aware(data["ts"])
-            else:
-                measurement["taken_on"] = utcnow_aware()
-            
-            meas = DeviceMeasurementsDB.create(db_session, **measurement)
-            return self.transform_response(meas)
\ No newline at end of file
+        return [{"takenOn": r.bucket.isoformat(), "measurement": r.measurement, "count": r.count} for r in rows]
@@ -0,0 +1,102 @@
+from db import run_in_async_session
+from db.device_pours import DevicePours as DevicePoursDB
+from resources import async_login_required, SWAGGER_AUTHORIZATIONS
+from resources.device_measurements import DeviceMeasurementResource, decode_cursor, encode_cursor
+
+from flask_restx import Namespace, fields, reqparse
+
+api = Namespace('device_pours', description='Pours detected in the device measurements', authorizations=SWAGGER_AUTHORIZATIONS)
+
+device_pour_mod = api.model('DevicePour', {
+    'id': fields.Integer(description='The id of the pour', readonly=True),
+    'deviceId': fields.String(description="The device Id"),
+    'startedOn': fields.DateTime(dt_format="iso8601", description='When the pour started'),
+    'endedOn': fields.DateTime(dt_format="iso8601", description='When the pour ended'),
+    'volumeMl': fields.Float(description='The volume poured, in ml'),
+})
+device_pour_stats_mod = api.model('DevicePourStats', {
+    'pourCount': fields.Integer(description='The number of pours'),
+    'totalVolumeMl': fields.Float(description='The total volume poured, in ml'),
+    'avgVolumeMl': fields.Float(description='The average volume of a pour, in ml'),
+    'maxVolumeMl': fields.Float(description='The largest pour, in ml'),
+    'avgDurationSeconds': fields.Float(description='The average duration of a pour'),
+    'firstStartedOn': fields.DateTime(dt_format="iso8601", description='When the first pour started'),
+    'lastStartedOn': fields.DateTime(dt_format="iso8601", description='When the last pour started'),
+})
+
+
+def time_range_parser():
+    parser = reqparse.RequestParser()
+    parser.add_argument('from', location='args')
+    parser.add_argument('to', location='args')
+    return parser
+
+
+@api.route('', '/')
+class DevicePours(DeviceMeasurementResource):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+    @api.doc(
+        'list_device_pours',
+        security=["apiKey"],
+        description='Lists pours newest first.  When more results are available, the X-Next-Cursor response header contains the cursor for the next page.',
+    )
+    @api.param('from', 'Only include pours started on or after this time (unix timestamp or ISO 8601)', _in="query")
+    @api.param('to', 'Only include pours started before this time (unix timestamp or ISO 8601)', _in="query")
+    @api.param('limit', 'The max number of pours to return', _in="query", type=int)
+    @api.param('cursor', 'The cursor returned in the X-Next-Cursor header of the previous page', _in="query")
+    @api.response(200, 'Success', [device_pour_mod])
+    @async_login_required(allow_device=False)
+    async def get(self, device_id, *args, current_user=None, **kwargs):
+        parser = time_range_parser()
+        parser.add_argument('limit', type=int, location='args')
+        parser.add_argument('cursor', location='args')
+        args = parser.parse_args()
+
+        start = self.parse_time_arg(args, "from")
+        end = self.parse_time_arg(args, "to")
+
+        limit = args.get("limit")
+        max_limit = self.config.get("measurements.page.max_limit")
+        if limit is None:
+            limit = self.config.get("measurements.page.default_limit")
+        elif limit < 1 or limit > max_limit:
+            api.abort(400, f"Invalid limit {limit}, must be between 1 and {max_limit}")
+
+        after = None
+        if args.get("cursor"):
+            after = decode_cursor(args["cursor"])
+
+        async def get_page(db_session):
+            return await DevicePoursDB.async_get_page(db_session, device_id, start=start, end=end, limit=limit, after=after)
+
+        pours, next_key = await run_in_async_session(self.config, get_page, read_only=True)
+        res = self.transform_response(pours) if pours else []
+
+        headers = {}
+        if next_key:
+            headers["X-Next-Cursor"] = encode_cursor(next_key)
+        return res, 200, headers
+
+
+@api.route('/stats')
+class DevicePourStats(DeviceMeasurementResource):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+    @api.doc('get_device_pour_stats', security=["apiKey"])
+    @api.param('from', 'Only include pours started on or after this time (unix timestamp or ISO 8601)', _in="query")
+    @api.param('to', 'Only include pours started before this time (unix timestamp or ISO 8601)', _in="query")
+    @api.response(200, 'Success', device_pour_stats_mod)
+    @async_login_required(allow_device=False)
+    async def get(self, device_id, *args, current_user=None, **kwargs):
+        args = time_range_parser().parse_args()
+        start = self.parse_time_arg(args, "from")
+        end = self.parse_time_arg(args, "to")
+
+        async def get_stats(db_session):
+            return await DevicePoursDB.async_get_stats(db_session, device_id, start=start, end=end)
+
+        stats = await run_in_async_session(self.config, get_stats, read_only=True)
+        return self.transform_response(stats._asdict())
@@ -1,8 +1,13 @@
-from db import session_scope
+from db import run_in_async_session
 from db.devices import Devices as DevicesDB
 from db.device_measurements import DeviceMeasurements as DevicesMeasurementsDB
+from db.filters import get_filter_bank
+from db.ingest import IngestQueueFull, get_ingest_buffer
 
+from lib.forecast import rate_half_life_hours
+from lib.pours import pour_settings
 from lib.time import utcfromtimestamp_aware
+from lib.units import normalize_unit
 from resources import AsyncBaseResource, async_login_required, SWAGGER_AUTHORIZATIONS
 
 from flask_restx import Namespace, fields
@@ -12,7 +17,7 @@ api = Namespace('devices_status', description='Device status update', authorizat
 device_status_mod = api.model("DeviceStatus", {
         "state": fields.Integer(required=True, description=""),
         "latestMeasurement": fields.Float(required=False, description=""),
-        "latestMeasurementUnit": fields.Float(required=False, description=""),
+        "latestMeasurementUnit": fields.String(required=False, description=""),
         "latestMeasurementTS": fields.Integer(required=False, description=""),
         "emptyKegWeightGrams": fields.Integer(required=False, description=""),
     })
@@ -24,6 +29,24 @@ class DeviceStatus(AsyncBaseResource):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
     
+    async def store_latest_measurement(self, db_session, dev, buffer, m_data):
+        if buffer is not None:
+            try:
+                buffer.enqueue([m_data])
+            except IngestQueueFull as ex:
+                # the device sends its latest measurement again with its next status
+                self.logger.warning(f"Not storing the latest measurement from device '{dev.name}': {ex}")
+            return
+
+        # the latest measurement is stored unless the device already sent it, keyed on its timestamp
+        [m_id] = await DevicesMeasurementsDB.async_create_many(db_session, [m_data], autocommit=False)
+        if m_id is not None:
+            self.logger.info(f"Latest measurement from device '{dev.name}' was not stored yet, added record.")
+            self.logger.debug(f"Added measurement for device '{dev.name}' ({dev.id}): {m_data['measurement']} on {m_data['taken_on']}")
+            await DevicesDB.async_record_measurements(
+                db_session, dev.id, [m_data], half_life_hours=rate_half_life_hours(self.config), pour_settings=pour_settings(self.config), autocommit=False,
+            )
+
     @api.doc('device_status', security=["apiKey"])
     @api.expect(device_status_mod, validate=True)
     @async_login_required(allow_service_account=False, allow_device=True, require_admin=True)
@@ -33,30 +56,35 @@ class DeviceStatus(AsyncBaseResource):
                 self.logger.warning(f"device with ID: {current_user.id} attempted to post status for device Id: {id}, which does not match")
                 api.abort(405, "Devices are not authorized to update the status for another device")
 
-        with session_scope(self.config) as db_session:
-            dev = DevicesDB.get_with_measurement_stats(db_session, id)
+        data = api.payload
+        m = data.get("latestMeasurement", 0)
+        ts = data.get("latestMeasurementTS", 0)
+        buffer = get_ingest_buffer(self.config)
+        filters = get_filter_bank(self.config)
+
+        async def update_status(db_session):
+            dev = await DevicesDB.async_get_by_pkey(db_session, id)
             if not dev:
-                api.abort(404)
-            
-            data = api.payload
-            m = data.get("latestMeasurement", 0)
-            ts = data.get("latestMeasurementTS", 0)
-
-            if(m > 0 and ts > 0 and dev.latest_measurement != m):
-                ts_dt = utcfromtimestamp_aware(ts)
-                self.logger.info(f"Latest measurement from device '{dev.name}' did not match latest measurement in DB, adding record.")
-                self.logger.debug(f"Adding measurement for device '{dev.name}' ({dev.id}) expected: {dev.latest_measurement} on {dev.latest_measurement_taken_on}, actual: {m} on {ts_dt}")
-                m_data = {
-                    "device_id": id,
-                    "measurement": m,
-                    "taken_on": ts_dt
-                }
+                return None
+
+            if m > 0 and ts > 0:
                 default_unit = "g" if dev.device_type == "weight" else "ml"
-                m_data["unit"] = data.get("latestMeasurementUnit", default_unit)
-                
-                DevicesMeasurementsDB.create(db_session, **m_data)
-            
+                try:
+                    unit = normalize_unit(data.get("latestMeasurementUnit", default_unit))
+                except ValueError as ex:
+                    # the status is still updated, only the measurement is not stored
+                    self.logger.warning(f"Not storing the latest measurement from device '{dev.name}': {ex}")
+                else:
+                    m_data = {"device_id": id, "measurement": m, "unit": unit, "taken_on": utcfromtimestamp_aware(ts)}
+                    if filters is not None:
+                        filters.smooth(dev.id, dev.filter_state, [m_data])
+                    await self.store_latest_measurement(db_session, dev, buffer, m_data)
+
             st = data["state"]
             self.logger.debug(f"Updating status for device '{dev.name}' ({dev.id}): state = {st}")
-            dev = DevicesDB.update(db_session, id, state=st)
-            return True
\ No newline at end of file
+            return await DevicesDB.async_update(db_session, id, state=st)
+
+        if not await run_in_async_session(self.config, update_status):
+            api.abort(404)
+
+        return True
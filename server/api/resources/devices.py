@@ -1,11 +1,13 @@
 from time import sleep
 
-from db import session_scope
+from db import lookups, session_scope
 from db.devices import Devices as DevicesDB
 from lib import devices
+from lib.forecast import estimate_empty_on
 from lib.units import convert_from_ml, convert_to_ml, convert_to_g, convert_from_g
 from lib.util import calculate_volume_ml_from_weight, obj_keys_camel_to_snake, random_string
 from resources import AsyncBaseResource, DEVICE_STATE_MAP, async_login_required, SWAGGER_AUTHORIZATIONS
+from resources.auth import forget_principal
 
 import asyncio
 from flask_restx import Namespace, fields, reqparse
@@ -40,6 +42,9 @@ device_mod = api.model("Device", {
         "latestMeasurementTakenOn": fields.DateTime(dt_format="iso8601", description=""),
         "percentRemaining": fields.Float(description="The percent volume remaining"),
         "totalVolumeRemaining": fields.Float(description="Total volume remaining"),
+        "consumptionMlPerHour": fields.Float(description="The exponentially weighted consumption rate, in ml per hour"),
+        "consumptionPerDay": fields.Float(description="The consumption rate, in the display volume unit per day"),
+        "estimatedEmptyOn": fields.DateTime(dt_format="iso8601", description="When the keg is projected to run out at the consumption rate"),
         "online": fields.Boolean(description=""),
         "emptyKegWeightGrams": fields.Float(description="Total volume remaining")
     } | IN_FIELDS)
@@ -85,9 +90,22 @@ class DeviceResource(AsyncBaseResource):
             latest_measurement_ml = self.get_device_value_in_ml(dev, "latestMeasurement", "latestMeasurementUnit")
             total_remaining = start_vol_ml - latest_measurement_ml
         
+        # the consumption rate is maintained on every ingested measurement (see DevicesDB.record_measurements), so the
+        # forecast is only a projection of the remaining volume at that rate
+        rate = dev.get("consumptionMlPerHour")
+        displayUnit = dev.get("displayVolumeUnit", "ml")
+        if rate is not None:
+            per_day = rate * 24
+            if displayUnit != "ml":
+                per_day = convert_from_ml(per_day, displayUnit)
+            dev["consumptionPerDay"] = round(per_day, 2)
+
         if total_remaining > 0:
+            empty_on = estimate_empty_on(total_remaining, rate, dev.get("latestMeasurementTakenOn"))
+            if empty_on is not None:
+                dev["estimatedEmptyOn"] = empty_on
+
             percent_remaining = total_remaining / start_vol_ml * 100
-            displayUnit = dev.get("displayVolumeUnit", "ml")
             if displayUnit != "ml":
                 total_remaining= convert_from_ml(total_remaining, displayUnit)
                 pass
@@ -122,7 +140,7 @@ class Devices(DeviceResource):
     @api.response(200, 'Success', device_mod)
     @async_login_required(allow_device=False)
     async def get(self, *args, current_user=None, **kwargs):
-        with session_scope(self.config) as db_session:
+        with session_scope(self.config, read_only=True) as db_session:
             devices = DevicesDB.get_all_with_measurement_stats(db_session)
             if devices:
                 self.logger.debug(f"devices found. results: {devices}")
@@ -138,7 +156,7 @@ class Devices(DeviceResource):
             data = api.payload
             data["chipType"] = "Particle"
 
-            existing_dev = DevicesDB.get_by_chip_id(db_session, data["chipType"], data["chipId"])
+            existing_dev = lookups.devices_by_chip_id(db_session, data["chipType"], data["chipId"])
             if existing_dev:
                 api.abort(400, "Device already exists")
 
@@ -198,7 +216,10 @@ class Devices(DeviceResource):
 
             self.logger.debug(f"Creating device record with data: {data}")
             dev = DevicesDB.create(db_session, **obj_keys_camel_to_snake(data))
-            return await self.transform_response(dev)
+            res = await self.transform_response(dev)
+        # the device's api key may have been tried, and cached as invalid, before it was registered
+        forget_principal()
+        return res
 
 @api.route('/find')
 @api.response(404, 'Device not found')
@@ -225,8 +246,8 @@ class FindDevice(DeviceResource):
         elif chip_type.lower() != "particle":
             api.abort(400, "Invalid chip_type.  Currently only 'Particle' is supported")
 
-        with session_scope(self.config) as db_session:
-            devs = DevicesDB.get_by_chip_id(db_session, chip_type, chip_id)
+        with session_scope(self.config, read_only=True) as db_session:
+            devs = lookups.devices_by_chip_id(db_session, chip_type, chip_id)
             if devs:
                 self.logger.debug(f"found device(s) matching chip type: {chip_type} with chip id: {chip_id}, results: {devs}")
                 return await self.transform_response(devs)
@@ -243,7 +264,7 @@ class Device(DeviceResource):
     @api.response(200, 'Success', device_mod)
     @async_login_required(allow_device=False)
     async def get(self, id, *args, current_user=None, **kwargs):
-        with session_scope(self.config) as db_session:
+        with session_scope(self.config, read_only=True) as db_session:
             dev = DevicesDB.get_with_measurement_stats(db_session, id)
             if dev:
                 self.logger.debug(f"Device found: {dev}")
@@ -275,7 +296,9 @@ class Device(DeviceResource):
             self.logger.debug(f"Updating device {id} with data {u_data}")
         
             dev = DevicesDB.update(db_session, id, **u_data)
-            return await self.transform_response(dev)
+            res = await self.transform_response(dev)
+        forget_principal(id)
+        return res
         
     @api.doc('delete_device', security=["apiKey"])
     @async_login_required(allow_device=False, allow_service_account=False, require_admin=True)
@@ -285,7 +308,8 @@ class Device(DeviceResource):
             if not dev:
                 api.abort(404)
             DevicesDB.delete(db_session, id)
-            return True
+        forget_principal(id)
+        return True
         
 
 @api.route("/<id>/rpc/<func_name>")
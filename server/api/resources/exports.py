@@ -0,0 +1,171 @@
+import asyncio
+
+from aiohttp import web
+
+from db import lookups, session_scope
+from db.devices import Devices as DevicesDB
+from db.device_measurements import DeviceMeasurements as DeviceMeasurementsDB
+from lib import exceptions as local_exc
+from lib import logging
+from lib.config import Config
+from lib.export import COLUMNAR_FORMATS, FORMATS, device_schema, encode_columnar, encode_rows, measurement_schema, require_pyarrow
+from lib.time import parse_timestamp_utc
+from resources import API_PREFIX
+from resources.auth import load_user_from_bearer_token
+
+# These are native aiohttp routes rather than flask-restx resources: the flask app is served through aiohttp_wsgi, which
+# buffers the whole response body, so responses that have to stream are handled before the request reaches it.
+routes = web.RouteTableDef()
+
+LOGGER = logging.getLogger(__name__)
+
+MEASUREMENT_EXPORT_COLUMNS = ["id", "deviceId", "measurement", "unit", "takenOn"]
+
+
+def _json_error(status, message):
+    return web.json_response({"message": message}, status=status)
+
+
+def _authenticate(config, request):
+    bearer_token = request.query.get("api_key")
+    if not bearer_token:
+        auth_token = request.headers.get("Authorization")
+        if auth_token:
+            bearer_token = auth_token.replace("Bearer ", "", 1).strip()
+
+    if not bearer_token:
+        return None
+
+    return load_user_from_bearer_token(config, bearer_token)
+
+
+def _parse_time_arg(request, key):
+    value = request.query.get(key)
+    if not value:
+        return None
+
+    try:
+        return parse_timestamp_utc(value)
+    except (OverflowError, OSError, ValueError):
+        raise ValueError(f"Invalid '{key}' value '{value}', expected a unix timestamp or an ISO 8601 datetime")
+
+
+def _device_exists(config, device_id):
+    with session_scope(config, read_only=True) as db_session:
+        return lookups.device_by_pkey(db_session, device_id) is not None
+
+
+def _export_chunks(config, device_id, fmt, start, end):
+    with session_scope(config, read_only=True) as db_session:
+        rows = DeviceMeasurementsDB.stream(db_session, device_id, start=start, end=end, batch_size=config.get("measurements.export.batch_size"))
+        yield from encode_rows(rows, MEASUREMENT_EXPORT_COLUMNS, fmt, chunk_bytes=config.get("measurements.export.chunk_bytes"))
+
+
+def _columnar_export_chunks(config, table, fmt, device_id, start, end):
+    batch_size = config.get("measurements.export.batch_size")
+    with session_scope(config, read_only=True) as db_session:
+        if table == "devices":
+            schema = device_schema()
+            rows = DevicesDB.stream(db_session, schema.names, batch_size=batch_size)
+        else:
+            schema = measurement_schema()
+            rows = DeviceMeasurementsDB.stream(db_session, device_id, start=start, end=end, batch_size=batch_size)
+        yield from encode_columnar(rows, schema, fmt)
+
+
+async def _authorize(request, require_admin=False):
+    # Returns the authenticated user, or the error response to send.  Mirrors async_login_required(allow_device=False)
+    config = Config()
+    try:
+        current_user = await asyncio.get_running_loop().run_in_executor(None, _authenticate, config, request)
+    except local_exc.InvalidBearerToken as ex:
+        return None, _json_error(401, str(ex))
+
+    if not current_user:
+        return None, _json_error(401, "The server could not verify that you are authorized to access the URL requested.")
+
+    if require_admin and (current_user.human and not current_user.admin):
+        return None, _json_error(403, "you are not authorized to execute admin actions")
+
+    if current_user.device:
+        return None, _json_error(403, "devices are not allowed")
+
+    return current_user, None
+
+
+async def _stream_response(request, content_type, filename, chunks):
+    loop = asyncio.get_running_loop()
+    response = web.StreamResponse(headers={"Content-Type": content_type, "Content-Disposition": f'attachment; filename="{filename}"'})
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+
+    # the rows are pulled off the server side cursor a chunk at a time in the executor, so neither the loop nor the
+    # process ever holds more than a chunk and the cursor's current batch
+    try:
+        while (chunk := await loop.run_in_executor(None, next, chunks, None)) is not None:
+            await response.write(chunk)
+    finally:
+        # closes the cursor and session, also when the client goes away mid export
+        await loop.run_in_executor(None, chunks.close)
+
+    await response.write_eof()
+    return response
+
+
+@routes.get(f"{API_PREFIX}/devices/{{device_id}}/measurements/export")
+async def export_device_measurements(request):
+    config = Config()
+    loop = asyncio.get_running_loop()
+    device_id = request.match_info["device_id"]
+
+    _, error = await _authorize(request)
+    if error:
+        return error
+
+    fmt = request.query.get("format", "ndjson").lower()
+    if fmt not in FORMATS:
+        return _json_error(400, f"Invalid format '{fmt}', expected one of: {', '.join(FORMATS)}")
+
+    try:
+        start = _parse_time_arg(request, "from")
+        end = _parse_time_arg(request, "to")
+    except ValueError as ex:
+        return _json_error(400, str(ex))
+
+    if not await loop.run_in_executor(None, _device_exists, config, device_id):
+        return _json_error(404, f"Device {device_id} not found")
+
+    chunks = _export_chunks(config, device_id, fmt, start, end)
+    return await _stream_response(request, f"{FORMATS[fmt]}; charset=utf-8", f"{device_id}-measurements.{fmt}", chunks)
+
+
+@routes.get(f"{API_PREFIX}/admin/exports/{{table}}")
+async def export_table(request):
+    config = Config()
+    table = request.match_info["table"]
+
+    _, error = await _authorize(request, require_admin=True)
+    if error:
+        return error
+
+    if table not in ("devices", "measurements"):
+        return _json_error(404, f"Unknown export '{table}', expected one of: devices, measurements")
+
+    fmt = request.query.get("format", "parquet").lower()
+    if fmt not in COLUMNAR_FORMATS:
+        return _json_error(400, f"Invalid format '{fmt}', expected one of: {', '.join(COLUMNAR_FORMATS)}")
+
+    try:
+        require_pyarrow()
+    except RuntimeError as ex:
+        return _json_error(501, str(ex))
+
+    device_id = request.query.get("device_id")
+    try:
+        start = _parse_time_arg(request, "from")
+        end = _parse_time_arg(request, "to")
+    except ValueError as ex:
+        return _json_error(400, str(ex))
+
+    chunks = _columnar_export_chunks(config, table, fmt, device_id, start, end)
+    return await _stream_response(request, COLUMNAR_FORMATS[fmt], f"{table}.{fmt}", chunks)
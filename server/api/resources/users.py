@@ -1,13 +1,14 @@
-import inspect
-
 from flask_login import current_user as _current_user
 from flask_restx import Namespace, reqparse, fields
 
 import asyncio
 from db import session_scope
 from db.users import Users as UsersDB
+from lib import exceptions as local_exc
+from lib.passwords import get_password_hasher
 from lib.util import random_string, obj_keys_camel_to_snake
-from resources import AsyncBaseResource, async_login_required
+from resources import AsyncBaseResource, async_login_required, get_current_user
+from resources.auth import forget_principal
 
 api = Namespace('users', description='Users APIs')
 
@@ -29,6 +30,18 @@ user_mod = api.model("User", {
 
 
 class UserResource(AsyncBaseResource):
+    async def hash_password(self, u_data):
+        # replaces the password in the user data with its hash, computed on the password hasher pool
+        password = u_data.pop("password", None)
+        if not password:
+            return u_data
+
+        try:
+            u_data["password_hash"] = await get_password_hasher(self.config).hash(password)
+        except local_exc.PasswordHasherBusy as ex:
+            api.abort(503, str(ex))
+        return u_data
+
     async def transform_response(self, user, transform_keys=None, remove_keys=None, current_user=None):
         data = user.to_dict()
         if not remove_keys:
@@ -42,9 +55,8 @@ class UserResource(AsyncBaseResource):
         if not current_user.admin and current_user.id == user.id:
             remove_keys.append("api_key")
 
-        data["password_enabled"] = False
-        if data.get("password_hash"):
-            data["password_enabled"] = True
+        # users are Users entities, or the AuthUser of the request which carries password_enabled rather than the hash
+        data["password_enabled"] = bool(data.get("password_enabled") or data.get("password_hash"))
 
         res = AsyncBaseResource.transform_response(data, transform_keys=transform_keys, remove_keys=remove_keys)
         return res
@@ -57,10 +69,7 @@ class Me(UserResource):
     @api.doc('get_current_user', security=["apiKey"])
     @api.response(200, 'Success')
     async def get(self, *args, **kwargs):    
-        if inspect.iscoroutine(_current_user):
-            cu = await _current_user
-        else:
-            cu = _current_user
+        cu = await get_current_user()
 
         if not cu:
             api.abort(401)
@@ -71,12 +80,10 @@ class Me(UserResource):
         if not cu.human:
             api.abort(401)
             
-        with session_scope(self.config) as db_session:      
-            user = UsersDB.get_by_pkey(db_session, cu.id)
-            remove_keys = []
-            if not user.admin:
-                remove_keys.append("admin")
-            return await self.transform_response(user, remove_keys=remove_keys, current_user=cu)
+        remove_keys = []
+        if not cu.admin:
+            remove_keys.append("admin")
+        return await self.transform_response(cu, remove_keys=remove_keys, current_user=cu)
         
 
 @api.route("", "/")
@@ -97,8 +104,8 @@ class Users(UserResource):
     async def post(self, *args, current_user=None, **kwargs):
         data = data = api.payload
 
+        u_data = await self.hash_password(obj_keys_camel_to_snake(data))
         with session_scope(self.config) as db_session:
-            u_data = obj_keys_camel_to_snake(data)
             self.logger.debug("Creating user with data: %s", u_data)
             user = UsersDB.create(db_session, **u_data)
             return await self.transform_response(user, current_user=current_user)
@@ -128,21 +135,24 @@ class User(UserResource):
         if "password" in data and user_c.id != user_id and not user_c.admin:
             api.abort(400, "You are not authorized to change the password for another user.")
 
+        disable_password = "password" in data and data["password"] is None
+        u_data = await self.hash_password(obj_keys_camel_to_snake(data))
+
         with session_scope(self.config) as db_session:
             user = UsersDB.get_by_pkey(db_session, user_id)
 
             if not user:
                 api.abort(404)
 
-            if "password" in data and data["password"] is None:
-                del data["password"]
+            if disable_password:
                 self.logger.debug("Disabling password for user '%s' (%s): %s", user.email, user_id)
                 UsersDB.disable_password(db_session, user_id)
 
-            u_data = obj_keys_camel_to_snake(data)
             self.logger.debug("Updating user '%s' (%s) with data: %s", user.email, user_id, u_data)
             user = UsersDB.update(db_session, user_id, **u_data)
-            return await self.transform_response(user, current_user=current_user)
+            res = await self.transform_response(user, current_user=current_user)
+        forget_principal(user_id)
+        return res
 
     @api.doc('delete_user', security=["apiKey"])
     @api.expect(new_user_mod, validate=False)
@@ -160,7 +170,8 @@ class User(UserResource):
 
             self.logger.debug("Deleting user '%s' (%s)", user.email, user_id)
             UsersDB.delete(db_session, user_id)
-            return True
+        forget_principal(user_id)
+        return True
         
 
 @api.route('/<user_id>/api_key')
@@ -205,7 +216,8 @@ class UserAPIKey(UserResource):
             self.logger.debug("Generating API key for user '%s' (%s)", user.email, user_id)
             api_key = random_string(self.config.get("general.default_api_key_length"))
             UsersDB.update(db_session, user_id, api_key=api_key)
-            return api_key
+        forget_principal(user_id)
+        return api_key
 
     @api.doc('delete_user_api_key', security=["apiKey"])
     @api.response(200, 'Success')
@@ -222,4 +234,5 @@ class UserAPIKey(UserResource):
 
             self.logger.debug("Deleting user '%s' (%s)s api key", user.email, user_id)
             UsersDB.update(db_session, user_id, api_key=None)
-            return True
\ No newline at end of file
+        forget_principal(user_id)
+        return True
\ No newline at end of file
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import os
+
+from db import session_scope, devices, device_measurements
+from lib.config import Config
+from lib.export import device_schema, write_columnar_file, write_partitioned_measurements
+from lib.time import parse_timestamp_utc
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the devices and their measurements as parquet for offline analytics")
+
+    # parse logging level arg:
+    parser.add_argument(
+        "-l",
+        "--log",
+        dest="loglevel",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+        default=os.environ.get("LOG_LEVEL", "INFO").upper(),
+        help="Set the logging level",
+    )
+    parser.add_argument("-o", "--out-dir", default="export", help="The directory to write the export to.  Default: ./export")
+    parser.add_argument("--device-id", help="Only export the measurements of this device")
+    parser.add_argument(
+        "--from", dest="start", type=parse_timestamp_utc, help="Only export measurements taken on or after this time (unix timestamp or ISO 8601)",
+    )
+    parser.add_argument("--to", dest="end", type=parse_timestamp_utc, help="Only export measurements taken before this time (unix timestamp or ISO 8601)")
+
+    args = parser.parse_args()
+    log_level = getattr(logging, args.loglevel)
+    logging.basicConfig(level=log_level, format="%(levelname)-8s: %(asctime)-15s [%(name)s]: %(message)s")
+    logger = logging.getLogger()
+
+    config = Config()
+    config.setup(config_files=["default.json"])
+    batch_size = config.get("measurements.export.batch_size")
+
+    with session_scope(config) as db_session:
+        schema = device_schema()
+        rows = devices.Devices.stream(db_session, schema.names, batch_size=batch_size)
+        path = write_columnar_file(rows, schema, os.path.join(args.out_dir, "devices.parquet"))
+        logger.info("Exported devices to %s", path)
+
+    with session_scope(config) as db_session:
+        # <out dir>/device_measurements/device_id=<id>/month=<YYYY-MM>/part-0.parquet, readable as a hive partitioned
+        # dataset, ex: duckdb "SELECT * FROM read_parquet('export/device_measurements/*/*/*.parquet', hive_partitioning=true)"
+        rows = device_measurements.DeviceMeasurements.stream(db_session, args.device_id, start=args.start, end=args.end, batch_size=batch_size)
+        paths = write_partitioned_measurements(rows, os.path.join(args.out_dir, "device_measurements"))
+        logger.info("Exported device measurements to %s partition file(s) under %s", len(paths), os.path.join(args.out_dir, "device_measurements"))
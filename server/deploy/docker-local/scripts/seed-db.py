@@ -63,19 +63,19 @@ DEVICES = [
     }
 ]
 
-MEASUREMENT_ID_1 = "d4dafc76-94c2-40fd-af8a-93fdacc74dff"
-MEASUREMENT_ID_2 = "c5cac4e9-495a-4a33-b781-0f43cc34482d"
-MEASUREMENT_ID_3 = "9348ac29-af33-404f-affd-e60a3da92d8a"
-MEASUREMENT_ID_4 = "9a01c621-edb9-4524-9309-6e3ce8db90cf"
-MEASUREMENT_ID_5 = "46996c5b-e7ba-444d-a23a-fffe8dd07f59"
-MEASUREMENT_ID_6 = "f4117dd9-0a54-4a40-ae24-4593eb22a704"
-MEASUREMENT_ID_7 = "b1d00235-54d7-45f0-9d08-2ac45ce6e5db"
-MEASUREMENT_ID_8 = "84e31930-3461-41b0-a89a-8169a1e13b20"
-MEASUREMENT_ID_9 = "081e19b4-73ff-4a4c-9a45-fdf3fc512da7"
-MEASUREMENT_ID_10 = "4da763d8-65df-4f78-a59f-bb855b4992ce"
-MEASUREMENT_ID_11 = "917f1581-0d66-4e9e-924a-37a54c9126f1"
-MEASUREMENT_ID_12 = "090c35e1-01c7-4099-8b6e-478280d41f98"
-MEASUREMENT_ID_13 = "78b30327-13de-4790-9bd4-c403266e4ff1"
+MEASUREMENT_ID_1 = 1
+MEASUREMENT_ID_2 = 2
+MEASUREMENT_ID_3 = 3
+MEASUREMENT_ID_4 = 4
+MEASUREMENT_ID_5 = 5
+MEASUREMENT_ID_6 = 6
+MEASUREMENT_ID_7 = 7
+MEASUREMENT_ID_8 = 8
+MEASUREMENT_ID_9 = 9
+MEASUREMENT_ID_10 = 10
+MEASUREMENT_ID_11 = 11
+MEASUREMENT_ID_12 = 12
+MEASUREMENT_ID_13 = 13
 MEASUREMENTS = [
     {
         "id": MEASUREMENT_ID_1,
@@ -145,28 +145,28 @@ MEASUREMENTS = [
         "device_id": DEVICE_ID_2,
         "measurement": 5109.764,
         "unit": "g",
-        "taken_on": datetime(2025, 4, 3, 6, 32, 00, tzinfo=timezone.utc)
+        "taken_on": datetime(2025, 4, 4, 6, 32, 00, tzinfo=timezone.utc)
     },
     {
         "id": MEASUREMENT_ID_11,
         "device_id": DEVICE_ID_2,
         "measurement": 4432.0,
         "unit": "g",
-        "taken_on": datetime(2025, 4, 3, 6, 32, 00, tzinfo=timezone.utc)
+        "taken_on": datetime(2025, 4, 5, 6, 32, 00, tzinfo=timezone.utc)
     },
     {
         "id": MEASUREMENT_ID_12,
         "device_id": DEVICE_ID_2,
         "measurement": 62678.8,
         "unit": "g",
-        "taken_on": datetime(2025, 4, 3, 6, 32, 00, tzinfo=timezone.utc)
+        "taken_on": datetime(2025, 4, 6, 6, 32, 00, tzinfo=timezone.utc)
     },
     {
         "id": MEASUREMENT_ID_13,
         "device_id": DEVICE_ID_2,
         "measurement": 5200,
         "unit": "g",
-        "taken_on": datetime(2025, 4, 3, 6, 32, 00, tzinfo=timezone.utc)
+        "taken_on": datetime(2025, 4, 7, 6, 32, 00, tzinfo=timezone.utc)
     }
 ]
 
@@ -229,3 +229,6 @@ if __name__ == "__main__":
 
         seed_db(db_session, devices.Devices, DEVICES)
         seed_db(db_session, device_measurements.DeviceMeasurements, MEASUREMENTS)
+        # the seeded measurements have fixed ids, new ones have to be numbered after them
+        db_session.execute(text("SELECT setval('device_measurements_id_seq', (SELECT max(id) FROM device_measurements))"))
+        devices.Devices.refresh_measurement_stats(db_session)
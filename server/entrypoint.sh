@@ -5,4 +5,5 @@ if [ "$RUN_ENV" = "dev" ]; then
 fi
 
 poetry run ./migrate.sh upgrade head
+poetry run python maintenance.py partitions
 poetry run python api.py